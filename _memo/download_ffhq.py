@@ -18,15 +18,22 @@ import PIL.ImageFile
 import numpy as np
 import scipy.ndimage
 import threading
+import concurrent.futures
 import queue
 import time
 import json
-import uuid
+import sqlite3
+import multiprocessing
 import glob
 import argparse
 import itertools
 import shutil
-from collections import OrderedDict, defaultdict
+from collections import defaultdict
+
+try:
+    import ijson # optional: incremental JSON parsing
+except ImportError:
+    ijson = None
 
 PIL.ImageFile.LOAD_TRUNCATED_IMAGES = True # avoid "Decompressed Data Too Large" error
 
@@ -56,51 +63,266 @@ license_specs = {
 
 #----------------------------------------------------------------------------
 
-def download_file(session, file_spec, stats, chunk_size=128, num_attempts=10, **kwargs):
+# Download engine. Each file is downloaded into a deterministic '<file_path>.tmp'
+# that later attempts (and later runs) resume with an HTTP Range request. Large
+# files on servers that honor ranges are split into segments fetched by several
+# threads in parallel; finished segments are recorded in '<file_path>.tmp.segments'.
+# Progress is tracked with one byte counter per thread that only its owner writes,
+# so the hot loop takes no lock and the status loop simply sums the counters.
+# Verification is pipelined: MD5 runs on a separate thread fed with memoryviews of
+# the received chunks, and pixel checks (PNG decode + pixel MD5) run in a process
+# pool while the download thread moves on to its next file.
+
+class _ByteCounter:
+    __slots__ = ['value']
+    def __init__(self):
+        self.value = 0
+
+def _thread_counter(stats):
+    counter = getattr(stats['local'], 'counter', None)
+    if counter is None:
+        counter = stats['local'].counter = _ByteCounter()
+        with stats['lock']:
+            stats['counters'].append(counter)
+    return counter
+
+def _bytes_done(stats):
+    return stats['bytes_base'] + sum(counter.value for counter in list(stats['counters']))
+
+def _file_md5(path, chunk_size=1<<20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return md5.hexdigest()
+            md5.update(chunk)
+
+class _HashPipe:
+    # MD5 on its own thread; hashlib releases the GIL, so hashing overlaps with network reads.
+    def __init__(self, md5=None, depth=64):
+        self.md5 = md5 if md5 is not None else hashlib.md5()
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            view = self.queue.get()
+            if view is None:
+                return
+            self.md5.update(view)
+
+    def update(self, chunk):
+        self.queue.put(memoryview(chunk)) # zero-copy; chunks are immutable bytes
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def hexdigest(self):
+        self.close()
+        return self.md5.hexdigest()
+
+def verify_pixels(path, pixel_size=None, pixel_md5=None):
+    # Runs in a worker process. Returns an error message, or None if the image matches.
+    with PIL.Image.open(path) as image:
+        if pixel_size is not None and list(image.size) != pixel_size:
+            return 'Incorrect pixel size'
+        if pixel_md5 is not None and hashlib.md5(np.array(image)).hexdigest() != pixel_md5:
+            return 'Incorrect pixel MD5'
+    return None
+
+def _pixel_args(file_spec, path):
+    if 'pixel_size' in file_spec or 'pixel_md5' in file_spec:
+        return (path, file_spec.get('pixel_size'), file_spec.get('pixel_md5'))
+    return None
+
+def _remove_tmp(tmp_path):
+    for path in [tmp_path, tmp_path + '.segments']:
+        if os.path.isfile(path):
+            os.remove(path)
+
+def _download_stream(session, file_url, tmp_path, counter, chunk_size):
+    # Downloads into tmp_path, resuming from its current size. Returns (size, md5) of the whole file.
+    offset = os.path.getsize(tmp_path) if os.path.isfile(tmp_path) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    with session.get(file_url, stream=True, headers=headers) as res:
+        if offset and res.status_code == 416: # already complete
+            counter.value += offset
+            return offset, _file_md5(tmp_path)
+        res.raise_for_status()
+        if res.status_code != 206:
+            offset = 0 # range ignored => start over
+        data_md5 = _HashPipe(_file_md5_state(tmp_path, offset))
+        counter.value += offset
+        data_size = offset
+        try:
+            with open(tmp_path, 'ab' if offset else 'wb') as f:
+                for chunk in res.iter_content(chunk_size=chunk_size<<10):
+                    f.write(chunk)
+                    data_size += len(chunk)
+                    data_md5.update(chunk)
+                    counter.value += len(chunk)
+        finally:
+            data_md5.close()
+    return data_size, data_md5.hexdigest()
+
+def _file_md5_state(path, num_bytes, chunk_size=1<<20):
+    # MD5 state after the first num_bytes of path, to continue hashing a resumed download.
+    md5 = hashlib.md5()
+    if num_bytes:
+        with open(path, 'rb') as f:
+            while num_bytes > 0:
+                chunk = f.read(min(chunk_size, num_bytes))
+                md5.update(chunk)
+                num_bytes -= len(chunk)
+    return md5
+
+def _supports_ranges(session, file_url, file_size):
+    try:
+        with session.get(file_url, stream=True, headers={'Range': 'bytes=0-0'}) as res:
+            return res.status_code == 206 and res.headers.get('Content-Range', '').endswith('/%d' % file_size)
+    except requests.RequestException:
+        return False
+
+def _download_segmented(file_url, tmp_path, file_size, stats, chunk_size, segment_size, max_segments):
+    # Makes one attempt at every missing segment. A failed segment is retried by the caller's next
+    # attempt, which resumes from the segments recorded as done in the state file.
+    state_path = tmp_path + '.segments'
+    num_segments = (file_size + segment_size - 1) // segment_size
+    done = set()
+    if os.path.isfile(state_path) and os.path.isfile(tmp_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('file_size') == file_size and state.get('segment_size') == segment_size:
+            done = set(state['done'])
+    if not done:
+        with open(tmp_path, 'wb') as f:
+            f.truncate(file_size)
+    _thread_counter(stats).value += sum(min(segment_size, file_size - idx * segment_size) for idx in done)
+
+    pending = queue.Queue()
+    for idx in range(num_segments):
+        if idx not in done:
+            pending.put(idx)
+    state_lock = threading.Lock()
+    failed = threading.Event()
+    worker_counters = []
+
+    def fetch_segments():
+        # Each call gets its own counter: the executor may run several calls on one thread,
+        # and a thread-local counter would then be registered and folded in more than once.
+        counter = _ByteCounter()
+        with stats['lock']:
+            stats['counters'].append(counter)
+            worker_counters.append(counter)
+        with requests.Session() as session:
+            while not failed.is_set():
+                try:
+                    idx = pending.get_nowait()
+                except queue.Empty:
+                    return
+                begin = idx * segment_size
+                end = min(begin + segment_size, file_size)
+                try:
+                    with session.get(file_url, stream=True, headers={'Range': 'bytes=%d-%d' % (begin, end - 1)}) as res:
+                        res.raise_for_status()
+                        if res.status_code != 206:
+                            raise IOError('Range request not honored', file_url)
+                        pos = begin
+                        with open(tmp_path, 'r+b') as f:
+                            f.seek(begin)
+                            for chunk in res.iter_content(chunk_size=chunk_size<<10):
+                                num_bytes = max(min(len(chunk), end - pos), 0) # ignore bytes past the segment
+                                f.write(chunk[:num_bytes])
+                                counter.value += num_bytes
+                                pos += len(chunk)
+                                if pos >= end:
+                                    break
+                    if pos < end:
+                        raise IOError('Incomplete segment', tmp_path, idx)
+                except:
+                    failed.set() # stop taking new segments; the caller retries the rest
+                    raise
+                with state_lock:
+                    done.add(idx)
+                    with open(state_path + '.new', 'w') as f:
+                        json.dump(dict(file_size=file_size, segment_size=segment_size, done=sorted(done)), f)
+                    os.replace(state_path + '.new', state_path)
+
+    # Worker counters are folded into the calling thread's counter (or dropped on failure,
+    # since the caller rewinds its own) so the list of counters does not grow with every file.
+    num_workers = max(min(max_segments, pending.qsize()), 1)
+    success = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for future in [executor.submit(fetch_segments) for _ in range(num_workers)]:
+                future.result()
+        success = True
+    finally:
+        counter = _thread_counter(stats)
+        with stats['lock']:
+            for worker_counter in worker_counters:
+                if success:
+                    counter.value += worker_counter.value
+                stats['counters'].remove(worker_counter)
+
+def download_file(session, file_spec, stats, chunk_size=128, num_attempts=10, segment_size=64, max_segments=8, verify_pool=None, defer_verify=False, **kwargs):
+    max_segments = file_spec.get('max_segments', max_segments) # raised by schedule_specs() for files that dominate the run
+    # With defer_verify, a download that passed its size/MD5 checks but still needs a pixel check
+    # returns the pending check as a future; the caller finishes it with _finish_download().
     file_path = file_spec['file_path']
     file_url = file_spec['file_url']
     file_dir = os.path.dirname(file_path)
-    tmp_path = file_path + '.tmp.' + uuid.uuid4().hex
+    tmp_path = file_path + '.tmp'
     if file_dir:
         os.makedirs(file_dir, exist_ok=True)
 
+    # Split large files into parallel range requests when the server supports them.
+    counter = _thread_counter(stats)
+    segment_bytes = segment_size << 20
+    segmented = max_segments > 1 and file_spec.get('file_size', 0) >= 2 * segment_bytes and _supports_ranges(session, file_url, file_spec['file_size'])
+
     for attempts_left in reversed(range(num_attempts)):
-        data_size = 0
+        start_value = counter.value
         try:
             # Download.
-            data_md5 = hashlib.md5()
-            with session.get(file_url, stream=True) as res:
-                res.raise_for_status()
-                with open(tmp_path, 'wb') as f:
-                    for chunk in res.iter_content(chunk_size=chunk_size<<10):
-                        f.write(chunk)
-                        data_size += len(chunk)
-                        data_md5.update(chunk)
-                        with stats['lock']:
-                            stats['bytes_done'] += len(chunk)
-
-            # Validate.
+            if segmented:
+                _download_segmented(file_url, tmp_path, file_spec['file_size'], stats, chunk_size, segment_bytes, max_segments)
+                data_size, data_md5 = os.path.getsize(tmp_path), _file_md5(tmp_path)
+            else:
+                data_size, data_md5 = _download_stream(session, file_url, tmp_path, counter, chunk_size)
+
+            # Validate. A complete but corrupt file is discarded so the next attempt starts over.
             if 'file_size' in file_spec and data_size != file_spec['file_size']:
+                if data_size > file_spec['file_size']:
+                    _remove_tmp(tmp_path)
                 raise IOError('Incorrect file size', file_path)
-            if 'file_md5' in file_spec and data_md5.hexdigest() != file_spec['file_md5']:
+            if 'file_md5' in file_spec and data_md5 != file_spec['file_md5']:
+                _remove_tmp(tmp_path)
                 raise IOError('Incorrect file MD5', file_path)
-            if 'pixel_size' in file_spec or 'pixel_md5' in file_spec:
-                with PIL.Image.open(tmp_path) as image:
-                    if 'pixel_size' in file_spec and list(image.size) != file_spec['pixel_size']:
-                        raise IOError('Incorrect pixel size', file_path)
-                    if 'pixel_md5' in file_spec and hashlib.md5(np.array(image)).hexdigest() != file_spec['pixel_md5']:
-                        raise IOError('Incorrect pixel MD5', file_path)
+            pixel_args = _pixel_args(file_spec, tmp_path)
+            if pixel_args is not None:
+                if verify_pool is not None and defer_verify:
+                    return verify_pool.submit(verify_pixels, *pixel_args)
+                error = verify_pool.submit(verify_pixels, *pixel_args).result() if verify_pool is not None else verify_pixels(*pixel_args)
+                if error is not None:
+                    _remove_tmp(tmp_path)
+                    raise IOError(error, file_path)
             break
 
         except:
-            with stats['lock']:
-                stats['bytes_done'] -= data_size
+            counter.value = start_value
+            data_size = os.path.getsize(tmp_path) if os.path.isfile(tmp_path) and not segmented else 0
 
             # Handle known failure cases.
             if data_size > 0 and data_size < 8192:
                 with open(tmp_path, 'rb') as f:
                     data = f.read()
-                data_str = data.decode('utf-8')
+                data_str = data.decode('utf-8', errors='ignore')
+                _remove_tmp(tmp_path) # small enough to restart, and possibly an HTML page rather than data
 
                 # Google Drive virus checker nag.
                 links = [html.unescape(link) for link in data_str.split('"') if 'export=download' in link]
@@ -118,12 +340,18 @@ def download_file(session, file_spec, stats, chunk_size=128, num_attempts=10, **
             if not attempts_left:
                 raise
 
+    _finish_download(file_path, stats)
+    return None
+
+def _finish_download(file_path, stats):
     # Rename temp file to the correct name.
+    tmp_path = file_path + '.tmp'
     os.replace(tmp_path, file_path) # atomic
+    _remove_tmp(tmp_path)
     with stats['lock']:
         stats['files_done'] += 1
 
-    # Attempt to clean up any leftover temps.
+    # Attempt to clean up any leftover temps from older versions of this script.
     for filename in glob.glob(file_path + '.tmp.*'):
         try:
             os.remove(filename)
@@ -151,69 +379,213 @@ def format_time(seconds):
     return '>100d'
 
 #----------------------------------------------------------------------------
+# Scheduling. File sizes range from 1.6 kB licenses to 220 GB TFRecords, so the
+# queue is ordered by size instead of shuffled: files that are large relative to
+# a thread's share of the work go first, largest first (LPT), each followed by a
+# run of small files to keep the mix of connections homogeneous. A file larger
+# than a whole share is split into more ranges so no single thread becomes the
+# tail of the run. The resulting list schedule gives the projected makespan.
+
+def _num_segments(file_size, segment_bytes, max_segments):
+    if max_segments <= 1 or file_size < 2 * segment_bytes:
+        return 1
+    return min(max_segments, -(-file_size // segment_bytes))
+
+def schedule_specs(file_specs, num_threads, segment_size=64, max_segments=8, large_fraction=0.25):
+    # Returns (ordered specs, makespan) where makespan is the busiest thread's load in bytes per connection.
+    segment_bytes = segment_size << 20
+    num_threads = max(min(num_threads, len(file_specs)), 1)
+    share = max(sum(spec['file_size'] for spec in file_specs) / num_threads, 1)
 
-def download_files(file_specs, num_threads=32, status_delay=0.2, timing_window=50, **download_kwargs):
+    specs = []
+    for spec in file_specs:
+        segments = _num_segments(spec['file_size'], segment_bytes, max_segments)
+        if spec['file_size'] / segments > share and segments > 1:
+            segments = max(segments, min(num_threads, -(-spec['file_size'] // int(share)), -(-spec['file_size'] // segment_bytes)))
+            spec = dict(spec, max_segments=segments)
+        specs.append((spec['file_size'] / segments, spec))
+
+    large = sorted([job for job in specs if job[0] >= share * large_fraction], key=lambda job: -job[0])
+    small = [job for job in specs if job[0] < share * large_fraction]
+    np.random.shuffle(small) # equal-sized files: mix directories as before
+    gap = min(len(small) // len(large), num_threads) if large else 0
+    jobs = []
+    for idx, job in enumerate(large):
+        jobs += [job] + small[idx * gap:(idx + 1) * gap]
+    jobs += small[len(large) * gap:]
+
+    # Greedy list scheduling, as the download threads pull from the queue.
+    loads = [0.0] * num_threads
+    for work, _spec in jobs:
+        loads[loads.index(min(loads))] += work
+    return [spec for _work, spec in jobs], max(loads)
+
+#----------------------------------------------------------------------------
+
+def download_files(file_specs, num_threads=32, status_delay=0.2, timing_window=50, verify_processes=None, **download_kwargs):
 
     # Determine which files to download.
     done_specs = {spec['file_path']: spec for spec in file_specs if os.path.isfile(spec['file_path'])}
     missing_specs = [spec for spec in file_specs if spec['file_path'] not in done_specs]
     files_total = len(file_specs)
     bytes_total = sum(spec['file_size'] for spec in file_specs)
-    stats = dict(files_done=len(done_specs), bytes_done=sum(spec['file_size'] for spec in done_specs.values()), lock=threading.Lock())
+    stats = dict(files_done=len(done_specs), bytes_base=sum(spec['file_size'] for spec in done_specs.values()), counters=[], local=threading.local(), lock=threading.Lock())
     if len(done_specs) == files_total:
         print('All files already downloaded -- skipping.')
         return
 
-    # Launch worker threads.
-    spec_queue = queue.Queue()
-    exception_queue = queue.Queue()
-    for spec in missing_specs:
-        spec_queue.put(spec)
-    thread_kwargs = dict(spec_queue=spec_queue, exception_queue=exception_queue, stats=stats, download_kwargs=download_kwargs)
-    for _thread_idx in range(min(num_threads, len(missing_specs))):
-        threading.Thread(target=_download_thread, kwargs=thread_kwargs, daemon=True).start()
-
-    # Monitor status until done.
-    bytes_unit, bytes_div = choose_bytes_unit(bytes_total)
-    spinner = '/-\\|'
-    timing = []
-    while True:
-        with stats['lock']:
-            files_done = stats['files_done']
-            bytes_done = stats['bytes_done']
-        spinner = spinner[1:] + spinner[:1]
-        timing = timing[max(len(timing) - timing_window + 1, 0):] + [(time.time(), bytes_done)]
-        bandwidth = max((timing[-1][1] - timing[0][1]) / max(timing[-1][0] - timing[0][0], 1e-8), 0)
-        bandwidth_unit, bandwidth_div = choose_bytes_unit(bandwidth)
-        eta = format_time((bytes_total - bytes_done) / max(bandwidth, 1))
-
-        print('\r%s %6.2f%% done  %d/%d files  %-13s  %-10s  ETA: %-7s ' % (
-            spinner[0],
-            bytes_done / bytes_total * 100,
-            files_done, files_total,
-            '%.2f/%.2f %s' % (bytes_done / bytes_div, bytes_total / bytes_div, bytes_unit),
-            '%.2f %s/s' % (bandwidth / bandwidth_div, bandwidth_unit),
-            'done' if bytes_total == bytes_done else '...' if len(timing) < timing_window or bandwidth == 0 else eta,
-        ), end='', flush=True)
-
-        if files_done == files_total:
-            print()
-            break
+    # Pixel checks run in worker processes, spawned rather than forked since download threads are running.
+    verify_pool = None
+    if any(_pixel_args(spec, spec['file_path']) is not None for spec in missing_specs):
+        verify_pool = concurrent.futures.ProcessPoolExecutor(verify_processes, mp_context=multiprocessing.get_context('spawn'))
+    download_kwargs = dict(download_kwargs, verify_pool=verify_pool)
+
+    try:
+        # Launch worker threads.
+        missing_specs, makespan = schedule_specs(missing_specs, num_threads, download_kwargs.get('segment_size', 64), download_kwargs.get('max_segments', 8))
+        num_connections = min(num_threads, len(missing_specs))
+        spec_queue = queue.Queue()
+        exception_queue = queue.Queue()
+        for spec in missing_specs:
+            spec_queue.put(spec)
+        thread_kwargs = dict(spec_queue=spec_queue, exception_queue=exception_queue, stats=stats, download_kwargs=download_kwargs)
+        for _thread_idx in range(min(num_threads, len(missing_specs))):
+            threading.Thread(target=_download_thread, kwargs=thread_kwargs, daemon=True).start()
+
+        # Monitor status until done.
+        bytes_unit, bytes_div = choose_bytes_unit(bytes_total)
+        spinner = '/-\\|'
+        timing = []
+        while True:
+            with stats['lock']:
+                files_done = stats['files_done']
+            bytes_done = _bytes_done(stats)
+            spinner = spinner[1:] + spinner[:1]
+            timing = timing[max(len(timing) - timing_window + 1, 0):] + [(time.time(), bytes_done)]
+            bandwidth = max((timing[-1][1] - timing[0][1]) / max(timing[-1][0] - timing[0][0], 1e-8), 0)
+            bandwidth_unit, bandwidth_div = choose_bytes_unit(bandwidth)
+            eta = format_time((bytes_total - bytes_done) / max(bandwidth, 1))
+            makespan_time = format_time(makespan * num_connections / max(bandwidth, 1)) # assumes connections share bandwidth evenly
+
+            print('\r%s %6.2f%% done  %d/%d files  %-13s  %-10s  ETA: %-7s  makespan: %-7s ' % (
+                spinner[0],
+                bytes_done / bytes_total * 100,
+                files_done, files_total,
+                '%.2f/%.2f %s' % (bytes_done / bytes_div, bytes_total / bytes_div, bytes_unit),
+                '%.2f %s/s' % (bandwidth / bandwidth_div, bandwidth_unit),
+                'done' if bytes_total == bytes_done else '...' if len(timing) < timing_window or bandwidth == 0 else eta,
+                '...' if len(timing) < timing_window or bandwidth == 0 else makespan_time,
+            ), end='', flush=True)
+
+            if files_done == files_total:
+                print()
+                break
 
-        try:
-            exc_info = exception_queue.get(timeout=status_delay)
-            raise exc_info[1].with_traceback(exc_info[2])
-        except queue.Empty:
-            pass
+            try:
+                exc_info = exception_queue.get(timeout=status_delay)
+                raise exc_info[1].with_traceback(exc_info[2])
+            except queue.Empty:
+                pass
+    finally:
+        if verify_pool is not None:
+            verify_pool.shutdown(wait=False, cancel_futures=True)
 
 def _download_thread(spec_queue, exception_queue, stats, download_kwargs):
+    verifying = [] # (spec, future) of downloads waiting for their pixel check
     with requests.Session() as session:
+        def finish(spec, future):
+            try:
+                error = future.exception() or future.result()
+                if error is None:
+                    _finish_download(spec['file_path'], stats)
+                    return
+                _remove_tmp(spec['file_path'] + '.tmp') # corrupt => download again, verifying synchronously
+                _thread_counter(stats).value -= spec['file_size']
+                download_file(session, spec, stats, **download_kwargs)
+            except:
+                exception_queue.put(sys.exc_info())
+
         while not spec_queue.empty():
             spec = spec_queue.get()
             try:
-                download_file(session, spec, stats, **download_kwargs)
+                future = download_file(session, spec, stats, defer_verify=True, **download_kwargs)
+                if future is not None:
+                    verifying.append((spec, future))
             except:
                 exception_queue.put(sys.exc_info())
+            while verifying and verifying[0][1].done():
+                finish(*verifying.pop(0))
+        for spec, future in verifying:
+            finish(spec, future)
+
+#----------------------------------------------------------------------------
+# Re-checking an existing tree: size, MD5 and pixels of every file, in parallel.
+# Files that passed are recorded by (path, size, mtime) in a small SQLite cache,
+# so repeated runs only read files that are new or have changed since.
+
+def verify_file(file_spec):
+    # Runs in a worker process. Returns an error message, or None if the file is intact.
+    file_path = file_spec['file_path']
+    if 'file_size' in file_spec and os.path.getsize(file_path) != file_spec['file_size']:
+        return 'Incorrect file size'
+    if 'file_md5' in file_spec and _file_md5(file_path) != file_spec['file_md5']:
+        return 'Incorrect file MD5'
+    pixel_args = _pixel_args(file_spec, file_path)
+    try:
+        return verify_pixels(*pixel_args) if pixel_args is not None else None
+    except Exception as e:
+        return 'Unreadable image (%s)' % e
+
+def verify_files(file_specs, cache_path, num_processes=None, status_delay=0.2):
+    conn = sqlite3.connect(cache_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS verified (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+    cached = {path: (size, mtime_ns) for path, size, mtime_ns in conn.execute('SELECT path, size, mtime_ns FROM verified')}
+
+    # Skip files whose size and mtime match the last successful check.
+    missing, todo = [], []
+    for spec in file_specs:
+        try:
+            st = os.stat(spec['file_path'])
+        except FileNotFoundError:
+            missing.append(spec['file_path'])
+            continue
+        if cached.get(spec['file_path']) != (st.st_size, st.st_mtime_ns):
+            todo.append((spec, st))
+    num_cached = len(file_specs) - len(missing) - len(todo)
+    print('Verifying %d files (%d unchanged since last verified, %d missing)...' % (len(todo), num_cached, len(missing)))
+
+    corrupt, passed = [], []
+    t0 = last_print = time.time()
+    with concurrent.futures.ProcessPoolExecutor(num_processes) as executor:
+        results = executor.map(verify_file, [spec for spec, _st in todo], chunksize=16)
+        for idx, ((spec, st), error) in enumerate(zip(todo, results)):
+            if error is None:
+                passed.append((spec['file_path'], st.st_size, st.st_mtime_ns))
+            else:
+                corrupt.append((spec['file_path'], error))
+            if len(passed) >= 1000 or idx == len(todo) - 1:
+                conn.executemany('INSERT OR REPLACE INTO verified VALUES (?, ?, ?)', passed)
+                conn.commit()
+                passed = []
+            if time.time() - last_print >= status_delay or idx == len(todo) - 1:
+                last_print = time.time()
+                rate = (idx + 1) / max(last_print - t0, 1e-8)
+                print('\r%d/%d files  %d corrupt  %.1f files/s  ETA: %-7s ' % (idx + 1, len(todo), len(corrupt), rate, format_time((len(todo) - idx - 1) / rate)), end='', flush=True)
+    if todo:
+        print()
+    conn.executemany('DELETE FROM verified WHERE path = ?', [(path,) for path, _error in corrupt])
+    conn.commit()
+    conn.close()
+
+    for path, error in corrupt[:20]:
+        print('  %s: %s' % (path, error))
+    if len(corrupt) > 20:
+        print('  ... and %d more' % (len(corrupt) - 20))
+    if corrupt or missing:
+        print('%d corrupt and %d missing files. Delete the corrupt files and download again to replace them.' % (len(corrupt), len(missing)))
+    else:
+        print('All %d files verified.' % len(file_specs))
+    return corrupt, missing
 
 #----------------------------------------------------------------------------
 
@@ -254,162 +626,361 @@ def print_statistics(json_data):
     for row in rows:
         print("  ".join(cell + " " * (width - len(cell)) for cell, width in zip(row, widths)))
 
+#----------------------------------------------------------------------------
+# Metadata loading: the 254 MB JSON is parsed once (incrementally when ijson is
+# installed) into a compact columnar cache -- Parquet (or .npz without pyarrow)
+# for the per-file columns and a NumPy array for the landmarks -- so later runs
+# start without touching the JSON.
+
+metadata_kinds = ['image', 'thumbnail', 'in_the_wild']
+metadata_fields = ['file_url', 'file_path', 'file_size', 'file_md5', 'pixel_md5']
+
+def iter_json_items(json_path):
+    with open(json_path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.kvitems(f, '', use_float=True)
+        else:
+            yield from json.load(f).items()
+
+def _columns_from_items(items):
+    columns = defaultdict(list)
+    landmarks = []
+    for key, item in items:
+        columns['key'].append(key)
+        columns['category'].append(item['category'])
+        columns['license'].append(item['metadata']['license'] or '')
+        columns['country'].append(item['metadata']['country'] or '')
+        for kind in metadata_kinds:
+            spec = item[kind]
+            for field in metadata_fields:
+                columns['%s.%s' % (kind, field)].append(spec.get(field, -1 if field == 'file_size' else ''))
+            pixel_size = spec.get('pixel_size', [-1, -1])
+            columns['%s.pixel_width' % kind].append(pixel_size[0])
+            columns['%s.pixel_height' % kind].append(pixel_size[1])
+        landmarks.append(item['in_the_wild']['face_landmarks'])
+    columns = {name: np.array(values, dtype=np.int64 if name.endswith(('file_size', 'pixel_width', 'pixel_height')) else str) for name, values in columns.items()}
+    return columns, np.array(landmarks, dtype=np.float64).reshape(-1, 68, 2)
+
+class ColumnarMetadata:
+    # Drop-in replacement for the parsed JSON dict: len(), keys() and values()
+    # yielding dict-shaped items (category, metadata.license/country, image,
+    # thumbnail, in_the_wild incl. face_landmarks) built on demand.
+
+    def __init__(self, columns, landmarks):
+        self.columns = columns
+        self.landmarks = landmarks
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def keys(self):
+        return list(self.columns['key'])
+
+    def spec(self, kind, idx):
+        spec = dict(file_url=str(self.columns[kind + '.file_url'][idx]), file_path=str(self.columns[kind + '.file_path'][idx]))
+        if self.columns[kind + '.file_size'][idx] >= 0:
+            spec['file_size'] = int(self.columns[kind + '.file_size'][idx])
+        for field in ['file_md5', 'pixel_md5']:
+            if self.columns['%s.%s' % (kind, field)][idx]:
+                spec[field] = str(self.columns['%s.%s' % (kind, field)][idx])
+        if self.columns[kind + '.pixel_width'][idx] >= 0:
+            spec['pixel_size'] = [int(self.columns[kind + '.pixel_width'][idx]), int(self.columns[kind + '.pixel_height'][idx])]
+        return spec
+
+    def item(self, idx):
+        item = dict(category=str(self.columns['category'][idx]), metadata=dict(license=str(self.columns['license'][idx]), country=str(self.columns['country'][idx])))
+        for kind in metadata_kinds:
+            item[kind] = self.spec(kind, idx)
+        item['in_the_wild']['face_landmarks'] = self.landmarks[idx]
+        return item
+
+    def specs(self, kind):
+        return [self.spec(kind, idx) for idx in range(len(self))]
+
+    def values(self):
+        return _MetadataValues(self)
+
+class _MetadataValues:
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __iter__(self):
+        return (self.metadata.item(idx) for idx in range(len(self.metadata)))
+
+def _save_metadata_cache(cache_dir, json_path, columns, landmarks):
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, 'landmarks.npy'), landmarks)
+    try:
+        import pandas as pd
+        pd.DataFrame(columns).to_parquet(os.path.join(cache_dir, 'columns.parquet'))
+    except ImportError:
+        np.savez(os.path.join(cache_dir, 'columns.npz'), **columns)
+    st = os.stat(json_path)
+    with open(os.path.join(cache_dir, 'source.json'), 'w') as f:
+        json.dump(dict(size=st.st_size, mtime_ns=st.st_mtime_ns), f) # written last: marks the cache complete
+
+def _load_metadata_cache(cache_dir, json_path):
+    try:
+        with open(os.path.join(cache_dir, 'source.json')) as f:
+            source = json.load(f)
+        st = os.stat(json_path)
+        if source != dict(size=st.st_size, mtime_ns=st.st_mtime_ns):
+            return None
+        landmarks = np.load(os.path.join(cache_dir, 'landmarks.npy'))
+        if os.path.isfile(os.path.join(cache_dir, 'columns.parquet')):
+            import pandas as pd
+            df = pd.read_parquet(os.path.join(cache_dir, 'columns.parquet'))
+            columns = {name: df[name].to_numpy() for name in df.columns}
+        else:
+            with np.load(os.path.join(cache_dir, 'columns.npz')) as npz:
+                columns = {name: npz[name] for name in npz.files}
+    except (OSError, ValueError, ImportError):
+        return None
+    return ColumnarMetadata(columns, landmarks)
+
+def load_metadata(json_path, cache_dir=None):
+    if cache_dir:
+        metadata = _load_metadata_cache(cache_dir, json_path)
+        if metadata is not None:
+            return metadata
+    print('Parsing JSON metadata%s...' % (' (streaming)' if ijson is not None else ''))
+    columns, landmarks = _columns_from_items(iter_json_items(json_path))
+    if cache_dir:
+        _save_metadata_cache(cache_dir, json_path, columns, landmarks)
+        print('Wrote metadata cache to %s' % cache_dir)
+    return ColumnarMetadata(columns, landmarks)
+
 #----------------------------------------------------------------------------
 
-def recreate_aligned_images(json_data, source_dir, dst_dir='realign1024x1024', output_size=1024, transform_size=4096, enable_padding=True, rotate_level=True, random_shift=0.0, retry_crops=False):
+align_stages = ['load', 'shrink', 'crop', 'pad', 'transform', 'save']
+
+def _align_item(item_idx, src_file, lm, dst_dir, output_size, transform_size, enable_padding, rotate_level, random_shift, retry_crops):
+    # Returns per-stage seconds, or None if no acceptable random crop was found.
+    timings = dict.fromkeys(align_stages, 0.0)
+    t0 = time.perf_counter()
+    def lap(stage):
+        nonlocal t0
+        t1 = time.perf_counter()
+        timings[stage] += t1 - t0
+        t0 = t1
+
+    # Per-item random stream, independent of worker count and processing order.
+    rng = np.random.default_rng(np.random.SeedSequence([12345, item_idx]))
+
+    # Parse landmarks.
+    # pylint: disable=unused-variable
+    lm = np.asarray(lm)
+    lm_chin          = lm[0  : 17]  # left-right
+    lm_eyebrow_left  = lm[17 : 22]  # left-right
+    lm_eyebrow_right = lm[22 : 27]  # left-right
+    lm_nose          = lm[27 : 31]  # top-down
+    lm_nostrils      = lm[31 : 36]  # top-down
+    lm_eye_left      = lm[36 : 42]  # left-clockwise
+    lm_eye_right     = lm[42 : 48]  # left-clockwise
+    lm_mouth_outer   = lm[48 : 60]  # left-clockwise
+    lm_mouth_inner   = lm[60 : 68]  # left-clockwise
+
+    # Calculate auxiliary vectors.
+    eye_left     = np.mean(lm_eye_left, axis=0)
+    eye_right    = np.mean(lm_eye_right, axis=0)
+    eye_avg      = (eye_left + eye_right) * 0.5
+    eye_to_eye   = eye_right - eye_left
+    mouth_left   = lm_mouth_outer[0]
+    mouth_right  = lm_mouth_outer[6]
+    mouth_avg    = (mouth_left + mouth_right) * 0.5
+    eye_to_mouth = mouth_avg - eye_avg
+
+    # Choose oriented crop rectangle.
+    if rotate_level:
+        x = eye_to_eye - np.flipud(eye_to_mouth) * [-1, 1]
+        x /= np.hypot(*x)
+        x *= max(np.hypot(*eye_to_eye) * 2.0, np.hypot(*eye_to_mouth) * 1.8)
+        y = np.flipud(x) * [-1, 1]
+        c0 = eye_avg + eye_to_mouth * 0.1
+    else:
+        x = np.array([1, 0], dtype=np.float64)
+        x *= max(np.hypot(*eye_to_eye) * 2.0, np.hypot(*eye_to_mouth) * 1.8)
+        y = np.flipud(x) * [-1, 1]
+        c0 = eye_avg + eye_to_mouth * 0.1
+
+    # Load in-the-wild image.
+    img = PIL.Image.open(src_file)
+    img.load()
+    lap('load')
+
+    quad = np.stack([c0 - x - y, c0 - x + y, c0 + x + y, c0 + x - y])
+    qsize = np.hypot(*x) * 2
+
+    # Keep drawing new random crop offsets until we find one that is contained in the image
+    # and does not require padding
+    if random_shift != 0:
+        for _ in range(1000):
+            # Offset the crop rectange center by a random shift proportional to image dimension
+            # and the requested standard deviation
+            c = (c0 + np.hypot(*x)*2 * random_shift * rng.normal(0, 1, c0.shape))
+            quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
+            crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
+            if not retry_crops or not (crop[0] < 0 or crop[1] < 0 or crop[2] >= img.width or crop[3] >= img.height):
+                # We're happy with this crop (either it fits within the image, or retries are disabled)
+                break
+        else:
+            # rejected N times, give up and move to next image
+            # (does not happen in practice with the FFHQ data)
+            return None
+
+    # Shrink.
+    shrink = int(np.floor(qsize / output_size * 0.5))
+    if shrink > 1:
+        rsize = (int(np.rint(float(img.size[0]) / shrink)), int(np.rint(float(img.size[1]) / shrink)))
+        img = img.resize(rsize, PIL.Image.LANCZOS)
+        quad /= shrink
+        qsize /= shrink
+    lap('shrink')
+
+    # Crop.
+    border = max(int(np.rint(qsize * 0.1)), 3)
+    crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
+    crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, img.size[0]), min(crop[3] + border, img.size[1]))
+    if crop[2] - crop[0] < img.size[0] or crop[3] - crop[1] < img.size[1]:
+        img = img.crop(crop)
+        quad -= crop[0:2]
+    lap('crop')
+
+    # Pad.
+    pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
+    pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - img.size[0] + border, 0), max(pad[3] - img.size[1] + border, 0))
+    if enable_padding and max(pad) > border - 4:
+        pad = np.maximum(pad, int(np.rint(qsize * 0.3)))
+        img = np.pad(np.float32(img), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
+        h, w, _ = img.shape
+        y, x, _ = np.ogrid[:h, :w, :1]
+        mask = np.maximum(1.0 - np.minimum(np.float32(x) / pad[0], np.float32(w-1-x) / pad[2]), 1.0 - np.minimum(np.float32(y) / pad[1], np.float32(h-1-y) / pad[3]))
+        blur = qsize * 0.02
+        img += (scipy.ndimage.gaussian_filter(img, [blur, blur, 0]) - img) * np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
+        img += (np.median(img, axis=(0,1)) - img) * np.clip(mask, 0.0, 1.0)
+        img = PIL.Image.fromarray(np.uint8(np.clip(np.rint(img), 0, 255)), 'RGB')
+        quad += pad[:2]
+    lap('pad')
+
+    # Transform.
+    img = img.transform((transform_size, transform_size), PIL.Image.QUAD, (quad + 0.5).flatten(), PIL.Image.BILINEAR)
+    if output_size < transform_size:
+        img = img.resize((output_size, output_size), PIL.Image.LANCZOS)
+    lap('transform')
+
+    # Save aligned image (atomically, so an interrupted run never leaves a partial output behind).
+    dst_file = _aligned_path(dst_dir, item_idx)
+    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+    img.save(dst_file + '.tmp', format='PNG')
+    os.replace(dst_file + '.tmp', dst_file)
+    lap('save')
+    return timings
+
+def _aligned_path(dst_dir, item_idx):
+    return os.path.join(dst_dir, '%05d' % (item_idx - item_idx % 1000), '%05d.png' % item_idx)
+
+def _align_shard(shard, align_kwargs):
+    # Aligns a shard of (item_idx, src_file, landmarks) in a worker process.
+    totals = dict.fromkeys(align_stages, 0.0)
+    done, rejected = 0, 0
+    for item_idx, src_file, lm in shard:
+        timings = _align_item(item_idx, src_file, lm, **align_kwargs)
+        if timings is None:
+            rejected += 1
+            continue
+        for stage, seconds in timings.items():
+            totals[stage] += seconds
+        done += 1
+    return done, rejected, totals
+
+def recreate_aligned_images(json_data, source_dir, dst_dir='realign1024x1024', output_size=1024, transform_size=4096, enable_padding=True, rotate_level=True, random_shift=0.0, retry_crops=False, num_processes=None, shard_size=16):
     print('Recreating aligned images...')
 
-    # Fix random seed for reproducibility
-    np.random.seed(12345)
-    # The following random numbers are unused in present implementation, but we consume them for reproducibility
-    _ = np.random.normal(0, 1, (len(json_data.values()), 2))
-
+    # Random crop offsets come from per-item seeds (SeedSequence([12345, item_idx])), so the
+    # results are reproducible regardless of the number of processes or which items are skipped.
     if dst_dir:
         os.makedirs(dst_dir, exist_ok=True)
         shutil.copyfile('LICENSE.txt', os.path.join(dst_dir, 'LICENSE.txt'))
 
+    # Collect work, skipping outputs that already exist.
+    work = []
     for item_idx, item in enumerate(json_data.values()):
-        print('\r%d / %d ... ' % (item_idx, len(json_data)), end='', flush=True)
-
-        # Parse landmarks.
-        # pylint: disable=unused-variable
-        lm = np.array(item['in_the_wild']['face_landmarks'])
-        lm_chin          = lm[0  : 17]  # left-right
-        lm_eyebrow_left  = lm[17 : 22]  # left-right
-        lm_eyebrow_right = lm[22 : 27]  # left-right
-        lm_nose          = lm[27 : 31]  # top-down
-        lm_nostrils      = lm[31 : 36]  # top-down
-        lm_eye_left      = lm[36 : 42]  # left-clockwise
-        lm_eye_right     = lm[42 : 48]  # left-clockwise
-        lm_mouth_outer   = lm[48 : 60]  # left-clockwise
-        lm_mouth_inner   = lm[60 : 68]  # left-clockwise
-
-        # Calculate auxiliary vectors.
-        eye_left     = np.mean(lm_eye_left, axis=0)
-        eye_right    = np.mean(lm_eye_right, axis=0)
-        eye_avg      = (eye_left + eye_right) * 0.5
-        eye_to_eye   = eye_right - eye_left
-        mouth_left   = lm_mouth_outer[0]
-        mouth_right  = lm_mouth_outer[6]
-        mouth_avg    = (mouth_left + mouth_right) * 0.5
-        eye_to_mouth = mouth_avg - eye_avg
-
-        # Choose oriented crop rectangle.
-        if rotate_level:
-            x = eye_to_eye - np.flipud(eye_to_mouth) * [-1, 1]
-            x /= np.hypot(*x)
-            x *= max(np.hypot(*eye_to_eye) * 2.0, np.hypot(*eye_to_mouth) * 1.8)
-            y = np.flipud(x) * [-1, 1]
-            c0 = eye_avg + eye_to_mouth * 0.1
-        else:
-            x = np.array([1, 0], dtype=np.float64)
-            x *= max(np.hypot(*eye_to_eye) * 2.0, np.hypot(*eye_to_mouth) * 1.8)
-            y = np.flipud(x) * [-1, 1]
-            c0 = eye_avg + eye_to_mouth * 0.1
-
-        # Load in-the-wild image.
+        if os.path.isfile(_aligned_path(dst_dir, item_idx)):
+            continue
         src_file = os.path.join(source_dir, item['in_the_wild']['file_path'])
         if not os.path.isfile(src_file):
             print('\nCannot find source image. Please run "--wilds" before "--align".')
             return
-        img = PIL.Image.open(src_file)
-
-        quad = np.stack([c0 - x - y, c0 - x + y, c0 + x + y, c0 + x - y])
-        qsize = np.hypot(*x) * 2
-
-        # Keep drawing new random crop offsets until we find one that is contained in the image
-        # and does not require padding
-        if random_shift != 0:
-            for _ in range(1000):
-                # Offset the crop rectange center by a random shift proportional to image dimension
-                # and the requested standard deviation
-                c = (c0 + np.hypot(*x)*2 * random_shift * np.random.normal(0, 1, c0.shape))
-                quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
-                crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-                if not retry_crops or not (crop[0] < 0 or crop[1] < 0 or crop[2] >= img.width or crop[3] >= img.height):
-                    # We're happy with this crop (either it fits within the image, or retries are disabled)
-                    break
-            else:
-                # rejected N times, give up and move to next image
-                # (does not happen in practice with the FFHQ data)
-                print('rejected image')
-                return
-
-        # Shrink.
-        shrink = int(np.floor(qsize / output_size * 0.5))
-        if shrink > 1:
-            rsize = (int(np.rint(float(img.size[0]) / shrink)), int(np.rint(float(img.size[1]) / shrink)))
-            img = img.resize(rsize, PIL.Image.ANTIALIAS)
-            quad /= shrink
-            qsize /= shrink
-
-        # Crop.
-        border = max(int(np.rint(qsize * 0.1)), 3)
-        crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-        crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, img.size[0]), min(crop[3] + border, img.size[1]))
-        if crop[2] - crop[0] < img.size[0] or crop[3] - crop[1] < img.size[1]:
-            img = img.crop(crop)
-            quad -= crop[0:2]
-
-        # Pad.
-        pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-        pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - img.size[0] + border, 0), max(pad[3] - img.size[1] + border, 0))
-        if enable_padding and max(pad) > border - 4:
-            pad = np.maximum(pad, int(np.rint(qsize * 0.3)))
-            img = np.pad(np.float32(img), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
-            h, w, _ = img.shape
-            y, x, _ = np.ogrid[:h, :w, :1]
-            mask = np.maximum(1.0 - np.minimum(np.float32(x) / pad[0], np.float32(w-1-x) / pad[2]), 1.0 - np.minimum(np.float32(y) / pad[1], np.float32(h-1-y) / pad[3]))
-            blur = qsize * 0.02
-            img += (scipy.ndimage.gaussian_filter(img, [blur, blur, 0]) - img) * np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
-            img += (np.median(img, axis=(0,1)) - img) * np.clip(mask, 0.0, 1.0)
-            img = PIL.Image.fromarray(np.uint8(np.clip(np.rint(img), 0, 255)), 'RGB')
-            quad += pad[:2]
-
-        # Transform.
-        img = img.transform((transform_size, transform_size), PIL.Image.QUAD, (quad + 0.5).flatten(), PIL.Image.BILINEAR)
-        if output_size < transform_size:
-            img = img.resize((output_size, output_size), PIL.Image.ANTIALIAS)
-
-        # Save aligned image.
-        dst_subdir = os.path.join(dst_dir, '%05d' % (item_idx - item_idx % 1000))
-        os.makedirs(dst_subdir, exist_ok=True)
-        img.save(os.path.join(dst_subdir, '%05d.png' % item_idx))
+        work.append((item_idx, src_file, item['in_the_wild']['face_landmarks']))
+    skipped = len(json_data) - len(work)
+    if skipped:
+        print('Skipping %d already aligned images.' % skipped)
+
+    # Shard by item index and align in a process pool.
+    align_kwargs = dict(dst_dir=dst_dir, output_size=output_size, transform_size=transform_size, enable_padding=enable_padding, rotate_level=rotate_level, random_shift=random_shift, retry_crops=retry_crops)
+    shards = [work[i : i + shard_size] for i in range(0, len(work), shard_size)]
+    totals = dict.fromkeys(align_stages, 0.0)
+    done, rejected = 0, 0
+    t0 = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [executor.submit(_align_shard, shard, align_kwargs) for shard in shards]
+        for future in concurrent.futures.as_completed(futures):
+            shard_done, shard_rejected, shard_totals = future.result()
+            done += shard_done
+            rejected += shard_rejected
+            for stage, seconds in shard_totals.items():
+                totals[stage] += seconds
+            elapsed = time.time() - t0
+            print('\r%d / %d ... %.1f images/s  ETA: %-7s ' % (skipped + done + rejected, len(json_data), done / max(elapsed, 1e-8),
+                format_time((len(work) - done - rejected) / max(done / max(elapsed, 1e-8), 1e-8))), end='', flush=True)
 
     # All done.
-    print('\r%d / %d ... done' % (len(json_data), len(json_data)))
+    print('\r%d / %d ... done in %s' % (len(json_data), len(json_data), format_time(time.time() - t0)))
+    if rejected:
+        print('Rejected %d images (no acceptable random crop).' % rejected)
+    if done:
+        busy = sum(totals.values())
+        print('Per-image stage time (CPU seconds, summed over processes):')
+        for stage in align_stages:
+            print('  %-10s %8.3fs  %5.1f%%' % (stage, totals[stage] / done, 100.0 * totals[stage] / max(busy, 1e-8)))
 
 #----------------------------------------------------------------------------
 
-def run(tasks, **download_kwargs):
+def run(tasks, metadata_cache, verify_only, verify_cache, **download_kwargs):
     if not os.path.isfile(json_spec['file_path']) or not os.path.isfile('LICENSE.txt'):
         print('Downloading JSON metadata...')
         download_files([json_spec, license_specs['json']], **download_kwargs)
 
-    print('Parsing JSON metadata...')
-    with open(json_spec['file_path'], 'rb') as f:
-        json_data = json.load(f, object_pairs_hook=OrderedDict)
+    if tasks == ['json']:
+        return
+    t0 = time.time()
+    json_data = load_metadata(json_spec['file_path'], cache_dir=metadata_cache or None)
+    print('Loaded metadata for %d items in %s' % (len(json_data), format_time(time.time() - t0)))
 
     if 'stats' in tasks:
         print_statistics(json_data)
 
     specs = []
     if 'images' in tasks:
-        specs += [item['image'] for item in json_data.values()] + [license_specs['images']]
+        specs += json_data.specs('image') + [license_specs['images']]
     if 'thumbs' in tasks:
-        specs += [item['thumbnail'] for item in json_data.values()] + [license_specs['thumbs']]
+        specs += json_data.specs('thumbnail') + [license_specs['thumbs']]
     if 'wilds' in tasks:
-        specs += [item['in_the_wild'] for item in json_data.values()] + [license_specs['wilds']]
+        specs += json_data.specs('in_the_wild') + [license_specs['wilds']]
     if 'tfrecords' in tasks:
         specs += tfrecords_specs + [license_specs['tfrecords']]
 
-    if len(specs):
+    if len(specs) and verify_only:
+        verify_files(specs, verify_cache, num_processes=download_kwargs['verify_processes'])
+    elif len(specs):
         print('Downloading %d files...' % len(specs))
-        np.random.shuffle(specs) # to make the workload more homogeneous
         download_files(specs, **download_kwargs)
 
     if 'align' in tasks:
-        recreate_aligned_images(json_data, source_dir=download_kwargs['source_dir'], rotate_level=not download_kwargs['no_rotation'], random_shift=download_kwargs['random_shift'], enable_padding=not download_kwargs['no_padding'], retry_crops=download_kwargs['retry_crops'])
+        recreate_aligned_images(json_data, source_dir=download_kwargs['source_dir'], rotate_level=not download_kwargs['no_rotation'], random_shift=download_kwargs['random_shift'], enable_padding=not download_kwargs['no_padding'], retry_crops=download_kwargs['retry_crops'], num_processes=download_kwargs['align_processes'])
 
 #----------------------------------------------------------------------------
 
@@ -426,12 +997,19 @@ def run_cmdline(argv):
     parser.add_argument('--status_delay',       help='time between download status prints (default: 0.2)', type=float, default=0.2, metavar='SEC')
     parser.add_argument('--timing_window',      help='samples for estimating download eta (default: 50)', type=int, default=50, metavar='LEN')
     parser.add_argument('--chunk_size',         help='chunk size for each download thread (default: 128)', type=int, default=128, metavar='KB')
+    parser.add_argument('--segment_size',       help='segment size for parallel range downloads of large files (default: 64)', type=int, default=64, metavar='MB')
+    parser.add_argument('--max_segments',       help='max parallel range requests per large file, 1 to disable (default: 8)', type=int, default=8, metavar='NUM')
     parser.add_argument('--num_attempts',       help='number of download attempts per file (default: 10)', type=int, default=10, metavar='NUM')
     parser.add_argument('--random-shift',       help='standard deviation of random crop rectangle jitter', type=float, default=0.0, metavar='SHIFT')
     parser.add_argument('--retry-crops',        help='retry random shift if crop rectangle falls outside image (up to 1000 times)', dest='retry_crops', default=False, action='store_true')
     parser.add_argument('--no-rotation',        help='keep the original orientation of images', dest='no_rotation', default=False, action='store_true')
     parser.add_argument('--no-padding',         help='do not apply blur-padding outside and near the image borders', dest='no_padding', default=False, action='store_true')
+    parser.add_argument('--align-processes',    help='number of worker processes for --align (default: CPU count)', dest='align_processes', type=int, default=None, metavar='NUM')
+    parser.add_argument('--verify-only',        help='re-check existing files of the selected tasks instead of downloading', dest='verify_only', default=False, action='store_true')
+    parser.add_argument('--verify-processes',   help='number of worker processes for pixel and --verify-only checks (default: CPU count)', dest='verify_processes', type=int, default=None, metavar='NUM')
+    parser.add_argument('--verify-cache',       help='record of files already verified (default: ffhq-dataset-v2.verified.sqlite)', dest='verify_cache', default='ffhq-dataset-v2.verified.sqlite', metavar='FILE')
     parser.add_argument('--source-dir',         help='where to find already downloaded FFHQ source data', default='', metavar='DIR')
+    parser.add_argument('--metadata-cache',     help='columnar metadata cache, empty to disable (default: ffhq-dataset-v2.cache)', dest='metadata_cache', default='ffhq-dataset-v2.cache', metavar='DIR')
 
     args = parser.parse_args()
     if not args.tasks:
@@ -1,11 +1,35 @@
 import os
+import io
+import csv
+import atexit
+import glob
+import json
+import random
 import socket
+import threading
+import uuid
+import time
+import bisect
+import hashlib
+import hmac
+import math
+import functools
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
 import qrcode
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, render_template, jsonify, request, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.sql import func
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError: # Windows: journals are not locked against other processes
+    fcntl = None
+
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 app = Flask(__name__, instance_path=os.path.join(project_root, 'instance'))
 
@@ -14,6 +38,32 @@ database_url = os.environ.get('DATABASE_URL', f'sqlite:///{os.path.join(app.inst
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['R2_BASE_URL'] = os.environ.get('R2_BASE_URL')
+# Per-stratum quotas for one survey session, in presentation order.
+# Keys are stratum prefixes following the manifest layout (gender/age/ethnicity),
+# e.g. "male=10,female=10" or "female/20-29=5,female/30-39=5,male=10".
+app.config['SURVEY_QUOTAS'] = os.environ.get('SURVEY_QUOTAS', 'male=10,female=10')
+# Coverage balancing: images with fewer ratings are handed out first until every
+# image has SURVEY_TARGET_RATINGS. Live counters are reconciled with the Label
+# table every SURVEY_RECONCILE_SECONDS; assignments without labels expire after
+# SURVEY_ASSIGNMENT_TTL seconds.
+app.config['SURVEY_TARGET_RATINGS'] = int(os.environ.get('SURVEY_TARGET_RATINGS', 5))
+app.config['SURVEY_RECONCILE_SECONDS'] = int(os.environ.get('SURVEY_RECONCILE_SECONDS', 60))
+app.config['SURVEY_ASSIGNMENT_TTL'] = int(os.environ.get('SURVEY_ASSIGNMENT_TTL', 900))
+# Optional write-behind label ingestion: accepted labels are journaled to local
+# disk and group-committed by a background writer every LABEL_FLUSH_INTERVAL_MS
+# or LABEL_FLUSH_MAX_ROWS rows, whichever comes first.
+app.config['LABEL_WRITE_BEHIND'] = os.environ.get('LABEL_WRITE_BEHIND', '0') == '1'
+app.config['LABEL_JOURNAL_DIR'] = os.environ.get('LABEL_JOURNAL_DIR', os.path.join(app.instance_path, 'label_journal'))
+app.config['LABEL_FLUSH_INTERVAL_MS'] = int(os.environ.get('LABEL_FLUSH_INTERVAL_MS', 200))
+app.config['LABEL_FLUSH_MAX_ROWS'] = int(os.environ.get('LABEL_FLUSH_MAX_ROWS', 500))
+# Optional pool of pre-generated survey sessions kept in memory by a background
+# producer (0 disables it). Participant ids are reserved in blocks, so their
+# created_at is the reservation time rather than the session start.
+app.config['SURVEY_SESSION_POOL_SIZE'] = int(os.environ.get('SURVEY_SESSION_POOL_SIZE', 0))
+app.config['SURVEY_PARTICIPANT_BLOCK'] = int(os.environ.get('SURVEY_PARTICIPANT_BLOCK', 32))
+# Optional bearer token required by the read-only /api/analytics endpoints
+# (unset: the endpoints are open like the rest of the API).
+app.config['ANALYTICS_TOKEN'] = os.environ.get('ANALYTICS_TOKEN')
 db = SQLAlchemy(app)
 
 # Define Database Models
@@ -24,6 +74,7 @@ class Participant(db.Model):
     # Add nullable fields for demographics
     age = db.Column(db.Integer, nullable=True)
     gender = db.Column(db.String(50), nullable=True)
+    demographics_at = db.Column(db.DateTime, nullable=True) # When demographics were submitted; counted in RaterGroupStats from then on
 
     def __repr__(self):
         return f'<Participant {self.id}>'
@@ -33,6 +84,8 @@ class Image(db.Model):
     filename = db.Column(db.String(120), nullable=False)
     gender = db.Column(db.String(10), nullable=False) # 'male' or 'female'
     url = db.Column(db.String(255), nullable=True) # New field to store the full R2 URL
+    variants = db.Column(db.String(255), nullable=True) # Resized derivatives, e.g. "webp=256,512,768;avif=256,512"
+    identity_cluster = db.Column(db.Integer, nullable=True, index=True) # Same-person cluster from scripts/dedup_identities.py
     labels = db.relationship('Label', backref='image', lazy=True)
 
     # Add a unique constraint for the combination of filename and gender
@@ -43,7 +96,7 @@ class Image(db.Model):
 
 class Label(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), nullable=False)
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), nullable=False, index=True)
     image_id = db.Column(db.Integer, db.ForeignKey('image.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False) # e.g., 1 to 5 for a subjective rating
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -51,12 +104,1225 @@ class Label(db.Model):
     def __repr__(self):
         return f'<Label {self.id} | P:{self.participant_id} I:{self.image_id} R:{self.rating}>'
 
+# Rating aggregates maintained on every label insert (see _update_rating_stats), so
+# the analytics endpoints never scan the Label table. Mean and variance are derived
+# from the count, sum and sum of squares.
+
+class ImageRatingStats(db.Model):
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    rating_sum_sq = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ImageRatingStats {self.image_id} n={self.rating_count}>'
+
+class StratumRatingStats(db.Model):
+    # Stratum levels of Image.filename (gender/age/ethnicity); missing levels are ''
+    gender = db.Column(db.String(50), primary_key=True)
+    age_group = db.Column(db.String(50), primary_key=True)
+    ethnicity = db.Column(db.String(50), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    rating_sum_sq = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<StratumRatingStats {self.gender}/{self.age_group}/{self.ethnicity} n={self.rating_count}>'
+
+class RaterGroupStats(db.Model):
+    # Raters who submitted demographics, by gender and age decade ('unknown' when not given)
+    gender = db.Column(db.String(50), primary_key=True)
+    age_group = db.Column(db.String(50), primary_key=True)
+    participant_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    rating_sum_sq = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<RaterGroupStats {self.gender}/{self.age_group} n={self.participant_count}>'
+
+class ManifestSync(db.Model):
+    """
+    Single-row record of the last manifest applied to the Image table, used to
+    skip or narrow the sync on the next start.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False) # SHA-256 of manifest.txt
+    r2_base_url = db.Column(db.String(255), nullable=True)
+    entries = db.Column(db.LargeBinary, nullable=False) # zlib-compressed applied manifest lines
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ManifestSync {self.digest[:12]}>'
+
+def _upgrade_schema():
+    """
+    Adds columns and indexes introduced after a table was first created.
+    db.create_all() only creates missing tables, so existing databases need
+    these ALTERs and CREATE INDEXes.
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"Added column {table.name}.{column.name}.")
+    db.session.commit()
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                print(f"Created index {index.name}.")
+
 # The path to the survey images directory (DATASET_PATH is no longer needed as images are from R2)
 
-def _populate_images_from_manifest():
+def _parse_stratum(filename):
+    """
+    Splits a manifest path (gender/age/ethnicity/file) into its stratum key.
+    Missing levels are returned as empty strings so older two-level paths
+    (gender/file) still map to a valid stratum.
+    """
+    parts = filename.split('/')[:-1]
+    parts += [''] * (3 - len(parts))
+    return tuple(parts[:3])
+
+def _parse_quotas(spec):
+    """
+    Parses a quota string like "male=10,female/20-29=5" into an ordered list of
+    (stratum prefix tuple, count) pairs.
+    """
+    quotas = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        prefix, _, count = item.partition('=')
+        prefix = tuple(part for part in prefix.strip().strip('/').split('/') if part)
+        if not prefix or not count.strip().isdigit():
+            raise ValueError(f"Invalid survey quota: {item!r}")
+        quotas.append((prefix, int(count)))
+    return quotas
+
+SRCSET_FORMAT = 'webp' # A plain <img srcset> has no type fallback, so only a format every browser decodes is used
+
+def _srcset(filename, variants):
+    """
+    Builds a srcset from the WebP derivatives of an image, following the
+    _variants/w<width>/<path>.<format> layout written by
+    scripts/generate_derivatives.py. Returns None if there are no WebP
+    variants, in which case the original image URL is used.
+    """
+    formats = dict(field.partition('=')[::2] for field in (variants or '').split(';') if field)
+    widths = formats.get(SRCSET_FORMAT)
+    if not widths:
+        return None
+    stem = os.path.splitext(filename)[0]
+    base_url = app.config['R2_BASE_URL']
+    return ', '.join(f"{base_url}/_variants/w{width}/{stem}.{SRCSET_FORMAT} {width}w" for width in widths.split(','))
+
+def _random_positions(total, rng):
+    """
+    Lazily yields the positions 0..total-1 in random order. Positions are drawn
+    by rejection while that is cheap, so taking the first k costs O(k) when k
+    is small compared to total.
+    """
+    seen = set()
+    while len(seen) < total // 2:
+        position = rng.randrange(total)
+        if position not in seen:
+            seen.add(position)
+            yield position
+    rest = [position for position in range(total) if position not in seen]
+    rng.shuffle(rest)
+    yield from rest
+
+class _IdBucket:
+    """
+    Unordered set of image ids supporting O(1) add, remove and positional
+    access, used for one coverage level of one stratum.
+    """
+
+    def __init__(self):
+        self.ids = array('l')
+        self._positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, image_id):
+        self._positions[image_id] = len(self.ids)
+        self.ids.append(image_id)
+
+    def remove(self, image_id):
+        position = self._positions.pop(image_id)
+        last = self.ids.pop()
+        if last != image_id:
+            self.ids[position] = last
+            self._positions[last] = position
+
+class StratifiedSampler:
+    """
+    In-process sampler holding image ids grouped by (gender, age, ethnicity)
+    stratum. It is built once from the Image table and rebuilt whenever the
+    manifest is synced, so drawing a session never touches the database.
+
+    Within each stratum ids are bucketed by coverage level (ratings received
+    plus recent assignments, capped at target_ratings), and draws always take
+    the least-covered bucket first so labels spread evenly across the pool.
+    """
+
+    def __init__(self, target_ratings=5, assignment_ttl=900):
+        self._lock = threading.Lock()
+        self.target_ratings = target_ratings
+        self.assignment_ttl = assignment_ttl
+        self._strata = None  # stratum tuple -> {coverage level: _IdBucket}
+        self._records = {}   # image id -> (filename, gender, url, stratum, srcset, identity cluster)
+        self._counts = {}    # image id -> live rating count
+        self._recent = deque()  # (timestamp, image ids) of pending assignments
+        self._label_counts = {} # image id -> label count at the last reconcile
+        self.reconciled_at = 0.0
+        self.manifest_digest = None
+
+    @property
+    def is_built(self):
+        return self._strata is not None
+
+    def invalidate(self):
+        with self._lock:
+            self._strata = None
+            self._records = {}
+            self._counts = {}
+
+    def _level(self, count):
+        return min(count, self.target_ratings)
+
+    def build(self, rows, label_counts=(), manifest_digest=None):
+        """
+        Builds the strata from (id, filename, gender, url, variants,
+        identity_cluster) rows and seeds the coverage counters from
+        (image_id, count) pairs.
+        """
+        self.manifest_digest = manifest_digest
+        records = {}
+        for image_id, filename, gender, url, variants, identity_cluster in rows:
+            records[image_id] = (filename, gender, url, _parse_stratum(filename), _srcset(filename, variants),
+                                 identity_cluster)
+        with self._lock:
+            self._records = records
+            self._rebuild_levels(label_counts)
+
+    def reconcile(self, label_counts):
+        """
+        Resets the live counters to the Label table counts plus assignments
+        handed out within the last assignment_ttl seconds that have not been
+        answered by a label yet.
+        """
+        with self._lock:
+            if self._strata is not None:
+                self._rebuild_levels(label_counts)
+
+    def _rebuild_levels(self, label_counts):
+        now = time.time()
+        while self._recent and self._recent[0][0] < now - self.assignment_ttl:
+            self._recent.popleft()
+        label_counts = dict(label_counts)
+        # Labels that arrived since the last reconcile answer pending assignments
+        # (oldest first), which then stop counting so a rated image is not counted twice.
+        answered = {image_id: count - self._label_counts.get(image_id, 0) for image_id, count in label_counts.items()
+                    if count > self._label_counts.get(image_id, 0)}
+        if answered:
+            recent = deque()
+            for timestamp, image_ids in self._recent:
+                pending = []
+                for image_id in image_ids:
+                    if answered.get(image_id, 0) > 0:
+                        answered[image_id] -= 1
+                    else:
+                        pending.append(image_id)
+                if pending:
+                    recent.append((timestamp, pending))
+            self._recent = recent
+        self._label_counts = label_counts
+        counts = dict.fromkeys(self._records, 0)
+        for image_id, count in label_counts.items():
+            if image_id in counts:
+                counts[image_id] = count
+        for _, image_ids in self._recent:
+            for image_id in image_ids:
+                if image_id in counts:
+                    counts[image_id] += 1
+        strata = {}
+        for image_id, count in counts.items():
+            levels = strata.setdefault(self._records[image_id][3], {})
+            levels.setdefault(self._level(count), _IdBucket()).add(image_id)
+        self._strata = strata
+        self._counts = counts
+        self.reconciled_at = now
+
+    def _matching_levels(self, prefix):
+        return [levels for stratum, levels in self._strata.items() if stratum[:len(prefix)] == prefix]
+
+    def draw(self, quotas, rng=random):
+        """
+        Draws image ids for each (prefix, count) quota without replacement,
+        least-covered first. Within a coverage level the pick is uniform over
+        the concatenated matching strata, so the cost is O(k log s) per quota
+        regardless of how many images exist. Drawn ids count as assigned.
+
+        At most one image per identity cluster is drawn per session: candidates
+        whose cluster was already drawn are rejected, which keeps the expected
+        cost O(k) while clusters are small compared to the pool.
+        """
+        drawn = []
+        chosen = set()
+        chosen_clusters = set()
+        with self._lock:
+            for prefix, count in quotas:
+                pools = self._matching_levels(prefix)
+                needed = count
+                for level in sorted({level for levels in pools for level in levels}):
+                    if needed <= 0:
+                        break
+                    buckets = [levels[level] for levels in pools if len(levels.get(level, ()))]
+                    offsets = []
+                    total = 0
+                    for bucket in buckets:
+                        offsets.append(total)
+                        total += len(bucket)
+                    for position in _random_positions(total, rng):
+                        if needed <= 0:
+                            break
+                        bucket_idx = bisect.bisect_right(offsets, position) - 1
+                        image_id = buckets[bucket_idx].ids[position - offsets[bucket_idx]]
+                        if image_id in chosen:
+                            continue
+                        identity_cluster = self._records[image_id][5]
+                        if identity_cluster is not None:
+                            if identity_cluster in chosen_clusters:
+                                continue
+                            chosen_clusters.add(identity_cluster)
+                        chosen.add(image_id)
+                        drawn.append(image_id)
+                        needed -= 1
+            self._record_assignment(drawn)
+        return drawn
+
+    def _record_assignment(self, image_ids):
+        self._recent.append((time.time(), image_ids))
+        for image_id in image_ids:
+            self._bump(image_id)
+
+    def release(self, image_ids):
+        """
+        Takes back assignments that were drawn but never handed out (e.g. a
+        pooled session discarded after a manifest change), newest first, so
+        they stop counting towards coverage.
+        """
+        remaining = Counter(image_ids)
+        released = []
+        with self._lock:
+            recent = deque()
+            for timestamp, assigned in reversed(self._recent):
+                pending = []
+                for image_id in assigned:
+                    if remaining[image_id] > 0:
+                        remaining[image_id] -= 1
+                        released.append(image_id)
+                    else:
+                        pending.append(image_id)
+                if pending:
+                    recent.appendleft((timestamp, pending))
+            self._recent = recent
+            if self._strata is not None:
+                for image_id in released:
+                    if image_id in self._counts:
+                        self._bump(image_id, -1)
+
+    def _bump(self, image_id, delta=1):
+        count = self._counts[image_id]
+        old_level, new_level = self._level(count), self._level(count + delta)
+        self._counts[image_id] = count + delta
+        if old_level != new_level:
+            levels = self._strata[self._records[image_id][3]]
+            levels[old_level].remove(image_id)
+            levels.setdefault(new_level, _IdBucket()).add(image_id)
+
+    def describe(self, image_id):
+        filename, gender, url, _, srcset, _ = self._records[image_id]
+        return {'id': image_id, 'filename': filename, 'gender': gender, 'url': url, 'srcset': srcset}
+
+image_sampler = StratifiedSampler(
+    target_ratings=app.config['SURVEY_TARGET_RATINGS'],
+    assignment_ttl=app.config['SURVEY_ASSIGNMENT_TTL'],
+)
+
+def _label_counts():
+    return db.session.query(Label.image_id, func.count(Label.id)).group_by(Label.image_id).all()
+
+def _get_sampler():
+    """
+    Returns the shared sampler, building it from the Image table on first use
+    and reconciling its coverage counters with the Label table every
+    SURVEY_RECONCILE_SECONDS instead of aggregating on every request. A new
+    manifest digest (e.g. after init_db.py ran elsewhere) triggers a rebuild.
+    """
+    if image_sampler.is_built and time.time() - image_sampler.reconciled_at > app.config['SURVEY_RECONCILE_SECONDS']:
+        digest = db.session.query(ManifestSync.digest).filter_by(id=1).scalar()
+        if digest != image_sampler.manifest_digest:
+            image_sampler.invalidate()
+            known_image_ids.invalidate()
+        else:
+            image_sampler.reconcile(_label_counts())
+    if not image_sampler.is_built:
+        rows = db.session.query(Image.id, Image.filename, Image.gender, Image.url, Image.variants,
+                                Image.identity_cluster).all()
+        # Images kept only because they have labels are no longer handed out.
+        state = db.session.get(ManifestSync, 1)
+        if state is not None:
+            active = {line.split('\t', 1)[0] for line in zlib.decompress(state.entries).decode('utf-8').splitlines()}
+            rows = [row for row in rows if row[1] in active]
+        image_sampler.build(rows, _label_counts(), manifest_digest=state.digest if state else None)
+    return image_sampler
+
+class KnownImageIds:
+    """
+    In-memory set of Image ids used to validate writes without a SELECT. It is
+    loaded on first use and invalidated by the manifest sync; ids missing from
+    the set are looked up once in the database so images added by another
+    process are picked up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = None
+
+    def invalidate(self):
+        with self._lock:
+            self._ids = None
+
+    def contains_all(self, image_ids):
+        # Works on a local snapshot, since invalidate() may reset self._ids at any time.
+        # The set is replaced rather than updated in place for the same reason.
+        with self._lock:
+            ids = self._ids
+        if ids is None:
+            ids = {image_id for (image_id,) in db.session.query(Image.id)}
+            with self._lock:
+                self._ids = ids
+        missing = set(image_ids) - ids
+        if missing:
+            found = {image_id for (image_id,) in db.session.query(Image.id).filter(Image.id.in_(missing))}
+            with self._lock:
+                if self._ids is ids:
+                    self._ids = ids | found
+            return found == missing
+        return True
+
+class RecentParticipants:
+    """
+    Bounded LRU cache of participant ids known to exist, each valid for ttl
+    seconds. Sessions register their participant on creation so the label
+    endpoints can skip the Participant lookup.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # participant id -> expiry timestamp
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def add(self, participant_id):
+        with self._lock:
+            self._entries[participant_id] = time.time() + self.ttl
+            self._entries.move_to_end(participant_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, participant_id):
+        with self._lock:
+            expires_at = self._entries.get(participant_id)
+            if expires_at is None:
+                return False
+            if expires_at < time.time():
+                del self._entries[participant_id]
+                return False
+            self._entries.move_to_end(participant_id)
+            return True
+
+known_image_ids = KnownImageIds()
+recent_participants = RecentParticipants()
+
+def _participant_exists(participant_id):
+    if participant_id in recent_participants:
+        return True
+    if db.session.get(Participant, participant_id) is None:
+        return False
+    recent_participants.add(participant_id)
+    return True
+
+RATING_MIN, RATING_MAX = 1, 5 # The survey's star scale
+
+def _valid_rating(rating):
+    return isinstance(rating, int) and not isinstance(rating, bool) and RATING_MIN <= rating <= RATING_MAX
+
+def _valid_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def _insert_labels(rows):
+    """
+    Inserts label rows (participant_id, image_id, rating and optionally
+    created_at) with one executemany and adds them to the rating
+    aggregates in the same transaction. The caller commits.
+
+    A label for an image the participant already rated is skipped, so a
+    batch the client sent twice (a retry, or a beacon racing the request it
+    repeats) is stored once. The participant rows are locked with a no-op
+    UPDATE first, which serializes concurrent submissions for them on both
+    SQLite and Postgres.
+    """
+    participants = Participant.__table__
+    participant_ids = sorted({row['participant_id'] for row in rows})
+    db.session.execute(participants.update().where(participants.c.id.in_(participant_ids))
+                       .values(created_at=participants.c.created_at))
+    seen = {tuple(key) for key in db.session.query(Label.participant_id, Label.image_id)
+            .filter(Label.participant_id.in_(participant_ids))}
+    new_rows = []
+    for row in rows:
+        key = (row['participant_id'], row['image_id'])
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+    if new_rows:
+        db.session.execute(Label.__table__.insert(), new_rows)
+        _update_rating_stats(new_rows)
+
+def _rater_group(gender, age):
+    age_group = f'{age // 10 * 10}-{age // 10 * 10 + 9}' if age is not None else 'unknown'
+    return (gender or 'unknown', age_group)
+
+def _rating_totals(keyed_ratings, key_columns):
+    """
+    Folds (key tuple, rating) pairs into one counter row per key.
+    """
+    totals = {}
+    for key, rating in keyed_ratings:
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += 1
+        total[1] += rating
+        total[2] += rating * rating
+    return [dict(zip(key_columns, key), rating_count=count, rating_sum=total, rating_sum_sq=total_sq)
+            for key, (count, total, total_sq) in totals.items()]
+
+def _increment_statement(table, dialect_name):
+    """
+    Returns an INSERT for an aggregate table that adds its counters to the
+    existing row on a primary key conflict, or None for dialects without
+    ON CONFLICT support.
+    """
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(table)
+    keys = [column.name for column in table.primary_key.columns]
+    set_ = {column.name: column + stmt.excluded[column.name] for column in table.columns if column.name not in keys}
+    return stmt.on_conflict_do_update(index_elements=keys, set_=set_)
+
+def _increment_stats(model, rows):
+    """
+    Adds counter rows (one per key) to an aggregate table.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    stmt = _increment_statement(table, db.engine.dialect.name)
+    if stmt is not None:
+        db.session.execute(stmt, rows)
+        return
+    keys = [column.name for column in table.primary_key.columns]
+    counters = [column for column in rows[0] if column not in keys]
+    update = table.update().where(*[table.c[key] == bindparam(f'key_{key}') for key in keys]).values(
+        {column: table.c[column] + bindparam(column) for column in counters})
+    for row in rows:
+        params = dict(row, **{f'key_{key}': row[key] for key in keys})
+        if db.session.execute(update, params).rowcount == 0:
+            db.session.execute(table.insert(), row)
+
+def _update_rating_stats(rows):
+    """
+    Adds label rows to ImageRatingStats, StratumRatingStats and, for raters
+    who already submitted demographics, RaterGroupStats. Labels of other
+    raters are added to their group by _record_rater_demographics.
+    """
+    ratings = [(row['image_id'], row['participant_id'], int(row['rating'])) for row in rows]
+    image_ids = {image_id for image_id, _, _ in ratings}
+    participant_ids = {participant_id for _, participant_id, _ in ratings}
+    filenames = dict(db.session.query(Image.id, Image.filename).filter(Image.id.in_(image_ids)))
+    groups = {participant_id: _rater_group(gender, age) for participant_id, gender, age in
+              db.session.query(Participant.id, Participant.gender, Participant.age)
+              .filter(Participant.id.in_(participant_ids), Participant.demographics_at.isnot(None))}
+
+    _increment_stats(ImageRatingStats, _rating_totals(
+        (((image_id,), rating) for image_id, _, rating in ratings), ('image_id',)))
+    _increment_stats(StratumRatingStats, _rating_totals(
+        ((_parse_stratum(filenames[image_id]), rating) for image_id, _, rating in ratings if image_id in filenames),
+        ('gender', 'age_group', 'ethnicity')))
+    _increment_stats(RaterGroupStats, [dict(row, participant_count=0) for row in _rating_totals(
+        ((groups[participant_id], rating) for _, participant_id, rating in ratings if participant_id in groups),
+        ('gender', 'age_group'))])
+
+def _record_rater_demographics(participant_id, old_group, new_group):
+    """
+    Moves a participant and the labels they already submitted from old_group
+    (None if they had not submitted demographics) to new_group in
+    RaterGroupStats. The caller commits.
+    """
+    if old_group == new_group:
+        return
+    count, total, total_sq = db.session.query(
+        func.count(Label.id), func.coalesce(func.sum(Label.rating), 0),
+        func.coalesce(func.sum(Label.rating * Label.rating), 0)).filter(Label.participant_id == participant_id).one()
+    rows = [dict(zip(('gender', 'age_group'), new_group), participant_count=1,
+                 rating_count=count, rating_sum=total, rating_sum_sq=total_sq)]
+    if old_group is not None:
+        rows.append(dict(zip(('gender', 'age_group'), old_group), participant_count=-1,
+                         rating_count=-count, rating_sum=-total, rating_sum_sq=-total_sq))
+    _increment_stats(RaterGroupStats, rows)
+
+def _rebuild_rating_stats():
+    """
+    Recomputes all rating aggregates from the Label table in one transaction.
+    This scans every label, so it is meant for backfilling and repairs, not
+    for serving requests.
+
+    Returns:
+        dict: Number of rows written to each aggregate table.
+    """
+    _backfill_demographics_at()
+    for model in (ImageRatingStats, StratumRatingStats, RaterGroupStats):
+        db.session.execute(model.__table__.delete())
+
+    rating_sq = Label.rating * Label.rating
+    per_image = db.session.query(Label.image_id, func.count(Label.id), func.sum(Label.rating), func.sum(rating_sq)) \
+        .group_by(Label.image_id)
+    db.session.execute(ImageRatingStats.__table__.insert().from_select(
+        ['image_id', 'rating_count', 'rating_sum', 'rating_sum_sq'], per_image.statement))
+
+    strata = {}
+    for filename, count, total, total_sq in db.session.query(
+            Image.filename, ImageRatingStats.rating_count, ImageRatingStats.rating_sum, ImageRatingStats.rating_sum_sq) \
+            .join(ImageRatingStats, ImageRatingStats.image_id == Image.id):
+        stratum = strata.setdefault(_parse_stratum(filename), [0, 0, 0])
+        stratum[0] += count
+        stratum[1] += total
+        stratum[2] += total_sq
+    _increment_stats(StratumRatingStats, [
+        dict(gender=key[0], age_group=key[1], ethnicity=key[2], rating_count=count, rating_sum=total, rating_sum_sq=total_sq)
+        for key, (count, total, total_sq) in strata.items()])
+
+    per_rater = db.session.query(
+        Participant.gender, Participant.age, func.count(Label.id),
+        func.coalesce(func.sum(Label.rating), 0), func.coalesce(func.sum(rating_sq), 0)) \
+        .outerjoin(Label, Label.participant_id == Participant.id) \
+        .filter(Participant.demographics_at.isnot(None)).group_by(Participant.id, Participant.gender, Participant.age)
+    groups = {}
+    for gender, age, count, total, total_sq in per_rater:
+        group = groups.setdefault(_rater_group(gender, age), [0, 0, 0, 0])
+        group[0] += 1
+        group[1] += count
+        group[2] += total
+        group[3] += total_sq
+    _increment_stats(RaterGroupStats, [
+        dict(gender=key[0], age_group=key[1], participant_count=participants,
+             rating_count=count, rating_sum=total, rating_sum_sq=total_sq)
+        for key, (participants, count, total, total_sq) in groups.items()])
+    db.session.commit()
+    return {'images': db.session.query(ImageRatingStats).count(), 'strata': len(strata), 'rater_groups': len(groups)}
+
+def _backfill_demographics_at():
+    """
+    Sets demographics_at for participants who submitted demographics before
+    the column existed, so they are counted in RaterGroupStats. Returns the
+    ids of the participants it updated; the caller commits.
+    """
+    participant_ids = [participant_id for participant_id, in db.session.query(Participant.id).filter(
+        Participant.demographics_at.is_(None), (Participant.gender.isnot(None)) | (Participant.age.isnot(None)))]
+    if participant_ids:
+        participants = Participant.__table__
+        db.session.execute(participants.update().where(participants.c.id.in_(participant_ids))
+                           .values(demographics_at=func.coalesce(participants.c.created_at, datetime.utcnow())))
+    return participant_ids
+
+def _backfill_rating_stats():
+    """
+    Builds the rating aggregates once for a database that has labels but
+    predates the aggregate tables, and adds participants whose demographics
+    predate demographics_at to aggregates that are already built.
+    """
+    participant_ids = _backfill_demographics_at()
+    if participant_ids and db.session.query(ImageRatingStats.image_id).first() is not None:
+        for participant_id, gender, age in db.session.query(Participant.id, Participant.gender, Participant.age) \
+                .filter(Participant.id.in_(participant_ids)):
+            _record_rater_demographics(participant_id, None, _rater_group(gender, age))
+        print(f"Added {len(participant_ids)} participants with earlier demographics to the rater group statistics.")
+    db.session.commit()
+    if db.session.query(ImageRatingStats.image_id).first() is None and db.session.query(Label.id).first() is not None:
+        result = _rebuild_rating_stats()
+        print(f"Backfilled rating statistics for {result['images']} images, {result['strata']} strata "
+              f"and {result['rater_groups']} rater groups.")
+
+class LabelJournal:
+    """
+    Append-only JSON-lines journal of labels accepted in write-behind mode.
+    Each process owns one file, locked for its lifetime, holding label records
+    with increasing sequence numbers and commit markers written once the
+    labels reached the database. The file is truncated whenever everything
+    in it has been committed. Labels the database rejects are moved to a
+    shared dead-letter.jsonl in the same directory instead of being retried.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'labels-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl')
+        self._file = open(self.path, 'ab')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def append(self, rows):
+        """
+        Durably appends rows and returns their sequence numbers.
+        """
+        with self._lock:
+            seqs = []
+            lines = []
+            for row in rows:
+                self._seq += 1
+                seqs.append(self._seq)
+                lines.append(json.dumps({'seq': self._seq, 'label': row}, default=str))
+            self._file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return seqs
+
+    def dead_letter(self, row, error):
+        """
+        Durably records a label the database rejected, with the error.
+        """
+        line = json.dumps({'label': row, 'error': str(error), 'failed_at': datetime.utcnow()}, default=str) + '\n'
+        with self._lock, open(os.path.join(self.directory, 'dead-letter.jsonl'), 'ab') as f:
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def mark_committed(self, seq):
+        with self._lock:
+            if seq == self._seq:
+                self._file.truncate(0)
+            else:
+                self._file.write((json.dumps({'commit': seq}) + '\n').encode('utf-8'))
+                self._file.flush()
+
+    def replay_orphans(self):
+        """
+        Inserts the uncommitted labels of journals left behind by processes
+        that are gone (their lock is free) and deletes those journals.
+        Replay is at-least-once: a crash between the database commit and the
+        commit marker replays that batch again. Rejected labels are
+        dead-lettered; if the database is unavailable the journal is kept
+        for the next start.
+
+        Returns:
+            int: Number of replayed labels.
+        """
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, 'labels-*.jsonl'))):
+            if path == self.path:
+                continue
+            with open(path, 'rb') as f:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue # Owned by a live process
+                committed = 0
+                records = []
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # Torn write at the end of the file
+                    if 'commit' in record:
+                        committed = max(committed, record['commit'])
+                    else:
+                        records.append(record)
+                items = [(record['seq'], record['label']) for record in records if record['seq'] > committed]
+                if items:
+                    processed, dead, error = _commit_labels(items, self.dead_letter)
+                    replayed += processed - dead
+                    if error is not None:
+                        if processed:
+                            with open(path, 'ab') as marker:
+                                marker.write((json.dumps({'commit': items[processed - 1][0]}) + '\n').encode('utf-8'))
+                        print(f"Replaying {path} failed, will retry on the next start: {error}")
+                        continue
+                os.remove(path)
+        return replayed
+
+def _label_row_from_journal(row):
+    row = dict(row)
+    if isinstance(row.get('created_at'), str):
+        row['created_at'] = datetime.fromisoformat(row['created_at'])
+    return row
+
+# Errors meaning the database could not be reached, as opposed to a rejected row
+_DATABASE_UNAVAILABLE = (OperationalError, InterfaceError)
+
+def _commit_labels(items, dead_letter):
+    """
+    Commits journaled (seq, row) items in one transaction. If a row is
+    rejected, the items are committed one at a time and each rejected row is
+    passed to dead_letter(row, error) instead of being retried, so a single
+    bad label cannot block the ones behind it. Stops at the first error that
+    means the database is unavailable.
+
+    Returns:
+        tuple: (number of leading items processed, number dead-lettered,
+                the unavailability error or None)
+    """
+    try:
+        with app.app_context():
+            _insert_labels([_label_row_from_journal(row) for _, row in items])
+            db.session.commit()
+        return len(items), 0, None
+    except _DATABASE_UNAVAILABLE as e:
+        return 0, 0, e
+    except Exception:
+        pass # Find the rejected rows below
+
+    dead = 0
+    for index, (_, row) in enumerate(items):
+        try:
+            with app.app_context():
+                _insert_labels([_label_row_from_journal(row)])
+                db.session.commit()
+        except _DATABASE_UNAVAILABLE as e:
+            return index, dead, e
+        except Exception as e:
+            print(f"Label rejected by the database, moved to the dead-letter file: {row} ({e})")
+            dead_letter(row, e)
+            dead += 1
+    return len(items), dead, None
+
+class LabelWriter:
+    """
+    Background writer for write-behind mode. Requests journal their labels and
+    return; the writer thread group-commits the queue every flush_interval
+    seconds or as soon as max_rows labels are waiting.
+    """
+
+    def __init__(self, journal, flush_interval, max_rows):
+        self.journal = journal
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._queue = deque() # (seq, row)
+        self._cond = threading.Condition()
+        self._stats = {
+            'flushes': 0, 'flushed_rows': 0, 'errors': 0, 'replayed_rows': 0, 'dead_letter_rows': 0,
+            'last_flush_ms': 0.0, 'max_flush_ms': 0.0, 'total_flush_ms': 0.0,
+        }
+
+    def start(self):
+        try:
+            self._stats['replayed_rows'] = self.journal.replay_orphans()
+        except Exception as e: # Never keep the writer from starting; the orphans stay on disk
+            print(f"Replaying orphaned label journals failed: {e}")
+        threading.Thread(target=self._run, name='label-writer', daemon=True).start()
+        atexit.register(self.drain)
+
+    def submit(self, rows):
+        with self._cond:
+            seqs = self.journal.append(rows)
+            self._queue.extend(zip(seqs, rows))
+            if len(self._queue) >= self.max_rows:
+                self._cond.notify()
+
+    def _take_batch(self):
+        with self._cond:
+            if len(self._queue) < self.max_rows:
+                self._cond.wait(self.flush_interval)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_rows))]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch and not self._flush(batch):
+                time.sleep(min(self.flush_interval * 10, 5.0)) # Back off while the database is unavailable
+
+    def _flush(self, batch):
+        start_time = time.perf_counter()
+        processed, dead, error = _commit_labels(batch, self.journal.dead_letter)
+        if processed:
+            self.journal.mark_committed(batch[processed - 1][0])
+        if error is not None:
+            print(f"Label flush of {len(batch) - processed} rows failed, will retry: {error}")
+            with self._cond:
+                self._queue.extendleft(reversed(batch[processed:]))
+                self._stats['errors'] += 1
+                self._stats['flushed_rows'] += processed - dead
+                self._stats['dead_letter_rows'] += dead
+            return False
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        with self._cond:
+            self._stats['flushes'] += 1
+            self._stats['flushed_rows'] += len(batch) - dead
+            self._stats['dead_letter_rows'] += dead
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            self._stats['total_flush_ms'] += elapsed_ms
+        return True
+
+    def drain(self):
+        """
+        Flushes whatever is queued; anything that fails stays in the journal.
+        """
+        while self._queue:
+            with self._cond:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_rows))]
+            if not self._flush(batch):
+                break
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+_label_writer = None
+_label_writer_lock = threading.Lock()
+
+def _get_label_writer():
+    """
+    Returns the process-wide LabelWriter, starting it (and replaying orphaned
+    journals) on first use so each Gunicorn worker gets its own after fork.
+    Returns None when write-behind mode is disabled.
+    """
+    global _label_writer
+    if not app.config['LABEL_WRITE_BEHIND']:
+        return None
+    with _label_writer_lock:
+        if _label_writer is None:
+            writer = LabelWriter(
+                LabelJournal(app.config['LABEL_JOURNAL_DIR']),
+                flush_interval=app.config['LABEL_FLUSH_INTERVAL_MS'] / 1000,
+                max_rows=app.config['LABEL_FLUSH_MAX_ROWS'],
+            )
+            writer.start()
+            _label_writer = writer
+    return _label_writer
+
+def _store_labels(rows):
+    """
+    Stores validated label rows, either synchronously in one transaction or,
+    in write-behind mode, by journaling them for the background writer.
+    """
+    writer = _get_label_writer()
+    if writer is None:
+        _insert_labels(rows)
+        db.session.commit()
+        return
+    created_at = datetime.utcnow()
+    writer.submit([dict(row, created_at=created_at) for row in rows])
+
+def _reserve_participant_ids(count):
+    """
+    Creates count participants with one batched INSERT ... RETURNING and
+    returns their ids.
+    """
+    participants = Participant.__table__
+    created_at = datetime.utcnow()
+    result = db.session.execute(participants.insert().returning(participants.c.id), [{'created_at': created_at}] * count)
+    participant_ids = list(result.scalars())
+    db.session.commit()
+    return participant_ids
+
+def _draw_session_images():
+    # Draw the images from the in-memory strata (male first with the default quotas)
+    sampler = _get_sampler()
+    image_ids = sampler.draw(_parse_quotas(app.config['SURVEY_QUOTAS']))
+    return sampler, [sampler.describe(image_id) for image_id in image_ids]
+
+class SessionPool:
+    """
+    Pool of ready-made survey sessions (participant id plus serialized image
+    set) refilled by a background producer, so starting a session is a pop
+    from a deque. Sessions drawn from an older manifest are discarded: their
+    images are released back to the sampler and their participant id is
+    reused for the next session.
+    """
+
+    def __init__(self, size, block_size):
+        self.size = size
+        self.block_size = block_size
+        self._sessions = deque() # (manifest digest, participant id, image ids, JSON payload)
+        self._participant_ids = deque()
+        self._wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='session-pool', daemon=True).start()
+
+    def pop(self):
+        while True:
+            try:
+                digest, participant_id, image_ids, payload = self._sessions.popleft()
+            except IndexError:
+                self._wake.set()
+                return None
+            if len(self._sessions) < self.size // 2:
+                self._wake.set()
+            if digest == image_sampler.manifest_digest:
+                return participant_id, payload
+            image_sampler.release(image_ids)
+            self._participant_ids.appendleft(participant_id)
+
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    self._fill()
+            except Exception as e:
+                print(f"Session pool refill failed: {e}")
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+
+    def _fill(self):
+        while len(self._sessions) < self.size:
+            if not self._participant_ids:
+                self._participant_ids.extend(_reserve_participant_ids(self.block_size))
+            participant_id = self._participant_ids.popleft()
+            sampler, image_data = _draw_session_images()
+            payload = json.dumps({'participant_id': participant_id, 'images': image_data})
+            self._sessions.append((sampler.manifest_digest, participant_id, [image['id'] for image in image_data], payload))
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+def _get_session_pool():
+    """
+    Returns the process-wide SessionPool, starting its producer on first use,
+    or None when SURVEY_SESSION_POOL_SIZE is 0.
+    """
+    global _session_pool
+    if app.config['SURVEY_SESSION_POOL_SIZE'] <= 0:
+        return None
+    with _session_pool_lock:
+        if _session_pool is None:
+            pool = SessionPool(app.config['SURVEY_SESSION_POOL_SIZE'], app.config['SURVEY_PARTICIPANT_BLOCK'])
+            pool.start()
+            _session_pool = pool
+    return _session_pool
+
+# Manifest fields listing resized derivatives written by scripts/generate_derivatives.py
+VARIANT_FORMATS = ('avif', 'webp')
+
+class TimingHistogram:
+    """
+    Fixed-bucket histogram of client-reported time-to-visible (ms) per image,
+    kept separately for prefetched and non-prefetched images.
+    """
+    BUCKETS_MS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def add(self, series, value_ms):
+        with self._lock:
+            stats = self._series.setdefault(series, {'count': 0, 'total_ms': 0.0, 'buckets': [0] * (len(self.BUCKETS_MS) + 1)})
+            stats['count'] += 1
+            stats['total_ms'] += value_ms
+            stats['buckets'][bisect.bisect_left(self.BUCKETS_MS, value_ms)] += 1
+
+    def _percentile(self, buckets, count, fraction):
+        # Upper bound of the bucket holding the requested rank
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.BUCKETS_MS + (None,), buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        with self._lock:
+            return {
+                series: {
+                    'count': stats['count'],
+                    'avg_ms': stats['total_ms'] / stats['count'],
+                    'p50_ms': self._percentile(stats['buckets'], stats['count'], 0.5),
+                    'p90_ms': self._percentile(stats['buckets'], stats['count'], 0.9),
+                }
+                for series, stats in self._series.items()
+            }
+
+time_to_visible = TimingHistogram()
+
+def _read_manifest_entries(manifest_path):
+    """
+    Parses manifest.txt into a list of entry dicts (filename, gender, variants,
+    identity_cluster and the normalized line), skipping blank, malformed and
+    non-image lines. Each line is a relative path optionally followed by
+    tab-separated "key=value" fields, e.g.
+    "female/20-29/asian/00002.png\twebp=256,512\tcluster=17".
+    """
+    entries = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            fields = [field.strip() for field in line.split('\t')]
+            relative_path = fields[0]
+            if not relative_path:
+                continue
+
+            # The new path is like: male/20-29/asian/14335.png
+            # The gender is the first part. The full path is unique.
+            parts = relative_path.split('/')
+            if len(parts) < 2:
+                print(f"Skipping malformed path in manifest: {relative_path}")
+                continue
+
+            gender = parts[0]
+            # Use the full relative path as the "filename" to ensure uniqueness
+            filename = relative_path
+
+            if not any(filename.endswith(ext) for ext in ['.jpg', '.jpeg', '.png']):
+                continue # Only consider image files
+
+            variants = ';'.join(field for field in fields[1:] if field.split('=', 1)[0] in VARIANT_FORMATS)
+            cluster = next((field.split('=', 1)[1] for field in fields[1:] if field.startswith('cluster=')), '')
+            entries.append({
+                'filename': filename,
+                'gender': gender,
+                'variants': variants or None,
+                'identity_cluster': int(cluster) if cluster.isdigit() else None,
+                'line': '\t'.join(field for field in fields if field),
+            })
+    return entries
+
+# Image columns whose values come from the manifest and are kept in sync with it
+MANIFEST_COLUMNS = ('url', 'variants', 'identity_cluster')
+
+def _upsert_statement(dialect_name):
+    """
+    Returns an INSERT for the Image table that updates the manifest-derived
+    columns when the row already exists on _filename_gender_uc, or a plain
+    INSERT for dialects without ON CONFLICT support.
+    """
+    table = Image.__table__
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        set_ = {column: stmt.excluded[column] for column in MANIFEST_COLUMNS}
+        return stmt.on_conflict_do_update(constraint='_filename_gender_uc', set_=set_)
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table)
+        set_ = {column: stmt.excluded[column] for column in MANIFEST_COLUMNS}
+        return stmt.on_conflict_do_update(index_elements=['filename', 'gender'], set_=set_)
+    return table.insert()
+
+def _sync_image_entries(entries, r2_base_url, batch_size=1000, only_listed=False):
+    """
+    Applies manifest entries to the Image table in bulk: the existing rows are
+    loaded with one query, diffed in memory, and inserts/updates of the
+    MANIFEST_COLUMNS are sent as batched executemany statements. With
+    only_listed, just the rows for the given filenames are loaded (used for
+    incremental syncs).
+
+    Returns:
+        dict: Counts of inserted, updated and unchanged rows.
+    """
+    columns = [getattr(Image, column) for column in MANIFEST_COLUMNS]
+    query = db.session.query(Image.id, Image.filename, Image.gender, *columns)
+    if only_listed:
+        filenames = sorted({entry['filename'] for entry in entries})
+        rows = []
+        for start in range(0, len(filenames), batch_size):
+            rows += query.filter(Image.filename.in_(filenames[start:start + batch_size])).all()
+    else:
+        rows = query
+    existing = {(row[1], row[2]): (row[0], tuple(row[3:])) for row in rows}
+
+    inserts = []
+    updates = []
+    unchanged = 0
+    seen = set()
+    for entry in entries:
+        key = (entry['filename'], entry['gender'])
+        if key in seen:
+            continue
+        seen.add(key)
+        values = {'url': f"{r2_base_url}/{entry['filename']}", 'variants': entry['variants'],
+                  'identity_cluster': entry['identity_cluster']}
+        if key not in existing:
+            inserts.append(dict(values, filename=entry['filename'], gender=entry['gender']))
+        elif existing[key][1] != tuple(values[column] for column in MANIFEST_COLUMNS): # Update if any manifest column changed
+            updates.append(dict(values, image_id=existing[key][0]))
+        else:
+            unchanged += 1
+
+    upsert = _upsert_statement(db.engine.dialect.name)
+    update = Image.__table__.update().where(Image.__table__.c.id == bindparam('image_id')).values(
+        {column: bindparam(column) for column in MANIFEST_COLUMNS})
+    for start in range(0, len(inserts), batch_size):
+        db.session.execute(upsert, inserts[start:start + batch_size])
+    for start in range(0, len(updates), batch_size):
+        db.session.execute(update, updates[start:start + batch_size])
+
+    return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': unchanged}
+
+def _remove_image_entries(filenames, batch_size=1000):
+    """
+    Deletes Image rows for paths that left the manifest. Images that already
+    have labels are kept so no collected rating loses its image.
+
+    Returns:
+        dict: Counts of removed rows and rows retained because of labels.
+    """
+    filenames = sorted(filenames)
+    removed = 0
+    for start in range(0, len(filenames), batch_size):
+        unlabeled = ~db.session.query(Label.id).filter(Label.image_id == Image.id).exists()
+        stmt = Image.__table__.delete().where(Image.filename.in_(filenames[start:start + batch_size])).where(unlabeled)
+        removed += db.session.execute(stmt).rowcount
+    return {'removed': removed, 'retained': len(filenames) - removed}
+
+def _populate_images_from_manifest(force=False):
     """
     Reads image filenames from manifest.txt, constructs R2 URLs, and populates
     the Image table in the database.
+
+    The SHA-256 of the manifest and the list of applied lines are stored in
+    ManifestSync. When neither the manifest nor R2_BASE_URL changed since the
+    last run the sync is skipped; otherwise only added, changed and removed
+    lines are applied. A full bulk sync runs on the first run or when force is set.
+
+    Args:
+        force (bool): Re-apply the whole manifest even if it looks unchanged.
+
+    Returns:
+        dict: Sync counts and elapsed seconds, or None if the manifest file is missing.
     """
     manifest_path = os.path.join(os.path.dirname(__file__), 'manifest.txt')
     r2_base_url = app.config['R2_BASE_URL']
@@ -65,38 +1331,49 @@ def _populate_images_from_manifest():
         print(f"Manifest file not found at {manifest_path}. Image table will not be populated.")
         return
 
+    start_time = time.perf_counter()
+    with open(manifest_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
     with app.app_context():
-        with open(manifest_path, 'r') as f:
-            for line in f:
-                relative_path = line.strip()
-                if not relative_path:
-                    continue
-
-                # The new path is like: male/20-29/asian/14335.png
-                # The gender is the first part. The full path is unique.
-                parts = relative_path.split('/')
-                if len(parts) < 2:
-                    print(f"Skipping malformed path in manifest: {relative_path}")
-                    continue
-                
-                gender = parts[0]
-                # Use the full relative path as the "filename" to ensure uniqueness
-                filename = relative_path
-                
-                if not any(filename.endswith(ext) for ext in ['.jpg', '.jpeg', '.png']):
-                    continue # Only consider image files
-
-                full_r2_url = f"{r2_base_url}/{filename}"
-
-                # Check if image already exists in DB based on the unique full path
-                existing_image = Image.query.filter_by(filename=filename, gender=gender).first()
-                if not existing_image:
-                    new_image = Image(filename=filename, gender=gender, url=full_r2_url)
-                    db.session.add(new_image)
-                elif existing_image.url != full_r2_url: # Update URL if it changed
-                    existing_image.url = full_r2_url
+        state = db.session.get(ManifestSync, 1)
+        same_base_url = state is not None and state.r2_base_url == r2_base_url
+        if not force and same_base_url and state.digest == digest:
+            print("Manifest unchanged since the last sync. Skipping image population.")
+            return {'skipped': True, 'seconds': time.perf_counter() - start_time}
+
+        entries = _read_manifest_entries(manifest_path)
+        current = {entry['line'] for entry in entries}
+        if not force and same_base_url:
+            previous = set(zlib.decompress(state.entries).decode('utf-8').splitlines())
+            added = [entry for entry in entries if entry['line'] not in previous]
+            result = _sync_image_entries(added, r2_base_url, only_listed=True)
+            result['unchanged'] = len(current & previous)
+            removed = {line.split('\t', 1)[0] for line in previous} - {entry['filename'] for entry in entries}
+            result.update(_remove_image_entries(removed))
+        else:
+            result = _sync_image_entries(entries, r2_base_url)
+
+        if state is None:
+            state = ManifestSync(id=1)
+            db.session.add(state)
+        state.digest = digest
+        state.r2_base_url = r2_base_url
+        state.entries = zlib.compress('\n'.join(sorted(current)).encode('utf-8'))
+        state.applied_at = datetime.utcnow()
         db.session.commit()
-    print("Image table populated/updated from manifest file.")
+
+    result['seconds'] = time.perf_counter() - start_time
+    # The strata and id cache are derived from the Image table, so rebuild them lazily.
+    image_sampler.invalidate()
+    known_image_ids.invalidate()
+    print("Image table populated/updated from manifest file "
+          f"({result['inserted']} inserted, {result['updated']} updated, "
+          f"{result.get('removed', 0)} removed, {result['unchanged']} unchanged "
+          f"in {result['seconds']:.2f}s).")
+    if result.get('retained'):
+        print(f"Kept {result['retained']} images that left the manifest because they already have labels.")
+    return result
 
 @app.route('/')
 def index():
@@ -106,28 +1383,23 @@ def index():
 def start_survey_session():
     """
     Starts a new survey session by creating a new participant and returning a random
-    sample of 20 images (10 male, 10 female) to label.
+    sample of images drawn per SURVEY_QUOTAS (by default 10 male, then 10 female).
+    Sessions come from the pre-generated pool when it is enabled and not empty.
     """
+    pool = _get_session_pool()
+    pooled = pool.pop() if pool else None
+    if pooled:
+        participant_id, payload = pooled
+        recent_participants.add(participant_id)
+        return app.response_class(payload, mimetype='application/json')
+
     # Create a new participant
     participant = Participant()
     db.session.add(participant)
     db.session.commit()
+    recent_participants.add(participant.id)
 
-    # Get 10 random male images
-    male_images = Image.query.filter_by(gender='male').order_by(func.random()).limit(10).all()
-
-    # Get 10 random female images
-    female_images = Image.query.filter_by(gender='female').order_by(func.random()).limit(10).all()
-
-    # Combine the lists, male first
-    images = male_images + female_images
-    
-    image_data = [{
-        'id': img.id,
-        'filename': img.filename,
-        'gender': img.gender,
-        'url': img.url # Include the URL in the response
-    } for img in images]
+    _, image_data = _draw_session_images()
 
     return jsonify({
         'participant_id': participant.id,
@@ -146,23 +1418,89 @@ def submit_survey_label():
 
     if not all([participant_id, image_id, rating is not None]):
         return jsonify({'error': 'Missing data'}), 400
+    if not _valid_id(participant_id) or not _valid_id(image_id):
+        return jsonify({'error': 'Invalid id'}), 400
+    if not _valid_rating(rating):
+        return jsonify({'error': f'Rating must be an integer from {RATING_MIN} to {RATING_MAX}'}), 400
 
-    # Validate participant and image
-    participant = Participant.query.get(participant_id)
-    image = Image.query.get(image_id)
-
-    if not participant:
+    # Validate participant and image against the in-memory caches
+    if not _participant_exists(participant_id):
         return jsonify({'error': 'Participant not found'}), 404
-    if not image:
+    if not known_image_ids.contains_all([image_id]):
         return jsonify({'error': 'Image not found'}), 404
     
     # Create and save the label
-    label = Label(participant_id=participant_id, image_id=image_id, rating=rating)
-    db.session.add(label)
-    db.session.commit()
+    _store_labels([{'participant_id': participant_id, 'image_id': image_id, 'rating': rating}])
+
+    return jsonify({'success': True})
+
+@app.route('/api/submit_survey_labels', methods=['POST'])
+def submit_survey_labels():
+    """
+    Submits a batch of labels by one participant in a single transaction.
+    Expects {"participant_id": ..., "labels": [{"image_id": ..., "rating": ...}, ...]}.
+    The body is parsed regardless of Content-Type so navigator.sendBeacon can post it.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    participant_id = data.get('participant_id')
+    labels = data.get('labels')
+
+    if not participant_id or not isinstance(labels, list) or not labels:
+        return jsonify({'error': 'Missing data'}), 400
+    if not _valid_id(participant_id):
+        return jsonify({'error': 'Invalid id'}), 400
+
+    # Every item is checked before anything is written, so a bad item rejects the whole batch
+    rows = []
+    for item in labels:
+        if not isinstance(item, dict) or not item.get('image_id') or item.get('rating') is None:
+            return jsonify({'error': 'Missing data'}), 400
+        if not _valid_id(item['image_id']):
+            return jsonify({'error': 'Invalid id'}), 400
+        if not _valid_rating(item['rating']):
+            return jsonify({'error': f'Rating must be an integer from {RATING_MIN} to {RATING_MAX}'}), 400
+        rows.append({'participant_id': participant_id, 'image_id': item['image_id'], 'rating': item['rating']})
+
+    # Validate the participant and every image against the in-memory caches;
+    # only unknown ids fall back to a single query each
+    if not _participant_exists(participant_id):
+        return jsonify({'error': 'Participant not found'}), 404
+    if not known_image_ids.contains_all(row['image_id'] for row in rows):
+        return jsonify({'error': 'Image not found'}), 404
+
+    # Insert all labels with one executemany and one commit
+    _store_labels(rows)
+
+    return jsonify({'success': True, 'count': len(rows)})
+
+TIMING_MAX_MS = 60000 # Longer reports (e.g. a tab left in the background) are recorded as this
+
+@app.route('/api/report_timings', methods=['POST'])
+def report_timings():
+    """
+    Receives client-measured time-to-visible per image, as
+    {"timings": [{"image_id": ..., "ms": ..., "prefetched": true|false}, ...]}.
+    Parsed regardless of Content-Type so navigator.sendBeacon can post it.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    timings = data.get('timings')
+    if not isinstance(timings, list):
+        return jsonify({'error': 'Missing data'}), 400
+
+    # JSON allows NaN and Infinity, so reports are checked before they reach the histogram
+    for item in timings:
+        if not isinstance(item, dict) or not isinstance(item.get('ms'), (int, float)) or isinstance(item['ms'], bool):
+            continue
+        value_ms = float(item['ms'])
+        if not math.isfinite(value_ms) or value_ms < 0:
+            continue
+        time_to_visible.add('prefetched' if item.get('prefetched') else 'not_prefetched', min(value_ms, TIMING_MAX_MS))
 
     return jsonify({'success': True})
 
+DEMOGRAPHICS_ATTEMPTS = 5 # Re-reads when a concurrent submission changed the participant in between
+AGE_MIN, AGE_MAX = 1, 150 # Same bounds as the age input of the form
+
 @app.route('/api/submit_demographics', methods=['POST'])
 def submit_demographics():
     """
@@ -175,27 +1513,234 @@ def submit_demographics():
 
     if not participant_id:
         return jsonify({'error': 'Missing participant_id'}), 400
+    if not _valid_id(participant_id):
+        return jsonify({'error': 'Invalid id'}), 400
+    if gender is not None and (not isinstance(gender, str) or len(gender) > Participant.gender.type.length):
+        return jsonify({'error': 'Invalid gender'}), 400
 
-    participant = Participant.query.get(participant_id)
-    if not participant:
-        return jsonify({'error': 'Participant not found'}), 404
-    
     # Update participant with provided data (it's okay if they are None/null)
+    values = {'gender': gender, 'demographics_at': datetime.utcnow()}
     if age is not None:
         try:
-            participant.age = int(age)
+            values['age'] = int(age)
         except (ValueError, TypeError):
             return jsonify({'error': 'Invalid age format'}), 400
-            
-    participant.gender = gender
-    
+        if isinstance(age, bool) or not AGE_MIN <= values['age'] <= AGE_MAX:
+            return jsonify({'error': f'Age must be from {AGE_MIN} to {AGE_MAX}'}), 400
+
+    # The previous values are read first so the rater aggregates can be moved between groups.
+    # The update only applies while they are unchanged, so of two concurrent submissions only
+    # one moves the participant; the other re-reads and moves it on from the new group.
+    participants = Participant.__table__
+    columns = (participants.c.gender, participants.c.age, participants.c.demographics_at)
+    for _ in range(DEMOGRAPHICS_ATTEMPTS):
+        previous = db.session.query(Participant.gender, Participant.age, Participant.demographics_at) \
+            .filter(Participant.id == participant_id).first()
+        if previous is None:
+            return jsonify({'error': 'Participant not found'}), 404
+        unchanged = [column.is_(None) if value is None else column == value for column, value in zip(columns, previous)]
+        if db.session.execute(participants.update().where(participants.c.id == participant_id, *unchanged)
+                              .values(**values)).rowcount:
+            break
+        db.session.rollback()
+    else:
+        return jsonify({'error': 'Demographics were updated concurrently, please retry'}), 409
+    _record_rater_demographics(
+        participant_id,
+        _rater_group(previous.gender, previous.age) if previous.demographics_at is not None else None,
+        _rater_group(gender, values.get('age', previous.age)),
+    )
     db.session.commit()
 
     return jsonify({'success': True})
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """
+    Returns runtime metrics of this worker process.
+    """
+    writer = _get_label_writer()
+    return jsonify({
+        'label_ingest': writer.metrics() if writer else {'write_behind': False},
+        'time_to_visible': time_to_visible.summary(),
+    })
+
+def _require_analytics_token(view):
+    """
+    Rejects requests without the ANALYTICS_TOKEN bearer token when one is configured.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['ANALYTICS_TOKEN']
+        if token:
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+            if not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+                return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def _rating_summary(count, total, total_sq):
+    """
+    Returns count, mean and sample variance from the aggregate counters.
+    """
+    mean = total / count if count else None
+    variance = (total_sq - total * total / count) / (count - 1) if count > 1 else None
+    return {'count': count, 'mean': mean, 'variance': variance}
+
+@app.route('/api/analytics/images', methods=['GET'])
+@_require_analytics_token
+def analytics_images():
+    """
+    Returns per-image rating count, mean and variance, ordered by image id.
+    Paginated with ?after=<last image id>&limit=<n> (clamped to 1..5000) and
+    optionally filtered with ?min_count=<n>.
+    """
+    try:
+        after = int(request.args.get('after', 0))
+        limit = max(1, min(int(request.args.get('limit', 1000)), 5000))
+        min_count = int(request.args.get('min_count', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    rows = db.session.query(ImageRatingStats.image_id, Image.filename, ImageRatingStats.rating_count,
+                            ImageRatingStats.rating_sum, ImageRatingStats.rating_sum_sq) \
+        .join(Image, Image.id == ImageRatingStats.image_id) \
+        .filter(ImageRatingStats.image_id > after, ImageRatingStats.rating_count >= max(min_count, 1)) \
+        .order_by(ImageRatingStats.image_id).limit(limit).all()
+    images = [dict(_rating_summary(count, total, total_sq), image_id=image_id, filename=filename)
+              for image_id, filename, count, total, total_sq in rows]
+    return jsonify({'images': images, 'next_after': rows[-1][0] if len(rows) == limit else None})
+
+@app.route('/api/analytics/images/<int:image_id>', methods=['GET'])
+@_require_analytics_token
+def analytics_image(image_id):
+    """
+    Returns the rating summary of one image.
+    """
+    image = db.session.get(Image, image_id)
+    if image is None:
+        return jsonify({'error': 'Image not found'}), 404
+    stats = db.session.get(ImageRatingStats, image_id)
+    summary = _rating_summary(stats.rating_count, stats.rating_sum, stats.rating_sum_sq) if stats else _rating_summary(0, 0, 0)
+    return jsonify(dict(summary, image_id=image_id, filename=image.filename))
+
+@app.route('/api/analytics/strata', methods=['GET'])
+@_require_analytics_token
+def analytics_strata():
+    """
+    Returns the rating summary of every stratum (gender/age/ethnicity of
+    Image.filename), optionally limited to a ?prefix=female/20-29, plus the
+    combined summary of the returned strata.
+    """
+    prefix = tuple(part for part in request.args.get('prefix', '').strip('/').split('/') if part)
+    strata = []
+    combined = [0, 0, 0]
+    for row in db.session.query(StratumRatingStats).order_by(
+            StratumRatingStats.gender, StratumRatingStats.age_group, StratumRatingStats.ethnicity):
+        if (row.gender, row.age_group, row.ethnicity)[:len(prefix)] != prefix:
+            continue
+        strata.append(dict(_rating_summary(row.rating_count, row.rating_sum, row.rating_sum_sq),
+                           gender=row.gender, age_group=row.age_group, ethnicity=row.ethnicity))
+        combined = [combined[0] + row.rating_count, combined[1] + row.rating_sum, combined[2] + row.rating_sum_sq]
+    return jsonify({'strata': strata, 'combined': _rating_summary(*combined)})
+
+@app.route('/api/analytics/raters', methods=['GET'])
+@_require_analytics_token
+def analytics_raters():
+    """
+    Returns the number of raters and their rating summary by rater gender and
+    age decade. Only raters who submitted demographics are counted.
+    """
+    groups = [dict(_rating_summary(row.rating_count, row.rating_sum, row.rating_sum_sq),
+                   gender=row.gender, age_group=row.age_group, participants=row.participant_count)
+              for row in db.session.query(RaterGroupStats).order_by(RaterGroupStats.gender, RaterGroupStats.age_group)
+              if row.participant_count > 0]
+    return jsonify({'groups': groups, 'participants': sum(group['participants'] for group in groups)})
+
+# Columns of the label export, one row per Label joined to its Image and Participant
+EXPORT_COLUMNS = ('label_id', 'participant_id', 'image_id', 'filename', 'image_gender', 'age_group', 'ethnicity',
+                  'rating', 'created_at', 'rater_age', 'rater_gender')
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+def _iter_label_export(stratum=None, min_ratings=0, chunk_size=5000):
+    """
+    Yields the labels as lists of at most chunk_size row dicts (EXPORT_COLUMNS),
+    in label id order. Rows are fetched with a server-side cursor, so memory
+    stays constant regardless of the size of the Label table.
+
+    Args:
+        stratum (str, optional): Stratum prefix of Image.filename, e.g. "female/20-29".
+        min_ratings (int): Only export images with at least this many ratings (from ImageRatingStats).
+        chunk_size (int): Rows fetched and yielded per chunk.
+    """
+    query = db.session.query(Label.id, Label.participant_id, Label.image_id, Image.filename, Image.gender,
+                             Label.rating, Label.created_at, Participant.age, Participant.gender) \
+        .join(Image, Image.id == Label.image_id) \
+        .join(Participant, Participant.id == Label.participant_id)
+    prefix = '/'.join(part for part in (stratum or '').strip('/').split('/') if part)
+    if prefix:
+        query = query.filter(Image.filename.startswith(prefix + '/', autoescape=True))
+    if min_ratings > 0:
+        query = query.join(ImageRatingStats, ImageRatingStats.image_id == Label.image_id) \
+            .filter(ImageRatingStats.rating_count >= min_ratings)
+    result = db.session.execute(query.order_by(Label.id).statement.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        chunk = []
+        for label_id, participant_id, image_id, filename, image_gender, rating, created_at, rater_age, rater_gender in partition:
+            _, age_group, ethnicity = _parse_stratum(filename)
+            chunk.append({
+                'label_id': label_id, 'participant_id': participant_id, 'image_id': image_id,
+                'filename': filename, 'image_gender': image_gender, 'age_group': age_group or None,
+                'ethnicity': ethnicity or None, 'rating': rating, 'created_at': created_at,
+                'rater_age': rater_age, 'rater_gender': rater_gender,
+            })
+        yield chunk
+
+def _format_export_chunk(chunk, export_format, header=False):
+    """
+    Serializes one chunk of export rows as CSV or JSON lines.
+    """
+    if export_format == 'jsonl':
+        return ''.join(json.dumps(row, default=str) + '\n' for row in chunk)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, lineterminator='\n')
+    if header:
+        writer.writeheader()
+    writer.writerows(chunk)
+    return buffer.getvalue()
+
+@app.route('/api/export/labels', methods=['GET'])
+@_require_analytics_token
+def export_labels():
+    """
+    Streams every label joined to its image and participant as
+    ?format=csv (default) or jsonl, optionally filtered by ?stratum=female/20-29
+    and ?min_ratings=<n> per image. For Parquet use export_labels.py.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format; use one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        min_ratings = int(request.args.get('min_ratings', 0))
+        chunk_size = min(max(int(request.args.get('chunk_size', 5000)), 1), 50000)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    stratum = request.args.get('stratum')
+
+    def generate():
+        if export_format == 'csv':
+            yield _format_export_chunk([], export_format, header=True)
+        for chunk in _iter_label_export(stratum, min_ratings, chunk_size):
+            yield _format_export_chunk(chunk, export_format)
+
+    return app.response_class(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format],
+                              headers={'Content-Disposition': f'attachment; filename=labels.{export_format}'})
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        _upgrade_schema()
+        _backfill_rating_stats()
         # Call the new image population function
         _populate_images_from_manifest()
 
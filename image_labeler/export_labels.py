@@ -0,0 +1,72 @@
+# export_labels.py
+import argparse
+import time
+from app import app, _iter_label_export, _format_export_chunk
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet export is optional
+    pa = None
+
+parser = argparse.ArgumentParser(description="Export the labels joined to their images and participants for model training.")
+parser.add_argument(
+    'output',
+    help="Output file (e.g., labels.parquet)."
+)
+parser.add_argument(
+    '--format',
+    choices=['parquet', 'csv', 'jsonl'],
+    default=None,
+    help="Output format (default: from the output file extension)."
+)
+parser.add_argument(
+    '--stratum',
+    default=None,
+    help="Only export images in this stratum prefix (e.g., female/20-29)."
+)
+parser.add_argument(
+    '--min_ratings',
+    type=int,
+    default=0,
+    help="Only export images with at least this many ratings (default: 0)."
+)
+parser.add_argument(
+    '--chunk_size',
+    type=int,
+    default=5000,
+    help="Rows fetched and written per chunk (default: 5000)."
+)
+args = parser.parse_args()
+
+export_format = args.format or args.output.rsplit('.', 1)[-1].lower()
+if export_format not in ('parquet', 'csv', 'jsonl'):
+    parser.error("Cannot infer the format from the output file; use --format.")
+if export_format == 'parquet' and pa is None:
+    parser.error("Parquet export requires pyarrow (pip install pyarrow).")
+
+start_time = time.perf_counter()
+row_count = 0
+with app.app_context():
+    chunks = _iter_label_export(args.stratum, args.min_ratings, args.chunk_size)
+    if export_format == 'parquet':
+        # One row group per chunk; the explicit schema keeps chunks with only nulls in a column compatible
+        schema = pa.schema([
+            ('label_id', pa.int64()), ('participant_id', pa.int64()), ('image_id', pa.int64()),
+            ('filename', pa.string()), ('image_gender', pa.string()), ('age_group', pa.string()),
+            ('ethnicity', pa.string()), ('rating', pa.int64()), ('created_at', pa.timestamp('us')),
+            ('rater_age', pa.int64()), ('rater_gender', pa.string()),
+        ])
+        with pq.ParquetWriter(args.output, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                row_count += len(chunk)
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            if export_format == 'csv':
+                f.write(_format_export_chunk([], 'csv', header=True))
+            for chunk in chunks:
+                f.write(_format_export_chunk(chunk, export_format))
+                row_count += len(chunk)
+
+print(f"Exported {row_count} labels to {args.output} in {time.perf_counter() - start_time:.1f}s.")
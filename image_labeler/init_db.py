@@ -1,15 +1,37 @@
 # init_db.py
-from app import app, db, _populate_images_from_manifest
+import argparse
+from app import app, db, _populate_images_from_manifest, _upgrade_schema, _backfill_rating_stats, _rebuild_rating_stats
+
+parser = argparse.ArgumentParser(description="Create the database tables and sync images from manifest.txt.")
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help="Re-apply the whole manifest even if it is unchanged since the last sync."
+)
+parser.add_argument(
+    '--rebuild_stats',
+    action='store_true',
+    help="Recompute the rating aggregates behind /api/analytics from the Label table."
+)
+args = parser.parse_args()
 
 print("Starting database initialization...")
 
 with app.app_context():
     print("Creating all database tables...")
     db.create_all()
+    _upgrade_schema()
     print("Database tables created.")
+
+    if args.rebuild_stats:
+        result = _rebuild_rating_stats()
+        print(f"Rebuilt rating statistics for {result['images']} images, {result['strata']} strata "
+              f"and {result['rater_groups']} rater groups.")
+    else:
+        _backfill_rating_stats()
     
     print("Populating images from manifest...")
-    _populate_images_from_manifest()
+    _populate_images_from_manifest(force=args.force)
     print("Image population complete.")
 
 print("Database initialization finished.")
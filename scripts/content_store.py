@@ -0,0 +1,236 @@
+import os
+import time
+import shutil
+import argparse
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from file_ops import list_files
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+"""
+A content-addressed image store. Each distinct image is stored once under its
+hash, and the organized trees (ffhq_sorted, age/ethnicity folders,
+UTK-FACE/filtered_dataset, ...) link to those objects. This way repeated
+reorganizations and uploads can tell that the bytes are identical.
+
+Layout:
+
+    <store>/objects/<first two hex digits>/<digest><ext>
+    <store>/hash_cache.sqlite
+
+Hashes are computed with xxhash (XXH3-128) or BLAKE3 when installed, otherwise
+with hashlib's BLAKE2b. They are computed on a thread pool and cached by
+(device, inode) together with size and mtime. Unchanged files, including every
+hard link to the same inode, are never read twice.
+
+Example (deduplicate an existing tree into the store and relink it):
+python scripts/content_store.py --store ./Data/store --relink UTK-FACE/filtered_dataset
+"""
+
+CHUNK_SIZE = 1 << 20
+
+def hash_algorithm():
+    """
+    Returns the name of the hash function in use.
+    """
+    if xxhash is not None:
+        return 'xxh3_128'
+    if blake3 is not None:
+        return 'blake3'
+    return 'blake2b'
+
+def _new_hasher():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    if blake3 is not None:
+        return blake3.blake3()
+    return hashlib.blake2b(digest_size=16)
+
+def hash_file(path):
+    hasher = _new_hasher()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class HashCache:
+    """
+    SQLite cache of file digests keyed by (device, inode) and validated by
+    size and mtime. Only used from the calling thread.
+    """
+    def __init__(self, path):
+        self.algorithm = hash_algorithm()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "algorithm TEXT, digest TEXT, PRIMARY KEY (device, inode))"
+        )
+
+    def lookup(self, stat):
+        row = self.conn.execute(
+            "SELECT digest FROM hashes WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND algorithm = ?",
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, self.algorithm)
+        ).fetchone()
+        return row[0] if row else None
+
+    def store(self, entries):
+        """
+        Records (stat, digest) pairs.
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+            [(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, self.algorithm, digest)
+             for stat, digest in entries]
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def hash_files(paths, cache, workers=8, desc="Hashing files"):
+    """
+    Returns {path: digest} for paths, reading only files whose (device, inode,
+    size, mtime) is not in the cache. Each uncached inode is hashed once.
+
+    Args:
+        paths (list): Files to hash.
+        cache (HashCache): Digest cache.
+        workers (int): Number of hashing threads.
+        desc (str): Progress bar label.
+    """
+    digests = {}
+    pending = {} # (device, inode) -> (stat, [paths])
+    for path in paths:
+        stat = os.stat(path)
+        digest = cache.lookup(stat)
+        if digest is not None:
+            digests[path] = digest
+        else:
+            pending.setdefault((stat.st_dev, stat.st_ino), (stat, []))[1].append(path)
+
+    if pending:
+        cached_count = len(digests)
+        groups = list(pending.values())
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            computed = list(tqdm(executor.map(lambda group: hash_file(group[1][0]), groups),
+                                 total=len(groups), desc=desc))
+        cache.store([(stat, digest) for (stat, _), digest in zip(groups, computed)])
+        for (_, group_paths), digest in zip(groups, computed):
+            for path in group_paths:
+                digests[path] = digest
+        num_bytes = sum(stat.st_size for stat, _ in groups)
+        print(f"Hashed {len(groups)} files ({num_bytes / (1 << 20):.1f} MB, {hash_algorithm()}) "
+              f"in {time.perf_counter() - start_time:.1f}s; {cached_count} cached.")
+    return digests
+
+class ContentStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def open_cache(self):
+        return HashCache(os.path.join(self.root, 'hash_cache.sqlite'))
+
+    def object_path(self, digest, ext):
+        return os.path.join(self.root, 'objects', digest[:2], digest + ext.lower())
+
+    def add(self, path, digest):
+        """
+        Places path into the store under digest, as a hard link when possible.
+
+        Returns:
+            tuple: (object path, True if the object was new)
+        """
+        object_path = self.object_path(digest, os.path.splitext(path)[1])
+        if os.path.exists(object_path):
+            return object_path, False
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = f"{object_path}.{os.getpid()}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path) # Different filesystem
+        os.replace(tmp_path, object_path)
+        return object_path, True
+
+    def ingest(self, paths, workers=8):
+        """
+        Hashes paths and adds every new digest to the store.
+
+        Returns:
+            tuple: ({path: object path}, {'new': count, 'duplicates': count})
+        """
+        cache = self.open_cache()
+        try:
+            digests = hash_files(paths, cache, workers=workers)
+        finally:
+            cache.close()
+        objects = {}
+        stats = {'new': 0, 'duplicates': 0}
+        for path in paths:
+            objects[path], is_new = self.add(path, digests[path])
+            stats['new' if is_new else 'duplicates'] += 1
+        return objects, stats
+
+def relink(path, object_path):
+    """
+    Replaces path with a hard link to object_path unless it already is one.
+    """
+    if os.path.samefile(path, object_path):
+        return False
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.link(object_path, tmp_path)
+    os.replace(tmp_path, path)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add image trees to the content-addressed store.")
+    parser.add_argument(
+        'directories',
+        nargs='+',
+        help="Directories whose images are added to the store (e.g., Data/FFHQ/ffhq_sorted)."
+    )
+    parser.add_argument(
+        '--store',
+        type=str,
+        required=True,
+        help="Root of the content-addressed store (e.g., Data/store)."
+    )
+    parser.add_argument(
+        '--relink',
+        action='store_true',
+        help="Replace the files in the directories with hard links to the stored objects."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of hashing threads (default: 8)."
+    )
+
+    args = parser.parse_args()
+    store = ContentStore(args.store)
+    paths = [os.path.join(directory, relative) for directory in args.directories
+             for relative in sorted(list_files(directory))]
+    objects, stats = store.ingest(paths, workers=args.workers)
+    relinked_count = sum(relink(path, objects[path]) for path in paths) if args.relink else 0
+
+    print("\n-------------------------------------------------")
+    print(f"Store: {args.store}")
+    print(f"{stats['new']} new objects, {stats['duplicates']} files already stored.")
+    if args.relink:
+        print(f"Relinked {relinked_count} files to their stored objects.")
+    print("-------------------------------------------------")
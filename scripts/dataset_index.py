@@ -0,0 +1,201 @@
+import os
+import argparse
+import sqlite3
+import pandas as pd
+from file_ops import list_files, run_file_operations
+from organize_dataset import compute_destinations, load_labels, write_manifest
+
+"""
+This script provides virtual "views" of the FFHQ dataset so that new filters
+(another age bucket, another target ethnicity, ...) do not require copying or
+moving gigabytes of PNGs.
+
+1. `build` records every image once in a compact SQLite index with its gender,
+   age_group, ethnicity, source path and file size.
+2. `view` selects rows with an SQL filter expression and, in seconds, writes a
+   manifest.txt and/or a symlink farm in the usual gender/age/ethnicity layout.
+   Image bytes are never touched; the link farm can be uploaded to R2 directly
+   (link targets are followed) and the manifest placed in image_labeler/.
+
+Example:
+python scripts/dataset_index.py build \\
+    --aging_csv "/path/to/ffhq_aging_labels.csv" \\
+    --demographics_csv "/path/to/FFHQ_Demographics.csv" \\
+    --source_dir "/path/to/images1024x1024" \\
+    --index ./Data/FFHQ/dataset_index.sqlite
+
+python scripts/dataset_index.py view \\
+    --index ./Data/FFHQ/dataset_index.sqlite \\
+    --where "age_group IN ('15-19', '20-29') AND gender = 'female'" \\
+    --target_ethnicity Asian \\
+    --manifest ./Data/FFHQ/views/young_female/manifest.txt \\
+    --link_dir ./Data/FFHQ/views/young_female
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image_id TEXT PRIMARY KEY,
+    gender TEXT NOT NULL,
+    age_group TEXT NOT NULL,
+    ethnicity TEXT,
+    source_path TEXT NOT NULL,
+    file_size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_strata ON images (gender, age_group, ethnicity);
+"""
+
+def build_index(aging_csv, demographics_csv, source_dir, index_path):
+    """
+    (Re)builds the SQLite index from the label CSVs and one listing of source_dir.
+    Images missing from source_dir are not indexed.
+    """
+    labels = load_labels(aging_csv, demographics_csv)
+    if labels is None:
+        return
+
+    labels = compute_destinations(labels)
+    print(f"Listing {source_dir}...")
+    source_files = list_files(source_dir)
+    labels = labels[labels['source_rel'].isin(source_files)]
+    source_paths = [os.path.abspath(os.path.join(source_dir, relative)) for relative in labels['source_rel']]
+    sizes = [os.stat(path).st_size for path in source_paths]
+
+    rows = list(zip(labels['image_id'], labels['gender'], labels['age_group'],
+                    labels['ethnicity'].where(labels['ethnicity'].notna(), None), source_paths, sizes))
+    with sqlite3.connect(index_path) as conn:
+        conn.executescript(SCHEMA)
+        conn.execute("DELETE FROM images")
+        conn.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    print(f"Indexed {len(rows)} images ({sum(sizes) / (1 << 30):.2f} GB) in {index_path}.")
+
+def query_view(index_path, where=None):
+    """
+    Returns the indexed images matching an SQL filter expression over the
+    columns image_id, gender, age_group, ethnicity and file_size.
+    """
+    sql = "SELECT image_id, gender, age_group, ethnicity, source_path, file_size FROM images"
+    if where:
+        sql += f" WHERE {where}"
+    with sqlite3.connect(f"file:{index_path}?mode=ro", uri=True) as conn:
+        return pd.read_sql_query(sql, conn)
+
+def materialize_view(index_path, where=None, target_ethnicity=None, manifest_path=None,
+                     link_dir=None, link_type='symlink', workers=8):
+    """
+    Writes a manifest and/or a link farm for the images selected by where.
+
+    Args:
+        index_path (str): SQLite index written by build_index.
+        where (str, optional): SQL filter expression. Defaults to all images.
+        target_ethnicity (str, optional): Ethnicity that gets its own folder; others go
+                                          to 'other'. Defaults to one folder per ethnicity.
+        manifest_path (str, optional): Where to write the view's manifest.txt.
+        link_dir (str, optional): Root of the link farm to create.
+        link_type (str): 'symlink' or 'hardlink'.
+        workers (int): Number of parallel link operations.
+    """
+    view = compute_destinations(query_view(index_path, where), target_ethnicity)
+    if view.empty:
+        print("No images match the filter.")
+        return
+    print(f"View selects {len(view)} images ({view['file_size'].sum() / (1 << 30):.2f} GB).")
+
+    if link_dir:
+        existing_links = list_files(link_dir)
+        todo = ~view['dest_rel'].isin(existing_links)
+        operations = [(source, os.path.join(link_dir, dest))
+                      for source, dest in zip(view['source_path'][todo], view['dest_rel'][todo])]
+        result = run_file_operations(operations, link_type, workers=workers, desc="Linking view")
+        print(f"Created {result['processed']} links in {link_dir} "
+              f"in {result['seconds']:.1f}s, "
+              f"{int((~todo).sum())} already present, {result['failed']} errors.")
+
+    if manifest_path:
+        write_manifest(manifest_path, view['dest_rel'])
+        print(f"Wrote {len(view)} entries to {manifest_path}.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index the FFHQ dataset and materialize filtered views without copying images.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Build the SQLite index of all images.")
+    build_parser.add_argument(
+        '--aging_csv',
+        type=str,
+        required=True,
+        help="Path to the ffhq_aging_labels.csv file."
+    )
+    build_parser.add_argument(
+        '--demographics_csv',
+        type=str,
+        required=True,
+        help="Path to the demographics CSV file (e.g., Data/FFHQ/FFHQ_Demographics.csv)."
+    )
+    build_parser.add_argument(
+        '--source_dir',
+        type=str,
+        required=True,
+        help="Directory containing the FFHQ .png images (e.g., images1024x1024)."
+    )
+    build_parser.add_argument(
+        '--index',
+        type=str,
+        required=True,
+        help="Path of the SQLite index to write (e.g., Data/FFHQ/dataset_index.sqlite)."
+    )
+
+    view_parser = subparsers.add_parser('view', help="Write a manifest and/or link farm for a filtered view.")
+    view_parser.add_argument(
+        '--index',
+        type=str,
+        required=True,
+        help="Path of the SQLite index written by 'build'."
+    )
+    view_parser.add_argument(
+        '--where',
+        type=str,
+        default=None,
+        help="SQL filter over image_id, gender, age_group, ethnicity, file_size (e.g., \"age_group = '20-29'\")."
+    )
+    view_parser.add_argument(
+        '--target_ethnicity',
+        type=str,
+        default=None,
+        help="Ethnicity that gets its own folder; others go to 'other'. Defaults to one folder per ethnicity."
+    )
+    view_parser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help="Where to write the view's manifest.txt."
+    )
+    view_parser.add_argument(
+        '--link_dir',
+        type=str,
+        default=None,
+        help="Root directory of the link farm to create."
+    )
+    view_parser.add_argument(
+        '--link_type',
+        type=str,
+        choices=['symlink', 'hardlink'],
+        default='symlink',
+        help="Type of links in the link farm (default: symlink)."
+    )
+    view_parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of parallel link operations (default: 8)."
+    )
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_index(args.aging_csv, args.demographics_csv, args.source_dir, args.index)
+    else:
+        if not args.manifest and not args.link_dir:
+            parser.error("view requires --manifest and/or --link_dir")
+        materialize_view(args.index, args.where, args.target_ethnicity, args.manifest,
+                         args.link_dir, args.link_type, args.workers)
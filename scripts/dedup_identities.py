@@ -0,0 +1,410 @@
+import os
+import csv
+import argparse
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from tqdm import tqdm
+from generate_derivatives import IMAGE_EXTENSIONS, VARIANTS_DIR
+
+"""
+This script finds near-duplicate images and images of the same person, as
+motivated in _memo/2025-12-14_duplicate_identity_memo.md, without comparing
+every pair of images.
+
+1. Every image gets a 64-bit perceptual hash (pHash or dHash), computed in
+   vectorized batches. Optionally it also gets a face embedding from a
+   pluggable CPU model, given as --embedder module:function. The function
+   receives a (batch, size, size, 3) uint8 array and returns (batch, dim)
+   floats.
+2. The features are stored as on-disk .npy arrays in --features_dir, so
+   re-runs over the same image list skip feature extraction.
+3. Candidate pairs come from an LSH index. Hashes use multi-index banding:
+   with threshold+1 bands, any two hashes within the Hamming threshold share
+   at least one band. Embeddings use random-hyperplane signatures. Only
+   candidates are verified, so the work grows near-linearly with the dataset
+   size.
+4. Verified pairs are merged with union-find, and each image's cluster id is
+   written to a CSV that organize_dataset.py (--clusters, --max_per_identity)
+   can use to cap images per identity. With --manifest, manifest.txt lines get
+   a "cluster=<id>" field so the survey never shows one person twice per session.
+
+Example:
+python scripts/dedup_identities.py \\
+    --source_dir ./Data/FFHQ/ffhq_sorted \\
+    --features_dir ./Data/FFHQ/dedup_features \\
+    --output_csv ./Data/FFHQ/identity_clusters.csv
+"""
+
+HASH_BITS = 64
+
+def _find_images(source_dir):
+    relative_paths = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = [d for d in dirs if d != VARIANTS_DIR]
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                relative_paths.append(os.path.relpath(os.path.join(root, file), source_dir).replace(os.sep, '/'))
+    return sorted(relative_paths)
+
+def _load_image(path, hash_method, embed_size):
+    """
+    Returns the downscaled grayscale array used for hashing and, if
+    embed_size is set, an RGB array for the embedder.
+    """
+    with Image.open(path) as image:
+        gray_size = (9, 8) if hash_method == 'dhash' else (32, 32)
+        gray = np.asarray(image.convert('L').resize(gray_size, Image.LANCZOS), dtype=np.float32)
+        rgb = None
+        if embed_size:
+            rgb = np.asarray(image.convert('RGB').resize((embed_size, embed_size), Image.LANCZOS), dtype=np.uint8)
+    return gray, rgb
+
+def _pack_bits(bits):
+    """
+    Packs a (batch, 64) boolean array into uint64 hashes.
+    """
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def dhash(gray):
+    """
+    Difference hash of a (batch, 8, 9) array: one bit per horizontal gradient.
+    """
+    return _pack_bits((gray[:, :, 1:] > gray[:, :, :-1]).reshape(len(gray), -1))
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] *= np.sqrt(1 / n)
+    matrix[1:] *= np.sqrt(2 / n)
+    return matrix
+
+DCT_32 = _dct_matrix(32)
+
+def phash(gray):
+    """
+    DCT hash of a (batch, 32, 32) array: the 8x8 lowest frequencies compared
+    with their median (excluding the DC term).
+    """
+    coefficients = np.einsum('kn,bnm,lm->bkl', DCT_32, gray, DCT_32)[:, :8, :8].reshape(len(gray), -1)
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(coefficients > median)
+
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.astype(np.uint64).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def load_embedder(spec):
+    """
+    Imports an embedding function given as 'module:function'.
+    """
+    module_name, function_name = spec.split(':', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+def compute_features(source_dir, relative_paths, features_dir, hash_method='phash', embedder=None,
+                     embed_size=112, batch_size=256, workers=None):
+    """
+    Computes (or reuses) perceptual hashes and optional embeddings for
+    relative_paths and stores them as .npy arrays in features_dir.
+
+    Returns:
+        tuple: (hashes as a uint64 array, embeddings as a memory-mapped array or None)
+    """
+    os.makedirs(features_dir, exist_ok=True)
+    paths_file = os.path.join(features_dir, 'paths.txt')
+    hash_file = os.path.join(features_dir, f'{hash_method}.npy')
+    embedding_file = os.path.join(features_dir, 'embeddings.npy')
+
+    cached_paths = None
+    if os.path.exists(paths_file):
+        with open(paths_file, 'r') as f:
+            cached_paths = f.read().splitlines()
+    if (cached_paths == relative_paths and os.path.exists(hash_file)
+            and (embedder is None or os.path.exists(embedding_file))):
+        print(f"Reusing features from {features_dir}.")
+        embeddings = np.load(embedding_file, mmap_mode='r') if embedder else None
+        return np.load(hash_file), embeddings
+    if cached_paths != relative_paths:
+        for name in ('phash.npy', 'dhash.npy', 'embeddings.npy', 'paths.txt'): # Stale for the new image list
+            if os.path.exists(os.path.join(features_dir, name)):
+                os.remove(os.path.join(features_dir, name))
+
+    hashes = np.lib.format.open_memmap(hash_file + '.tmp', mode='w+', dtype=np.uint64, shape=(len(relative_paths),))
+    embeddings = None
+    hash_function = dhash if hash_method == 'dhash' else phash
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for start in tqdm(range(0, len(relative_paths), batch_size), desc="Computing features"):
+            batch_paths = [os.path.join(source_dir, relative) for relative in relative_paths[start:start + batch_size]]
+            loaded = list(executor.map(_load_image, batch_paths, [hash_method] * len(batch_paths),
+                                       [embed_size if embedder else None] * len(batch_paths), chunksize=16))
+            hashes[start:start + len(loaded)] = hash_function(np.stack([gray for gray, _ in loaded]))
+            if embedder:
+                vectors = np.asarray(embedder(np.stack([rgb for _, rgb in loaded])), dtype=np.float32)
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(embedding_file + '.tmp', mode='w+', dtype=np.float32,
+                                                           shape=(len(relative_paths), vectors.shape[1]))
+                embeddings[start:start + len(loaded)] = vectors
+
+    hashes.flush()
+    os.replace(hash_file + '.tmp', hash_file)
+    if embeddings is not None:
+        embeddings.flush()
+        os.replace(embedding_file + '.tmp', embedding_file)
+        embeddings = np.load(embedding_file, mmap_mode='r')
+    with open(paths_file, 'w') as f:
+        f.write('\n'.join(relative_paths) + '\n')
+    return np.load(hash_file), embeddings
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = np.arange(size)
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root: # Path compression
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        """
+        Returns True if a and b were in different clusters.
+        """
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return False
+        self.parent[max(root_a, root_b)] = min(root_a, root_b)
+        return True
+
+def _bucket_candidates(keys, max_bucket):
+    """
+    Yields index arrays of items that share a key in one LSH table.
+    Buckets larger than max_bucket are skipped to keep the work bounded.
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(keys)]))
+    sizes = ends - starts
+    oversized = int((sizes > max_bucket).sum())
+    if oversized:
+        print(f"Warning: skipped {oversized} LSH buckets with more than {max_bucket} items.")
+    for start, end in zip(starts[(sizes > 1) & (sizes <= max_bucket)], ends[(sizes > 1) & (sizes <= max_bucket)]):
+        yield order[start:end]
+
+def _merge_verified(union_find, members, close):
+    """
+    Unions the pairs within members for which close(i_indexes, j_indexes) holds.
+
+    Returns:
+        int: Number of unions that merged two clusters.
+    """
+    i, j = np.triu_indices(len(members), k=1)
+    matched = close(members[i], members[j])
+    return sum(union_find.union(a, b) for a, b in zip(members[i][matched], members[j][matched]))
+
+def cluster_hashes(hashes, union_find, threshold=6, max_bucket=5000):
+    """
+    Merges images whose hashes differ in at most threshold bits, using
+    threshold+1 bands (pigeonhole principle) as the LSH tables.
+    """
+    bands = min(threshold + 1, HASH_BITS)
+    edges = np.linspace(0, HASH_BITS, bands + 1).astype(int)
+    merged = 0
+    for low, high in zip(edges[:-1], edges[1:]):
+        keys = (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+        for members in _bucket_candidates(keys, max_bucket):
+            merged += _merge_verified(union_find, members,
+                                      lambda a, b: popcount(hashes[a] ^ hashes[b]) <= threshold)
+    return merged
+
+def cluster_embeddings(embeddings, union_find, similarity=0.6, tables=16, bits=12, max_bucket=5000, seed=12345):
+    """
+    Merges images whose embeddings have cosine similarity of at least
+    similarity, using random-hyperplane signatures as the LSH tables.
+    """
+    rng = np.random.default_rng(seed)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normalized = np.asarray(embeddings) / np.maximum(norms, 1e-12)
+    weights = 1 << np.arange(bits, dtype=np.int64)
+    merged = 0
+    for _ in range(tables):
+        planes = rng.standard_normal((normalized.shape[1], bits)).astype(np.float32)
+        keys = ((normalized @ planes) > 0).astype(np.int64) @ weights
+        for members in _bucket_candidates(keys, max_bucket):
+            merged += _merge_verified(union_find, members,
+                                      lambda a, b: np.einsum('ij,ij->i', normalized[a], normalized[b]) >= similarity)
+    return merged
+
+def write_clusters(output_csv, relative_paths, union_find):
+    """
+    Writes filename, cluster_id and cluster_size per image. Cluster ids are
+    numbered in order of each cluster's first image.
+    """
+    roots = np.array([union_find.find(index) for index in range(len(relative_paths))])
+    _, cluster_ids, cluster_sizes = np.unique(roots, return_inverse=True, return_counts=True)
+    tmp_path = output_csv + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['filename', 'cluster_id', 'cluster_size'])
+        for relative_path, cluster_id in zip(relative_paths, cluster_ids):
+            writer.writerow([relative_path, int(cluster_id), int(cluster_sizes[cluster_id])])
+    os.replace(tmp_path, output_csv)
+    return cluster_ids, cluster_sizes
+
+def annotate_manifest(manifest_path, relative_paths, cluster_ids, cluster_sizes):
+    """
+    Rewrites manifest lines with a "cluster=<id>" field for every image that
+    shares its cluster with another image, keeping the other fields. The image
+    labeler stores it in Image.identity_cluster.
+    """
+    clusters = {relative_path: int(cluster_id) for relative_path, cluster_id in zip(relative_paths, cluster_ids)
+                if cluster_sizes[cluster_id] > 1}
+    with open(manifest_path, 'r') as f:
+        lines = [line.rstrip('\n') for line in f]
+
+    annotated = []
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = line.split('\t')
+        relative_path = fields[0].strip()
+        extra = [field for field in fields[1:] if not field.startswith('cluster=')]
+        if relative_path in clusters:
+            extra.append(f"cluster={clusters[relative_path]}")
+        annotated.append('\t'.join([relative_path] + extra))
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(annotated) + '\n')
+    os.replace(tmp_path, manifest_path)
+    return sum(relative_path in clusters for relative_path in (line.split('\t', 1)[0] for line in annotated))
+
+def find_identity_clusters(source_dir, features_dir, output_csv, hash_method='phash', hash_threshold=6,
+                           embedder_spec=None, embed_size=112, similarity=0.6, batch_size=256, workers=None,
+                           manifest_path=None):
+    """
+    Computes features for every image in source_dir, clusters near-duplicates
+    and same-identity images, and writes the cluster CSV.
+
+    Args:
+        source_dir (str): Root of the image tree.
+        features_dir (str): Directory for the on-disk feature arrays.
+        output_csv (str): Path of the cluster CSV to write.
+        hash_method (str): 'phash' or 'dhash'.
+        hash_threshold (int): Maximum Hamming distance between near-duplicate hashes.
+        embedder_spec (str, optional): 'module:function' returning face embeddings.
+        embed_size (int): Side length of the RGB images given to the embedder.
+        similarity (float): Minimum cosine similarity of same-identity embeddings.
+        batch_size (int): Images per feature batch.
+        workers (int, optional): Number of image decoding processes. Defaults to the CPU count.
+        manifest_path (str, optional): manifest.txt to annotate with cluster ids. Its paths
+                                       must be relative to source_dir.
+    """
+    relative_paths = _find_images(source_dir)
+    if not relative_paths:
+        print(f"No images found in {source_dir}")
+        return
+
+    embedder = load_embedder(embedder_spec) if embedder_spec else None
+    print(f"Found {len(relative_paths)} images. Computing {hash_method}"
+          f"{' and embeddings' if embedder else ''}...")
+    hashes, embeddings = compute_features(source_dir, relative_paths, features_dir, hash_method, embedder,
+                                          embed_size, batch_size, workers)
+
+    union_find = UnionFind(len(relative_paths))
+    hash_merges = cluster_hashes(hashes, union_find, hash_threshold)
+    embedding_merges = cluster_embeddings(embeddings, union_find, similarity) if embeddings is not None else 0
+    cluster_ids, cluster_sizes = write_clusters(output_csv, relative_paths, union_find)
+    if manifest_path:
+        annotated_count = annotate_manifest(manifest_path, relative_paths, cluster_ids, cluster_sizes)
+        print(f"Annotated {annotated_count} lines of {manifest_path} with their identity cluster.")
+
+    print("\n-------------------------------------------------")
+    print("Identity clustering complete!")
+    print(f"Clusters are saved in: {output_csv}")
+    print(f"Merged {hash_merges} near-duplicates by {hash_method}"
+          f"{f' and {embedding_merges} same-identity images by embedding' if embedder else ''}.")
+    print(f"{len(relative_paths)} images form {len(cluster_sizes)} clusters; "
+          f"{int((cluster_sizes > 1).sum())} clusters have more than one image (largest: {int(cluster_sizes.max())}).")
+    print("-------------------------------------------------")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cluster near-duplicate and same-identity images.")
+    parser.add_argument(
+        '--source_dir',
+        type=str,
+        required=True,
+        help="Root of the image tree (e.g., Data/FFHQ/ffhq_sorted)."
+    )
+    parser.add_argument(
+        '--features_dir',
+        type=str,
+        required=True,
+        help="Directory for the on-disk hash and embedding arrays (e.g., Data/FFHQ/dedup_features)."
+    )
+    parser.add_argument(
+        '--output_csv',
+        type=str,
+        required=True,
+        help="Path of the CSV with filename, cluster_id and cluster_size per image."
+    )
+    parser.add_argument(
+        '--hash',
+        type=str,
+        choices=['phash', 'dhash'],
+        default='phash',
+        help="Perceptual hash to use (default: phash)."
+    )
+    parser.add_argument(
+        '--hash_threshold',
+        type=int,
+        default=6,
+        help="Maximum Hamming distance (of 64 bits) between near-duplicates (default: 6)."
+    )
+    parser.add_argument(
+        '--embedder',
+        type=str,
+        default=None,
+        help="Optional face embedding function as 'module:function' (batch of RGB uint8 arrays -> (batch, dim) floats)."
+    )
+    parser.add_argument(
+        '--embed_size',
+        type=int,
+        default=112,
+        help="Side length of the images given to the embedder (default: 112)."
+    )
+    parser.add_argument(
+        '--similarity',
+        type=float,
+        default=0.6,
+        help="Minimum cosine similarity of embeddings of the same person (default: 0.6)."
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=256,
+        help="Number of images per feature batch (default: 256)."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help="Number of image decoding processes. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help="Path to manifest.txt (paths relative to source_dir) to annotate with cluster ids (e.g., image_labeler/manifest.txt)."
+    )
+
+    args = parser.parse_args()
+    find_identity_clusters(args.source_dir, args.features_dir, args.output_csv, args.hash, args.hash_threshold,
+                           args.embedder, args.embed_size, args.similarity, args.batch_size, args.workers,
+                           args.manifest)
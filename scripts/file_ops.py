@@ -0,0 +1,121 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+"""
+Shared helpers for the dataset scripts: a single up-front directory listing
+and a bounded thread pool that materializes (source, destination) pairs with
+copy, move or link actions while reporting throughput.
+
+Actions:
+    copy      Copy the bytes (uses sendfile/copy_file_range where available).
+    move      Rename, or copy + delete across filesystems.
+    hardlink  Add a second name for the same inode (same filesystem only).
+    reflink   Copy-on-write clone (Linux btrfs/XFS via FICLONE); no bytes copied.
+    symlink   Absolute symbolic link to the source.
+"""
+
+ACTIONS = ('copy', 'move', 'hardlink', 'reflink', 'symlink')
+
+# ioctl request number of FICLONE from <linux/fs.h>
+FICLONE = 0x40049409
+
+def _reflink(source_path, dest_path):
+    import fcntl
+    with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dest_path)
+            raise
+
+def materialize(source_path, dest_path, action):
+    """
+    Places source_path at dest_path using the given action.
+    """
+    if action == 'copy':
+        shutil.copyfile(source_path, dest_path)
+    elif action == 'move':
+        shutil.move(source_path, dest_path)
+    elif action == 'hardlink':
+        os.link(source_path, dest_path)
+    elif action == 'reflink':
+        _reflink(source_path, dest_path)
+    elif action == 'symlink':
+        os.symlink(os.path.abspath(source_path), dest_path)
+    else:
+        raise ValueError(f"Unknown action: {action}")
+
+def list_files(root):
+    """
+    Lists all files below root with one recursive scandir pass.
+
+    Returns:
+        set: Paths relative to root, using '/' as separator.
+    """
+    found = set()
+    if not os.path.isdir(root):
+        return found
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative_path)
+                else:
+                    found.add(relative_path)
+    return found
+
+def format_throughput(num_bytes, num_files, seconds):
+    seconds = max(seconds, 1e-9)
+    return f"{num_bytes / seconds / (1 << 20):.1f} MB/s, {num_files / seconds:.1f} files/s"
+
+def _process(source_path, dest_path, action):
+    size = os.stat(source_path).st_size
+    materialize(source_path, dest_path, action)
+    return size
+
+def run_file_operations(operations, action, workers=8, desc="Processing files"):
+    """
+    Materializes (source_path, dest_path) pairs on a bounded thread pool.
+    Destination directories are created once up front.
+
+    Args:
+        operations (list): (source_path, dest_path) pairs.
+        action (str): One of ACTIONS.
+        workers (int): Number of worker threads.
+        desc (str): Progress bar label.
+
+    Returns:
+        dict: processed/failed counts, destinations that failed, bytes
+              processed and elapsed seconds.
+    """
+    for dest_dir in {os.path.dirname(dest_path) for _, dest_path in operations}:
+        os.makedirs(dest_dir, exist_ok=True)
+
+    processed = 0
+    failed = []
+    num_bytes = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_process, source_path, dest_path, action): (source_path, dest_path)
+                   for source_path, dest_path in operations}
+        with tqdm(total=len(futures), desc=desc) as progress:
+            for future in as_completed(futures):
+                try:
+                    num_bytes += future.result()
+                    processed += 1
+                except Exception as e:
+                    tqdm.write(f"Error processing {futures[future][0]} with action '{action}': {e}")
+                    failed.append(futures[future][1])
+                progress.update(1)
+                if progress.n % 100 == 0 or progress.n == len(futures):
+                    progress.set_postfix_str(format_throughput(num_bytes, processed, time.perf_counter() - start_time))
+
+    return {'processed': processed, 'failed': len(failed), 'failed_destinations': failed,
+            'bytes': num_bytes, 'seconds': time.perf_counter() - start_time}
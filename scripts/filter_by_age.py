@@ -1,98 +1,95 @@
 
 import os
-import shutil
 import argparse
 import pandas as pd
-from tqdm import tqdm
+from op_journal import JournalMismatchError, default_journal_path, rollback_journaled, run_journaled
 
-def filter_ffhq_by_age(csv_path, source_dir, output_dir, age_groups, action='copy'):
+def plan_age_filter(csv_path, source_dir, output_dir, age_groups, action='copy'):
     """
-    Filters FFHQ images based on specified age groups and copies/moves them to an output directory.
-
-    Args:
-        csv_path (str): Path to the ffhq_aging_labels.csv file.
-        source_dir (str): Path to the directory containing gender-sorted FFHQ images (e.g., Data/FFHQ/ffhq_sorted).
-                          This directory should contain 'male' and 'female' subdirectories.
-        output_dir (str): Path to the base directory where age-filtered images will be saved,
-                          creating nested gender/age_group subdirectories (e.g., Data/FFHQ/ffhq_sorted).
-        age_groups (list): A list of age group strings to filter by (e.g., ['15-19', '20-29']).
-        action (str): 'copy' to copy files, 'move' to move files. Defaults to 'copy'.
+    Plans the (action, source_path, dest_path) operations for the age filter.
+    Images already in the destination or missing from the source are skipped.
     """
-    # The output_dir should be the base where gender/age subdirs will be created
-    # No need to os.makedirs(output_dir, exist_ok=True) here directly, as nested ones will be made.
-
     try:
         print(f"Reading labels from {csv_path}...")
         df = pd.read_csv(csv_path)
     except FileNotFoundError:
         print(f"Error: The file '{csv_path}' was not found.")
-        return
+        return []
 
     required_columns = {'image_number', 'gender', 'age_group'}
     if not required_columns.issubset(df.columns):
         print(f"Error: CSV file must contain the following columns: {required_columns}")
-        return
+        return []
 
     # Filter by age groups
     filtered_df = df[df['age_group'].isin(age_groups)]
     
     if filtered_df.empty:
         print(f"No images found for the specified age groups: {age_groups}")
-        return
+        return []
 
-    print(f"Found {len(filtered_df)} images matching age groups {age_groups}. Starting filtering (action: {action})...")
+    print(f"Found {len(filtered_df)} images matching age groups {age_groups}. Planning filtering (action: {action})...")
 
-    processed_count = 0
-    skipped_count = 0
-    for _, row in tqdm(filtered_df.iterrows(), total=filtered_df.shape[0], desc="Filtering images by age"):
+    operations = []
+    for _, row in filtered_df.iterrows():
         image_id = str(row['image_number']).strip().zfill(5)
-        gender_label = row['gender']
-        age_group_label = str(row['age_group']).strip() # Get the age group from the row
-        
-        source_filename = f"{image_id}.png"
-        
-        # Determine the source gender subdirectory
-        gender_subdir = ''
-        if gender_label == 'male':
-            gender_subdir = 'male'
-        elif gender_label == 'female':
-            gender_subdir = 'female'
-        else:
-            skipped_count += 1
+        gender_subdir = row['gender']
+        if gender_subdir not in ('male', 'female'):
             continue # Skip if gender label is not 'male' or 'female'
+        age_group_label = str(row['age_group']).strip() # Get the age group from the row
 
-        # Construct the full destination path with nested gender/age_group subdirectories
-        age_group_dest_dir = os.path.join(output_dir, gender_subdir, age_group_label)
-        os.makedirs(age_group_dest_dir, exist_ok=True) # Ensure this new age group dir exists
-
+        source_filename = f"{image_id}.png"
         source_path = os.path.join(source_dir, gender_subdir, source_filename)
-        dest_path = os.path.join(age_group_dest_dir, source_filename)
+        dest_path = os.path.join(output_dir, gender_subdir, age_group_label, source_filename)
 
-        # Skip if the destination file already exists
-        if os.path.exists(dest_path):
-            skipped_count += 1
+        # Skip if the destination file already exists or the source is missing
+        if os.path.exists(dest_path) or not os.path.exists(source_path):
             continue
+        operations.append((action, source_path, dest_path))
+    return operations
 
-        if not os.path.exists(source_path):
-            skipped_count += 1
-            continue
+def filter_ffhq_by_age(csv_path, source_dir, output_dir, age_groups, action='copy', journal_path=None, restart=False):
+    """
+    Filters FFHQ images based on specified age groups and copies/moves them to an output directory.
 
-        try:
-            if action == 'copy':
-                shutil.copyfile(source_path, dest_path)
-            elif action == 'move':
-                shutil.move(source_path, dest_path)
-            processed_count += 1
-        except Exception as e:
-            print(f"Error processing {source_path}: {e}")
-            skipped_count += 1
+    Every planned operation is recorded in a journal before any file is touched,
+    and completion markers are appended as the run progresses. If a previous run
+    was interrupted, its remaining operations are resumed instead of re-planning,
+    provided it was started with the same arguments.
+
+    Args:
+        csv_path (str): Path to the ffhq_aging_labels.csv file.
+        source_dir (str): Path to the directory containing gender-sorted FFHQ images (e.g., Data/FFHQ/ffhq_sorted).
+                          This directory should contain 'male' and 'female' subdirectories.
+        output_dir (str): Path to the base directory where age-filtered images will be saved,
+                          creating nested gender/age_group subdirectories (e.g., Data/FFHQ/ffhq_sorted).
+        age_groups (list): A list of age group strings to filter by (e.g., ['15-19', '20-29']).
+        action (str): 'copy' to copy files, 'move' to move files. Defaults to 'copy'.
+        journal_path (str, optional): Journal file. Defaults to '<output_dir>.filter_by_age.journal'.
+        restart (bool): Abandon an unfinished run in the journal instead of resuming it.
+    """
+    journal_path = journal_path or default_journal_path(output_dir, 'filter_by_age')
+    params = {'csv_path': os.path.abspath(csv_path), 'source_dir': os.path.abspath(source_dir),
+              'output_dir': os.path.abspath(output_dir), 'age_groups': list(age_groups), 'action': action}
+    try:
+        result = run_journaled(journal_path,
+                               lambda: plan_age_filter(csv_path, source_dir, output_dir, age_groups, action),
+                               desc="Filtering images by age", params=params, restart=restart)
+    except JournalMismatchError as e:
+        print(f"Error: {e}")
+        return
+    if result is None:
+        print("Nothing to do: all matching images are already in place.")
+        return
+    _, processed_count, errors = result
 
     print("\n-------------------------------------------------")
     print("Age-based filtering complete!")
     print(f"Filtered images are saved in: {output_dir}")
     print(f"Successfully processed {processed_count} images.")
-    if skipped_count > 0:
-        print(f"Skipped {skipped_count} images due to errors, not found, or already existing in destination.")
+    if errors:
+        print(f"Failed to process {len(errors)} images; run the script again to retry them.")
+    print(f"Journal: {journal_path} (use --rollback to undo this run)")
     print("-------------------------------------------------")
 
 
@@ -129,10 +126,30 @@ if __name__ == '__main__':
         default='copy',
         help="Action to perform on files: 'copy' (default) or 'move'. Use 'move' with caution."
     )
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=None,
+        help="Path of the operation journal. Defaults to '<output_dir>.filter_by_age.journal'."
+    )
+    parser.add_argument(
+        '--rollback',
+        action='store_true',
+        help="Undo the run recorded in the journal instead of filtering."
+    )
+    parser.add_argument(
+        '--restart',
+        action='store_true',
+        help="Abandon an unfinished run in the journal (e.g. one with failing operations) and plan a new one."
+    )
 
     args = parser.parse_args()
     
     # Split the comma-separated string into a list of age groups
     age_groups_list = [ag.strip() for ag in args.age_groups.split(',')]
     
-    filter_ffhq_by_age(args.csv_path, args.source_dir, args.output_dir, age_groups_list, args.action)
+    if args.rollback:
+        rollback_journaled(args.journal or default_journal_path(args.output_dir, 'filter_by_age'))
+    else:
+        filter_ffhq_by_age(args.csv_path, args.source_dir, args.output_dir, age_groups_list, args.action, args.journal,
+                           args.restart)
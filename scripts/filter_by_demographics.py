@@ -1,23 +1,20 @@
 
 import os
-import shutil
+import filecmp
 import argparse
 import pandas as pd
-from tqdm import tqdm
+from op_journal import JournalMismatchError, default_journal_path, rollback_journaled, run_journaled
 
-def reorganize_by_ethnicity(csv_path, source_dir, target_ethnicity, action='move'):
+def plan_ethnicity_reorganization(csv_path, source_dir, target_ethnicity, action='move'):
     """
-    Reorganizes images within the source directory into subdirectories based on ethnicity.
+    Plans the (action, source_path, dest_path) operations for the reorganization.
 
-    For each {gender}/{age_group} folder, it creates subdirectories for the
-    target ethnicity (e.g., 'asian') and 'other', then moves the images
-    from the parent folder into the appropriate new subdirectory.
+    If the destination already exists, the source is only scheduled for
+    deletion (a 'dedupe' operation, which --rollback restores) when moving and
+    the two files are byte-identical; otherwise both are left untouched.
 
-    Args:
-        csv_path (str): Path to the FFHQ_Demographics.csv file.
-        source_dir (str): Path to the directory containing images to be reorganized.
-        target_ethnicity (str): The primary ethnicity to create a folder for (e.g., 'Asian').
-        action (str): 'copy' or 'move'. Defaults to 'move' for reorganization.
+    Returns:
+        tuple: (operations, number of conflicting destinations)
     """
     try:
         print(f"Reading demographics from {csv_path}...")
@@ -26,10 +23,10 @@ def reorganize_by_ethnicity(csv_path, source_dir, target_ethnicity, action='move
         ethnicity_map = df.set_index('File')['Ethnic'].to_dict()
     except FileNotFoundError:
         print(f"Error: The file '{csv_path}' was not found.")
-        return
+        return [], 0
     except KeyError:
         print(f"Error: CSV file must contain 'File' and 'Ethnic' columns.")
-        return
+        return [], 0
 
     print(f"Reorganizing directory '{source_dir}' for ethnicity '{target_ethnicity}' (action: {action})...")
 
@@ -48,11 +45,11 @@ def reorganize_by_ethnicity(csv_path, source_dir, target_ethnicity, action='move
 
     if not image_paths_to_process:
         print(f"No images found to reorganize in the source directory: {source_dir}")
-        return
+        return [], 0
 
-    processed_count = 0
-    skipped_count = 0
-    for image_path in tqdm(image_paths_to_process, desc="Reorganizing by ethnicity"):
+    operations = []
+    conflict_count = 0
+    for image_path in image_paths_to_process:
         filename = os.path.basename(image_path)
         
         image_ethnicity = ethnicity_map.get(filename)
@@ -61,37 +58,73 @@ def reorganize_by_ethnicity(csv_path, source_dir, target_ethnicity, action='move
         if image_ethnicity and image_ethnicity.lower() == target_ethnicity.lower():
             dest_subdir_name = target_ethnicity.lower()
             
-        parent_dir = os.path.dirname(image_path)
-        dest_dir = os.path.join(parent_dir, dest_subdir_name)
-        os.makedirs(dest_dir, exist_ok=True)
-        dest_path = os.path.join(dest_dir, filename)
+        dest_path = os.path.join(os.path.dirname(image_path), dest_subdir_name, filename)
 
         if image_path == dest_path: # Should not happen, but a safeguard
             continue
 
         if os.path.exists(dest_path):
-            skipped_count += 1
-            # If destination exists, we might want to remove the source if action is 'move'
-            if action == 'move' and os.path.exists(image_path):
-                os.remove(image_path)
+            # Only drop the source if it is an exact duplicate of the destination
+            if action == 'move' and filecmp.cmp(image_path, dest_path, shallow=False):
+                operations.append(('dedupe', image_path, dest_path))
+            else:
+                conflict_count += 1
             continue
 
-        try:
-            if action == 'copy':
-                shutil.copyfile(image_path, dest_path)
-            elif action == 'move':
-                shutil.move(image_path, dest_path)
-            processed_count += 1
-        except Exception as e:
-            print(f"Error processing {image_path}: {e}")
-            skipped_count += 1
+        operations.append((action, image_path, dest_path))
+    return operations, conflict_count
+
+def reorganize_by_ethnicity(csv_path, source_dir, target_ethnicity, action='move', journal_path=None, restart=False):
+    """
+    Reorganizes images within the source directory into subdirectories based on ethnicity.
+
+    For each {gender}/{age_group} folder, it creates subdirectories for the
+    target ethnicity (e.g., 'asian') and 'other', then moves the images
+    from the parent folder into the appropriate new subdirectory.
+
+    The planned operations are journaled before any file is touched, so an
+    interrupted run is resumed by running the script again with the same
+    arguments and a finished run can be undone with --rollback.
+
+    Args:
+        csv_path (str): Path to the FFHQ_Demographics.csv file.
+        source_dir (str): Path to the directory containing images to be reorganized.
+        target_ethnicity (str): The primary ethnicity to create a folder for (e.g., 'Asian').
+        action (str): 'copy' or 'move'. Defaults to 'move' for reorganization.
+        journal_path (str, optional): Journal file. Defaults to '<source_dir>.filter_by_demographics.journal'.
+        restart (bool): Abandon an unfinished run in the journal instead of resuming it.
+    """
+    journal_path = journal_path or default_journal_path(source_dir, 'filter_by_demographics')
+    conflicts = []
+    def plan():
+        operations, conflict_count = plan_ethnicity_reorganization(csv_path, source_dir, target_ethnicity, action)
+        conflicts.append(conflict_count)
+        return operations
+    params = {'csv_path': os.path.abspath(csv_path), 'source_dir': os.path.abspath(source_dir),
+              'target_ethnicity': target_ethnicity, 'action': action}
+    try:
+        result = run_journaled(journal_path, plan, desc="Reorganizing by ethnicity", params=params, restart=restart)
+    except JournalMismatchError as e:
+        print(f"Error: {e}")
+        return
+    if result is None:
+        print("Nothing to do: all images are already reorganized.")
+        if conflicts and conflicts[0]:
+            print(f"Left {conflicts[0]} images in place whose destination exists with different content.")
+        return
+    journal, processed_count, errors = result
+    counts = journal.counts()
 
     print("\n-------------------------------------------------")
     print("Demographic reorganization complete!")
     print(f"Reorganized images within: {source_dir}")
-    print(f"Successfully {action}ed {processed_count} images.")
-    if skipped_count > 0:
-        print(f"Skipped {skipped_count} images (e.g., not in CSV, or already reorganized).")
+    print(f"Successfully processed {processed_count} of {len(journal.operations)} operations "
+          f"({counts[action]} {action}, {counts['dedupe']} duplicate sources removed).")
+    if conflicts and conflicts[0]:
+        print(f"Left {conflicts[0]} images in place whose destination exists with different content.")
+    if errors:
+        print(f"Failed to process {len(errors)} images; run the script again to retry them.")
+    print(f"Journal: {journal_path} (use --rollback to undo this run)")
     print("-------------------------------------------------")
 
 
@@ -122,7 +155,27 @@ if __name__ == '__main__':
         default='move',
         help="Action to perform on files: 'move' (default) or 'copy'."
     )
+    parser.add_argument(
+        '--journal',
+        type=str,
+        default=None,
+        help="Path of the operation journal. Defaults to '<source_dir>.filter_by_demographics.journal'."
+    )
+    parser.add_argument(
+        '--rollback',
+        action='store_true',
+        help="Undo the run recorded in the journal instead of reorganizing."
+    )
+    parser.add_argument(
+        '--restart',
+        action='store_true',
+        help="Abandon an unfinished run in the journal (e.g. one with failing operations) and plan a new one."
+    )
 
     args = parser.parse_args()
     
-    reorganize_by_ethnicity(args.csv_path, args.source_dir, args.target_ethnicity, args.action)
+    if args.rollback:
+        rollback_journaled(args.journal or default_journal_path(args.source_dir, 'filter_by_demographics'))
+    else:
+        reorganize_by_ethnicity(args.csv_path, args.source_dir, args.target_ethnicity, args.action, args.journal,
+                                args.restart)
@@ -0,0 +1,234 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, features
+from tqdm import tqdm
+
+"""
+This script generates resized WebP/AVIF derivatives of the sorted survey images
+so that phones only download the size they actually display.
+
+For every image in the sorted tree (gender/age/ethnicity/file), one file per
+width and format is written to:
+
+    <output_dir>/_variants/w<width>/<gender>/<age>/<ethnicity>/<name>.<format>
+
+Outputs that are newer than their source are skipped, so re-running the script
+only processes new or changed images. With --manifest, each manifest line is
+annotated with the variants that exist, e.g.
+
+    female/20-29/asian/00002.png	webp=256,512,768
+
+which the image labeler stores in Image.variants and turns into a srcset.
+
+Example:
+python scripts/generate_derivatives.py \\
+    --source_dir "./Data/FFHQ/ffhq_sorted" \\
+    --widths 256,512,768 \\
+    --formats webp,avif \\
+    --manifest image_labeler/manifest.txt
+"""
+
+VARIANTS_DIR = '_variants'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+def variant_relpath(relative_path, width, fmt):
+    """
+    Returns the path of one derivative relative to the output directory.
+    """
+    stem = os.path.splitext(relative_path)[0]
+    return f"{VARIANTS_DIR}/w{width}/{stem}.{fmt}"
+
+def _is_up_to_date(source_path, output_path):
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(source_path)
+    except OSError:
+        return False
+
+def _render_variants(source_path, relative_path, output_dir, widths, formats, quality):
+    """
+    Writes all missing or stale derivatives of one image. The source is only
+    decoded when at least one output needs to be (re)generated; widths larger
+    than the source are never generated, which is checked from the image
+    header alone, so they do not cause a decode on every run.
+
+    Returns:
+        tuple: (relative_path, written count, skipped count, {format: [widths]})
+    """
+    pending = []
+    available = {fmt: [] for fmt in formats}
+    for fmt in formats:
+        for width in widths:
+            output_path = os.path.join(output_dir, variant_relpath(relative_path, width, fmt))
+            if _is_up_to_date(source_path, output_path):
+                available[fmt].append(width)
+            else:
+                pending.append((width, fmt, output_path))
+
+    written = 0
+    if pending:
+        with Image.open(source_path) as image: # Reads only the header until the pixels are needed
+            pending = [item for item in pending if item[0] <= image.width] # Never upscale
+            if pending:
+                image = image.convert('RGB')
+            for width, fmt, output_path in pending:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS)
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                tmp_path = output_path + '.tmp'
+                resized.save(tmp_path, format=fmt.upper(), quality=quality)
+                os.replace(tmp_path, output_path)
+                available[fmt].append(width)
+                written += 1
+
+    return relative_path, written, len(widths) * len(formats) - written, {fmt: sorted(w) for fmt, w in available.items()}
+
+def _find_images(source_dir):
+    relative_paths = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = [d for d in dirs if d != VARIANTS_DIR]
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                relative_paths.append(os.path.relpath(os.path.join(root, file), source_dir).replace(os.sep, '/'))
+    return sorted(relative_paths)
+
+def _annotate_manifest(manifest_path, variants):
+    """
+    Rewrites manifest lines with "<format>=<widths>" fields for every image
+    processed in this run, keeping other fields and dropping stale variant
+    ones. Lines of images not in variants (failed or outside source_dir) are
+    kept as they are, since their existing derivatives are still on disk.
+    """
+    with open(manifest_path, 'r') as f:
+        lines = [line.rstrip('\n') for line in f]
+
+    annotated = []
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = line.split('\t')
+        relative_path = fields[0].strip()
+        if relative_path not in variants:
+            annotated.append(line)
+            continue
+        extra = [field for field in fields[1:] if field.split('=', 1)[0] not in ('webp', 'avif')]
+        for fmt, widths in variants.get(relative_path, {}).items():
+            if widths:
+                extra.append(f"{fmt}={','.join(str(width) for width in widths)}")
+        annotated.append('\t'.join([relative_path] + extra))
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(annotated) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+def generate_derivatives(source_dir, output_dir, widths, formats, quality=80, workers=None, manifest_path=None):
+    """
+    Generates resized derivatives for every image in the sorted tree.
+
+    Args:
+        source_dir (str): Root of the sorted gender/age/ethnicity tree.
+        output_dir (str): Directory under which the _variants tree is written.
+        widths (list): Target widths in pixels.
+        formats (list): Output formats ('webp' and/or 'avif').
+        quality (int): Encoder quality (0-100).
+        workers (int, optional): Number of worker processes. Defaults to the CPU count.
+        manifest_path (str, optional): manifest.txt to annotate with the available variants.
+    """
+    for fmt in formats:
+        if not features.check(fmt):
+            print(f"Error: This Pillow build cannot write '{fmt}' images.")
+            return
+
+    relative_paths = _find_images(source_dir)
+    if not relative_paths:
+        print(f"No images found in {source_dir}")
+        return
+
+    print(f"Found {len(relative_paths)} images. Generating {formats} at widths {widths}...")
+
+    written_count = 0
+    skipped_count = 0
+    error_count = 0
+    variants = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_render_variants, os.path.join(source_dir, relative_path), relative_path,
+                            output_dir, widths, formats, quality): relative_path
+            for relative_path in relative_paths
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating derivatives"):
+            try:
+                relative_path, written, skipped, available = future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                error_count += 1
+                continue
+            written_count += written
+            skipped_count += skipped
+            variants[relative_path] = available
+
+    if manifest_path:
+        _annotate_manifest(manifest_path, variants)
+        print(f"Annotated {manifest_path} with the available variants.")
+
+    print("\n-------------------------------------------------")
+    print("Derivative generation complete!")
+    print(f"Derivatives are saved in: {os.path.join(output_dir, VARIANTS_DIR)}")
+    print(f"Written {written_count} files, {skipped_count} already up to date.")
+    if error_count > 0:
+        print(f"Failed to process {error_count} images.")
+    print("-------------------------------------------------")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate resized WebP/AVIF derivatives of the sorted survey images.")
+    parser.add_argument(
+        '--source_dir',
+        type=str,
+        required=True,
+        help="Root of the sorted gender/age/ethnicity tree (e.g., Data/FFHQ/ffhq_sorted)."
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        default=None,
+        help="Directory under which the _variants tree is written. Defaults to source_dir so it is uploaded with the images."
+    )
+    parser.add_argument(
+        '--widths',
+        type=str,
+        default='256,512,768',
+        help="Comma-separated list of output widths in pixels (default: 256,512,768)."
+    )
+    parser.add_argument(
+        '--formats',
+        type=str,
+        default='webp',
+        help="Comma-separated list of output formats: webp, avif (default: webp)."
+    )
+    parser.add_argument(
+        '--quality',
+        type=int,
+        default=80,
+        help="Encoder quality from 0 to 100 (default: 80)."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help="Path to manifest.txt to annotate with the generated variants (e.g., image_labeler/manifest.txt)."
+    )
+
+    args = parser.parse_args()
+    widths_list = sorted({int(width) for width in args.widths.split(',')})
+    formats_list = [fmt.strip().lower() for fmt in args.formats.split(',') if fmt.strip()]
+
+    generate_derivatives(args.source_dir, args.output_dir or args.source_dir, widths_list, formats_list,
+                         args.quality, args.workers, args.manifest)
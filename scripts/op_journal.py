@@ -0,0 +1,296 @@
+import os
+import json
+import shutil
+import filecmp
+from tqdm import tqdm
+
+"""
+A write-ahead journal for the file operations of the filter scripts, so that
+large reorganizations can run unattended, be resumed after an interruption and
+be undone.
+
+The journal is a JSON-lines file. It starts with the arguments the run was
+planned with, followed by the planned operations, one per line and written
+atomically before anything is touched:
+
+    {"params": {"source_dir": "...", "age_groups": ["20-29"], ...}}
+    {"op": "move", "src": "...", "dst": "..."}
+
+followed by completion markers appended as the run progresses:
+
+    {"done": 17}                     operation 17 (0-based, after the params) was applied
+    {"done": 17, "skipped": true}    ... without changes, as its copy already existed
+    {"undone": 17}                   operation 17 was reverted by a rollback
+    {"closed": true}                 every applied operation was rolled back
+
+A skipped copy is not reverted, so a rollback never deletes a file the run
+did not write. A reverted operation counts as pending again, and a closed
+journal has nothing left to resume: the next run plans from scratch.
+
+Operations:
+    move    Move src to dst.
+    copy    Copy src to dst (via a temporary file, so dst is never partial).
+    dedupe  Delete src, which is byte-identical to the existing dst.
+
+Every operation is idempotent, so an operation whose marker was lost in a
+crash is simply re-applied on resume. A re-run only reads the journal and
+processes the operations without a marker, without re-planning or re-stating
+the rest of the tree. A journal with unfinished operations is only resumed
+by a run with the same arguments; a run with different ones stops with a
+JournalMismatchError until the old run is abandoned (restart) or rolled back.
+"""
+
+OPERATIONS = ('move', 'copy', 'dedupe')
+
+# Completion markers are fsynced in batches; a lost marker only means the
+# (idempotent) operation is applied again on resume.
+SYNC_EVERY = 256
+
+class JournalMismatchError(Exception):
+    """
+    Raised when a journal holds an unfinished run planned with other arguments.
+    """
+
+def _copy_atomic(source_path, dest_path):
+    tmp_path = dest_path + '.tmp'
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+def apply_operation(op):
+    """
+    Applies one journaled operation. Safe to call again after a crash.
+    Returns True if it was skipped because dst already existed.
+    """
+    source_path, dest_path = op['src'], op['dst']
+    if op['op'] == 'move':
+        if not os.path.exists(source_path) and os.path.exists(dest_path):
+            return # Already moved
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.move(source_path, dest_path)
+    elif op['op'] == 'copy':
+        if os.path.exists(dest_path):
+            return True # Not written by this run, so a rollback must keep it
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        _copy_atomic(source_path, dest_path)
+    elif op['op'] == 'dedupe':
+        if not os.path.exists(source_path):
+            return # Already removed
+        if not filecmp.cmp(source_path, dest_path, shallow=False):
+            raise RuntimeError(f"{source_path} differs from {dest_path}; refusing to delete it")
+        os.remove(source_path)
+    else:
+        raise ValueError(f"Unknown operation: {op['op']}")
+
+def revert_operation(op):
+    """
+    Undoes one applied operation. Safe to call again after a crash.
+    """
+    source_path, dest_path = op['src'], op['dst']
+    if op['op'] == 'move':
+        if os.path.exists(source_path) and not os.path.exists(dest_path):
+            return # Already moved back
+        os.makedirs(os.path.dirname(source_path), exist_ok=True)
+        shutil.move(dest_path, source_path)
+    elif op['op'] == 'copy':
+        if os.path.exists(dest_path) and not op.get('skipped'):
+            os.remove(dest_path)
+    elif op['op'] == 'dedupe':
+        if not os.path.exists(source_path):
+            _copy_atomic(dest_path, source_path)
+    else:
+        raise ValueError(f"Unknown operation: {op['op']}")
+
+class OperationJournal:
+    def __init__(self, path):
+        self.path = path
+        self.params = None
+        self.operations = []
+        self.done = set()
+        self.undone = set()
+        self.closed = False
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Marker torn by a crash; the operation is re-applied
+                if 'params' in record:
+                    self.params = record['params']
+                elif 'op' in record:
+                    self.operations.append(record)
+                elif 'done' in record:
+                    self.done.add(record['done'])
+                    self.undone.discard(record['done'])
+                    self.operations[record['done']]['skipped'] = record.get('skipped', False)
+                elif 'undone' in record:
+                    self.undone.add(record['undone'])
+                elif 'closed' in record:
+                    self.closed = True
+
+    def pending(self):
+        """
+        Returns the indexes of planned operations that have not been applied,
+        or were rolled back, unless the whole run was rolled back.
+        """
+        if self.closed:
+            return []
+        return [index for index in range(len(self.operations)) if index not in self.done or index in self.undone]
+
+    def applied(self):
+        """
+        Returns the indexes of applied operations that have not been rolled back.
+        """
+        return [index for index in range(len(self.operations)) if index in self.done and index not in self.undone]
+
+    def start(self, operations, params=None):
+        """
+        Atomically replaces the journal with a new plan of (op, src, dst) tuples,
+        recording the arguments it was planned with.
+        """
+        self.params = params
+        self.operations = [{'op': op, 'src': src, 'dst': dst} for op, src, dst in operations]
+        self.done = set()
+        self.undone = set()
+        self.closed = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if params is not None:
+                f.write(json.dumps({'params': params}) + '\n')
+            for record in self.operations:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _process(self, indexes, function, marker, desc):
+        processed_count = 0
+        errors = []
+        with open(self.path, 'a') as f:
+            for count, index in enumerate(tqdm(indexes, desc=desc), start=1):
+                op = self.operations[index]
+                try:
+                    skipped = function(op)
+                except Exception as e:
+                    tqdm.write(f"Error processing {op['src']} ({op['op']}): {e}")
+                    errors.append(index)
+                    continue
+                record = {marker: index}
+                if marker == 'done':
+                    op['skipped'] = bool(skipped)
+                    if skipped:
+                        record['skipped'] = True
+                f.write(json.dumps(record) + '\n')
+                processed_count += 1
+                if count % SYNC_EVERY == 0:
+                    f.flush()
+                    os.fsync(f.fileno())
+            f.flush()
+            os.fsync(f.fileno())
+        return processed_count, errors
+
+    def execute(self, desc="Applying operations"):
+        """
+        Applies all pending operations, appending a completion marker for each.
+
+        Returns:
+            tuple: (number applied, indexes that failed)
+        """
+        pending = self.pending()
+        processed_count, errors = self._process(pending, apply_operation, 'done', desc)
+        self.done.update(index for index in pending if index not in errors)
+        self.undone.difference_update(index for index in pending if index not in errors)
+        return processed_count, errors
+
+    def rollback(self, desc="Rolling back"):
+        """
+        Reverts all applied operations in reverse order. If all of them were
+        reverted, the journal is closed so the next run plans from scratch.
+
+        Returns:
+            tuple: (number reverted, indexes that failed)
+        """
+        applied = self.applied()[::-1]
+        processed_count, errors = self._process(applied, revert_operation, 'undone', desc)
+        self.undone.update(index for index in applied if index not in errors)
+        if not errors:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'closed': True}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.closed = True
+        return processed_count, errors
+
+    def counts(self):
+        return {op: sum(1 for record in self.operations if record['op'] == op) for op in OPERATIONS}
+
+def run_journaled(journal_path, plan_operations, desc="Applying operations", params=None, restart=False):
+    """
+    Resumes the unfinished run recorded in journal_path, or plans and journals
+    a new one with plan_operations() and applies it.
+
+    Args:
+        journal_path (str): Journal file.
+        plan_operations (callable): Returns a list of (op, src, dst) tuples.
+                                    Not called when a run is being resumed.
+        desc (str): Progress bar label.
+        params (dict, optional): JSON-serializable arguments of this run. An
+                                 unfinished run is only resumed if it was
+                                 planned with the same ones.
+        restart (bool): Abandon an unfinished run and plan a new one. Its
+                        applied operations can then no longer be rolled back.
+
+    Returns:
+        tuple: (journal, number applied, indexes that failed), or None if
+               there was nothing to do.
+
+    Raises:
+        JournalMismatchError: The journal holds an unfinished run planned
+                              with different arguments and restart is not set.
+    """
+    journal = OperationJournal(journal_path)
+    pending = journal.pending()
+    if pending and not restart and journal.params != params:
+        raise JournalMismatchError(
+            f"{journal_path} holds an unfinished run ({len(pending)} operations remaining) planned with "
+            f"different arguments: {journal.params}. Use --restart to abandon it and plan a new run, "
+            f"or --rollback to undo it.")
+    if pending and not restart:
+        print(f"Resuming the run journaled in {journal_path}: "
+              f"{len(pending)} of {len(journal.operations)} operations remaining.")
+    else:
+        if pending:
+            print(f"Abandoning {len(pending)} unfinished operations journaled in {journal_path}.")
+        operations = plan_operations()
+        if not operations:
+            if pending:
+                journal.start([], params) # Drop the abandoned run so it is not resumed later
+            return None # Otherwise keep the previous journal so that run can still be rolled back
+        journal.start(operations, params)
+        print(f"Journaled {len(operations)} operations in {journal_path}.")
+
+    processed_count, errors = journal.execute(desc)
+    return journal, processed_count, errors
+
+def rollback_journaled(journal_path, desc="Rolling back"):
+    """
+    Undoes the run recorded in journal_path and prints a summary.
+    """
+    if not os.path.exists(journal_path):
+        print(f"Error: No journal found at {journal_path}.")
+        return
+    journal = OperationJournal(journal_path)
+    reverted_count, errors = journal.rollback(desc)
+    print(f"Rolled back {reverted_count} operations recorded in {journal_path}.")
+    if errors:
+        print(f"Failed to roll back {len(errors)} operations; run --rollback again to retry.")
+
+def default_journal_path(directory, script_name):
+    """
+    Places the journal next to (not inside) the directory being reorganized,
+    so it is never uploaded or listed as part of the dataset.
+    """
+    return f"{os.path.normpath(directory)}.{script_name}.journal"
@@ -0,0 +1,276 @@
+import os
+import argparse
+import pandas as pd
+from file_ops import ACTIONS, format_throughput, list_files, run_file_operations
+from content_store import ContentStore
+
+"""
+This script builds the final gender/age_group/ethnicity tree used by the survey
+in a single pass, replacing the chained prepare_ffhq.py -> filter_by_age.py ->
+filter_by_demographics.py workflow that read and wrote the dataset up to three
+times.
+
+ffhq_aging_labels.csv and FFHQ_Demographics.csv are joined in memory, every
+image's destination is computed in one vectorized step, each file is
+materialized exactly once on a worker pool, and manifest.txt is written from
+the files that actually exist in the output tree.
+
+Example:
+python scripts/organize_dataset.py \\
+    --aging_csv "/path/to/ffhq_aging_labels.csv" \\
+    --demographics_csv "/path/to/FFHQ_Demographics.csv" \\
+    --source_dir "/path/to/images1024x1024" \\
+    --output_dir "./Data/FFHQ/ffhq_sorted" \\
+    --target_ethnicity Asian \\
+    --age_groups 15-19,20-29 \\
+    --action hardlink \\
+    --manifest image_labeler/manifest.txt
+
+With --store, source images are first added to the content-addressed store
+(see content_store.py) and the tree is built from the stored objects, so
+identical images share one object across every organized tree. With
+--clusters and --max_per_identity, at most N images of each identity cluster
+found by dedup_identities.py are kept.
+"""
+
+def load_labels(aging_csv, demographics_csv):
+    """
+    Joins the FFHQ-Aging labels with the FFHQ demographics on the image number.
+
+    Returns:
+        pandas.DataFrame: One row per image with 'image_id' (zero-padded),
+                          'gender', 'age_group' and 'ethnicity' (NaN if unknown),
+                          or None if a file or column is missing. Images
+                          without an age group are left out, as
+                          filter_by_age.py never selected them either.
+    """
+    try:
+        print(f"Reading labels from {aging_csv}...")
+        aging = pd.read_csv(aging_csv)
+        print(f"Reading demographics from {demographics_csv}...")
+        demographics = pd.read_csv(demographics_csv)
+    except FileNotFoundError as e:
+        print(f"Error: The file '{e.filename}' was not found.")
+        return None
+
+    required_columns = {'image_number', 'gender', 'age_group'}
+    if not required_columns.issubset(aging.columns):
+        print(f"Error: CSV file must contain the following columns: {required_columns}")
+        return None
+    if not {'File', 'Ethnic'}.issubset(demographics.columns):
+        print("Error: CSV file must contain 'File' and 'Ethnic' columns.")
+        return None
+
+    age_group = aging['age_group'].astype(str).str.strip()
+    has_age_group = aging['age_group'].notna() & (age_group != '')
+    labels = pd.DataFrame({
+        'image_id': aging['image_number'].astype(str).str.strip().str.zfill(5),
+        'gender': aging['gender'],
+        'age_group': age_group,
+    })[has_age_group]
+    ethnicity = pd.DataFrame({
+        'image_id': demographics['File'].astype(str).str.strip().str.replace(r'\.\w+$', '', regex=True).str.zfill(5),
+        'ethnicity': demographics['Ethnic'],
+    }).drop_duplicates('image_id')
+    return labels.merge(ethnicity, on='image_id', how='left')
+
+def compute_destinations(labels, target_ethnicity=None):
+    """
+    Adds the source path in the nested FFHQ layout (e.g. 01000/01234.png) and
+    the destination path gender/age_group/<target ethnicity or 'other'>/file,
+    matching the folders produced by filter_by_demographics.py. Without a
+    target ethnicity the lowercased ethnicity itself (or 'unknown') is used.
+
+    Returns:
+        pandas.DataFrame: labels restricted to male/female rows, with
+                          'ethnicity_dir', 'source_rel' and 'dest_rel' columns.
+    """
+    labels = labels[labels['gender'].isin(['male', 'female'])].copy()
+    ethnicity = labels['ethnicity'].fillna('unknown').astype(str).str.lower()
+    if target_ethnicity:
+        target = target_ethnicity.lower()
+        labels['ethnicity_dir'] = ethnicity.where(ethnicity == target, 'other')
+    else:
+        labels['ethnicity_dir'] = ethnicity
+    folder_name = (labels['image_id'].astype(int) // 1000 * 1000).astype(str).str.zfill(5)
+    labels['source_rel'] = folder_name + '/' + labels['image_id'] + '.png'
+    labels['dest_rel'] = (labels['gender'] + '/' + labels['age_group'] + '/' +
+                          labels['ethnicity_dir'] + '/' + labels['image_id'] + '.png')
+    return labels
+
+def cap_per_identity(plan, clusters_csv, max_per_identity):
+    """
+    Keeps at most max_per_identity images (lowest image ids first) of each
+    identity cluster written by dedup_identities.py. Images without a cluster
+    are kept.
+    """
+    clusters = pd.read_csv(clusters_csv, usecols=['filename', 'cluster_id'])
+    clusters['image_id'] = clusters['filename'].str.rsplit('/', n=1).str[-1].str.replace(r'\.\w+$', '', regex=True)
+    plan = plan.merge(clusters[['image_id', 'cluster_id']].drop_duplicates('image_id'), on='image_id', how='left')
+    clustered = plan['cluster_id'].notna()
+    capped = plan[clustered].sort_values('image_id').groupby('cluster_id').head(max_per_identity)
+    print(f"Capped identities at {max_per_identity} images: dropped {int(clustered.sum()) - len(capped)} images.")
+    return pd.concat([capped, plan[~clustered]]).drop(columns='cluster_id')
+
+def write_manifest(manifest_path, relative_paths):
+    """
+    Atomically writes manifest.txt with one relative path per line.
+    """
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for relative_path in sorted(relative_paths):
+            f.write(relative_path + '\n')
+    os.replace(tmp_path, manifest_path)
+
+def organize_dataset(aging_csv, demographics_csv, source_dir, output_dir, target_ethnicity,
+                     age_groups=None, action='copy', workers=8, manifest_path=None, store_dir=None,
+                     clusters_csv=None, max_per_identity=None):
+    """
+    Materializes the gender/age_group/ethnicity tree in one pass.
+
+    Args:
+        aging_csv (str): Path to ffhq_aging_labels.csv.
+        demographics_csv (str): Path to FFHQ_Demographics.csv.
+        source_dir (str): Directory with the FFHQ images (e.g. images1024x1024/01000/01234.png).
+        output_dir (str): Root of the organized tree.
+        target_ethnicity (str): Ethnicity that gets its own folder; all others go to 'other'.
+        age_groups (list, optional): Age groups to keep. Defaults to all.
+        action (str): One of 'copy', 'move', 'hardlink', 'reflink' or 'symlink'.
+        workers (int): Number of parallel file operations.
+        manifest_path (str, optional): Where to write manifest.txt for the organized tree.
+        store_dir (str, optional): Content-addressed store to link the tree from.
+        clusters_csv (str, optional): Identity clusters from dedup_identities.py.
+        max_per_identity (int, optional): Maximum number of images per identity cluster.
+    """
+    labels = load_labels(aging_csv, demographics_csv)
+    if labels is None:
+        return
+
+    if age_groups:
+        labels = labels[labels['age_group'].isin(age_groups)]
+    plan = compute_destinations(labels, target_ethnicity)
+    if clusters_csv and max_per_identity:
+        plan = cap_per_identity(plan, clusters_csv, max_per_identity)
+    if plan.empty:
+        print("No images match the requested filters.")
+        return
+
+    print(f"Planned {len(plan)} images. Listing source and output directories...")
+    source_files = list_files(source_dir)
+    existing_files = list_files(output_dir)
+    already_organized = plan['dest_rel'].isin(existing_files)
+    source_found = plan['source_rel'].isin(source_files)
+    todo = ~already_organized & source_found
+
+    print(f"Organizing {int(todo.sum())} images (action: {action})...")
+    operations = [(os.path.join(source_dir, source), os.path.join(output_dir, dest))
+                  for source, dest in zip(plan['source_rel'][todo], plan['dest_rel'][todo])]
+    if store_dir and operations:
+        objects, stats = ContentStore(store_dir).ingest([source for source, _ in operations], workers=workers)
+        print(f"Store: {stats['new']} new objects, {stats['duplicates']} already stored.")
+        operations = [(objects[source], dest) for source, dest in operations]
+    result = run_file_operations(operations, action, workers=workers, desc="Organizing images")
+
+    if manifest_path:
+        failed = {os.path.relpath(path, output_dir).replace(os.sep, '/') for path in result['failed_destinations']}
+        present = plan['dest_rel'][already_organized | todo]
+        write_manifest(manifest_path, set(present) - failed)
+        print(f"Wrote {len(present) - len(failed)} entries to {manifest_path}.")
+
+    missing_count = int((~already_organized & ~source_found).sum())
+    print("\n-------------------------------------------------")
+    print("Dataset organization complete!")
+    print(f"Organized images are saved in: {output_dir}")
+    print(f"Successfully processed {result['processed']} images "
+          f"({format_throughput(result['bytes'], result['processed'], result['seconds'])}).")
+    print(f"Already in place: {int(already_organized.sum())}, not found in source: {missing_count}, "
+          f"errors: {result['failed']}.")
+    print("-------------------------------------------------")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Organize FFHQ into gender/age_group/ethnicity folders in one pass.")
+    parser.add_argument(
+        '--aging_csv',
+        type=str,
+        required=True,
+        help="Path to the ffhq_aging_labels.csv file."
+    )
+    parser.add_argument(
+        '--demographics_csv',
+        type=str,
+        required=True,
+        help="Path to the demographics CSV file (e.g., Data/FFHQ/FFHQ_Demographics.csv)."
+    )
+    parser.add_argument(
+        '--source_dir',
+        type=str,
+        required=True,
+        help="Directory containing the FFHQ .png images (e.g., images1024x1024)."
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        required=True,
+        help="Root of the organized tree (e.g., Data/FFHQ/ffhq_sorted)."
+    )
+    parser.add_argument(
+        '--target_ethnicity',
+        type=str,
+        required=True,
+        help="The target ethnicity to create a specific folder for (e.g., 'Asian'). Others go to 'other'."
+    )
+    parser.add_argument(
+        '--age_groups',
+        type=str,
+        default=None,
+        help="Comma-separated list of age groups to keep (e.g., '15-19,20-29'). Defaults to all."
+    )
+    parser.add_argument(
+        '--action',
+        type=str,
+        choices=ACTIONS,
+        default='copy',
+        help="Action to perform on files: 'copy' (default), 'move', 'hardlink', 'reflink' or 'symlink'."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of parallel file operations (default: 8)."
+    )
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help="Path of the manifest.txt to write for the organized tree (e.g., image_labeler/manifest.txt)."
+    )
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=None,
+        help="Content-addressed store (e.g., Data/store) to add the sources to and link the tree from."
+    )
+    parser.add_argument(
+        '--clusters',
+        type=str,
+        default=None,
+        help="Identity cluster CSV written by dedup_identities.py."
+    )
+    parser.add_argument(
+        '--max_per_identity',
+        type=int,
+        default=None,
+        help="Keep at most this many images per identity cluster (requires --clusters)."
+    )
+
+    args = parser.parse_args()
+    age_groups_list = [ag.strip() for ag in args.age_groups.split(',')] if args.age_groups else None
+    if args.max_per_identity and not args.clusters:
+        parser.error("--max_per_identity requires --clusters")
+    if args.store and args.action == 'move':
+        parser.error("--store cannot be combined with --action move; use hardlink, reflink, symlink or copy")
+
+    organize_dataset(args.aging_csv, args.demographics_csv, args.source_dir, args.output_dir,
+                     args.target_ethnicity, age_groups_list, args.action, args.workers, args.manifest, args.store,
+                     args.clusters, args.max_per_identity)
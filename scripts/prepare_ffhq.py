@@ -1,9 +1,8 @@
 
 import os
-import shutil
 import argparse
 import pandas as pd
-from tqdm import tqdm
+from file_ops import ACTIONS, format_throughput, list_files, run_file_operations
 
 """
 This script prepares the FFHQ dataset for the labeling survey by sorting
@@ -37,18 +36,30 @@ python scripts/prepare_ffhq.py \\
     --source_dir "/path/to/your/ffhq-images-source/" \\
     --output_dir "./Data/FFHQ_sorted" \\
     --action move
+
+# Sort without copying any bytes, using hard links on the same filesystem
+python scripts/prepare_ffhq.py \\
+    --csv_path "/path/to/your/ffhq_aging_labels.csv" \\
+    --source_dir "/path/to/your/ffhq-images-source/" \\
+    --output_dir "./Data/FFHQ_sorted" \\
+    --action hardlink --workers 16
 """
 
-def sort_ffhq_dataset(csv_path, source_dir, output_dir, action='copy', limit=None):
+def sort_ffhq_dataset(csv_path, source_dir, output_dir, action='copy', limit=None, workers=8):
     """
     Sorts pre-resized FFHQ images based on gender labels from a CSV file.
 
+    The source and output trees are each listed once up front, all paths are
+    built with vectorized pandas string operations, and the files are then
+    materialized on a bounded thread pool.
+
     Args:
         csv_path (str): Path to the ffhq_aging_labels.csv file.
         source_dir (str): Path to the directory containing FFHQ .png images.
         output_dir (str): Path to the directory where sorted images will be saved.
-        action (str): 'copy' to copy files, 'move' to move files. Defaults to 'copy'.
+        action (str): One of 'copy', 'move', 'hardlink', 'reflink' or 'symlink'. Defaults to 'copy'.
         limit (int, optional): Maximum number of images to process. Defaults to None (process all).
+        workers (int): Number of parallel file operations. Defaults to 8.
     """
     # Create output directories
     male_dir = os.path.join(output_dir, 'male')
@@ -77,49 +88,37 @@ def sort_ffhq_dataset(csv_path, source_dir, output_dir, action='copy', limit=Non
 
     print(f"Found {len(df)} labels. Starting image sorting (action: {action})...")
 
-    # Process each image
-    processed_count = 0
-    skipped_count = 0
-    for _, row in tqdm(df.iterrows(), total=df.shape[0], desc="Sorting images"):
-        image_id = str(row['image_number']).strip().zfill(5)
-        gender_label = row['gender']
-        
-        source_filename = f"{image_id}.png"
-        # Accommodate for the nested directory structure, e.g., images1024x1024/01000/01234.png
-        # For image_id '01234', the folder_name will be '01000'.
-        folder_name = str(int(image_id) // 1000 * 1000).zfill(5)
-        source_path = os.path.join(source_dir, folder_name, source_filename)
-        
-        if gender_label == 'male': # Male
-            dest_path = os.path.join(male_dir, source_filename)
-        elif gender_label == 'female': # Female
-            dest_path = os.path.join(female_dir, source_filename)
-        else:
-            continue # Skip if gender label is not 'male' or 'female'
-
-        # Skip if the destination file already exists
-        if os.path.exists(dest_path):
-            skipped_count += 1
-            continue
-
-        if not os.path.exists(source_path):
-            skipped_count += 1
-            continue
-
-        try:
-            if action == 'copy':
-                shutil.copyfile(source_path, dest_path)
-            elif action == 'move':
-                shutil.move(source_path, dest_path)
-            processed_count += 1
-        except Exception as e:
-            print(f"Error processing {source_path} with action '{action}': {e}")
-            skipped_count += 1
+    # Skip rows whose gender label is not 'male' or 'female'
+    df = df[df['gender'].isin(['male', 'female'])]
+
+    # Build all paths at once. Accommodate for the nested directory structure,
+    # e.g., images1024x1024/01000/01234.png: for image_id '01234' the folder is '01000'.
+    image_id = df['image_number'].astype(str).str.strip().str.zfill(5)
+    folder_name = (image_id.astype(int) // 1000 * 1000).astype(str).str.zfill(5)
+    source_rel = folder_name + '/' + image_id + '.png'
+    dest_rel = df['gender'] + '/' + image_id + '.png'
+
+    # One listing of each tree replaces the per-row existence checks
+    print("Listing source and output directories...")
+    source_files = list_files(source_dir)
+    existing_files = list_files(output_dir)
+    already_sorted = dest_rel.isin(existing_files)
+    source_found = source_rel.isin(source_files)
+    todo = ~already_sorted & source_found
+    skipped_count = int((~todo).sum())
+
+    operations = [(os.path.join(source_dir, source), os.path.join(output_dir, dest))
+                  for source, dest in zip(source_rel[todo], dest_rel[todo])]
+    result = run_file_operations(operations, action, workers=workers, desc="Sorting images")
+    processed_count = result['processed']
+    skipped_count += result['failed']
 
     print("\n-------------------------------------------------")
     print("Dataset sorting complete!")
     print(f"Sorted images are saved in: {output_dir}")
     print(f"Successfully processed {processed_count} images.")
+    print(f"Throughput: {format_throughput(result['bytes'], processed_count, result['seconds'])} "
+          f"({result['seconds']:.1f}s)")
     if skipped_count > 0:
         print(f"Skipped {skipped_count} images due to errors or not found or already existing in destination.")
     print("-------------------------------------------------")
@@ -148,9 +147,9 @@ if __name__ == '__main__':
     parser.add_argument(
         '--action',
         type=str,
-        choices=['copy', 'move'],
+        choices=ACTIONS,
         default='copy',
-        help="Action to perform on files: 'copy' (default) or 'move'. Use 'move' with caution."
+        help="Action to perform on files: 'copy' (default), 'move', 'hardlink', 'reflink' or 'symlink'. Use 'move' with caution."
     )
     parser.add_argument(
         '--limit',
@@ -158,6 +157,12 @@ if __name__ == '__main__':
         default=None,
         help="Maximum number of images to process from the CSV. Defaults to all images."
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help="Number of parallel file operations (default: 8)."
+    )
 
     args = parser.parse_args()
-    sort_ffhq_dataset(args.csv_path, args.source_dir, args.output_dir, args.action, args.limit)
+    sort_ffhq_dataset(args.csv_path, args.source_dir, args.output_dir, args.action, args.limit, args.workers)
@@ -0,0 +1,328 @@
+import os
+import json
+import hashlib
+import argparse
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from file_ops import list_files
+from content_store import ContentStore, hash_files
+from generate_derivatives import VARIANTS_DIR
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+except ImportError:
+    boto3 = None
+
+"""
+This script syncs the sorted image tree (including the _variants derivatives)
+to Cloudflare R2, or any S3-compatible endpoint, and writes manifest.txt from
+the objects that actually landed. The upload and the manifest therefore
+cannot drift apart.
+
+- The remote listing (ETag, size and content hash per key) is cached in a JSON
+  file, so a re-run needs no LIST requests unless --refresh_listing is given.
+- Local content hashes come from the content store's hash cache
+  (content_store.py), so unchanged files are not re-read.
+- Only new or changed objects are transferred. An object whose content is
+  already in the bucket under another key is copied server-side with
+  copy_object instead of being uploaded again.
+- Uploads run concurrently through one pooled client, and large files use
+  multipart uploads.
+
+Requires boto3. Credentials are read the usual boto3 way
+(AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY or a profile).
+
+Example:
+python scripts/sync_r2.py \\
+    --source_dir ./Data/FFHQ/ffhq_sorted \\
+    --bucket survey-images \\
+    --endpoint_url https://<account_id>.r2.cloudflarestorage.com \\
+    --manifest image_labeler/manifest.txt
+
+For local testing, point --endpoint_url at MinIO or a moto server
+(e.g., http://127.0.0.1:5000).
+"""
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+HASH_METADATA_KEY = 'content-hash'
+MULTIPART_THRESHOLD = 8 * (1 << 20)
+MULTIPART_CHUNKSIZE = 8 * (1 << 20)
+
+def s3_etag(path, part_size=MULTIPART_CHUNKSIZE):
+    """
+    Computes the ETag S3 assigns to path when uploaded with the given part size:
+    the MD5 for single-part uploads, otherwise the MD5 of the part MD5s plus "-<parts>".
+    """
+    if os.path.getsize(path) < MULTIPART_THRESHOLD:
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    part_digests = []
+    with open(path, 'rb') as f:
+        while chunk := f.read(part_size):
+            part_digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+def make_client(endpoint_url=None, workers=16):
+    return boto3.client(
+        's3',
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=workers * 2, retries={'max_attempts': 5, 'mode': 'adaptive'}),
+    )
+
+def list_remote(client, bucket, prefix):
+    """
+    Returns {key: {'etag': ..., 'size': ...}} for every object under prefix.
+    """
+    listing = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            listing[obj['Key']] = {'etag': obj['ETag'].strip('"'), 'size': obj['Size']}
+    return listing
+
+def load_listing(cache_path, client, bucket, prefix, refresh=False):
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('bucket') == bucket and cached.get('prefix') == prefix:
+            return cached['objects']
+    print(f"Listing s3://{bucket}/{prefix}...")
+    return list_remote(client, bucket, prefix)
+
+def save_listing(cache_path, bucket, prefix, objects):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'bucket': bucket, 'prefix': prefix, 'objects': objects}, f)
+    os.replace(tmp_path, cache_path)
+
+def plan_sync(local_files, digests, remote):
+    """
+    Compares the local tree with the remote listing.
+
+    Args:
+        local_files (dict): {key: local path}
+        digests (dict): {local path: content hash}
+        remote (dict): Remote listing; entries may carry a 'digest'.
+
+    Returns:
+        tuple: (keys to upload, [(source key, key)] to copy server-side, keys in sync)
+    """
+    in_sync = []
+    changed = []
+    for key, path in local_files.items():
+        entry = remote.get(key)
+        size = os.path.getsize(path)
+        if entry is None or entry['size'] != size:
+            changed.append(key)
+        elif entry.get('digest') is not None:
+            (in_sync if entry['digest'] == digests[path] else changed).append(key)
+        elif entry.get('etag') == s3_etag(path):
+            entry['digest'] = digests[path] # Uploaded by other means; adopt it
+            in_sync.append(key)
+        else:
+            changed.append(key)
+
+    remote_by_digest = {entry['digest']: key for key, entry in remote.items()
+                        if entry.get('digest') is not None and key not in changed}
+    uploads = []
+    copies = []
+    for key in changed:
+        source_key = remote_by_digest.get(digests[local_files[key]])
+        if source_key is not None:
+            copies.append((source_key, key))
+        else:
+            uploads.append(key)
+            remote_by_digest.setdefault(digests[local_files[key]], key)
+    return uploads, copies, in_sync
+
+def _upload(client, bucket, key, path, digest, transfer_config):
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    client.upload_file(path, bucket, key, Config=transfer_config,
+                       ExtraArgs={'ContentType': content_type, 'Metadata': {HASH_METADATA_KEY: digest}})
+    head = client.head_object(Bucket=bucket, Key=key)
+    return {'etag': head['ETag'].strip('"'), 'size': head['ContentLength'], 'digest': digest}
+
+def _copy(client, bucket, source_key, key, digest):
+    client.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': source_key},
+                       MetadataDirective='COPY')
+    head = client.head_object(Bucket=bucket, Key=key)
+    return {'etag': head['ETag'].strip('"'), 'size': head['ContentLength'], 'digest': digest}
+
+def _run_transfers(tasks, workers, desc):
+    """
+    Runs {key: callable} concurrently and returns ({key: listing entry}, [failed keys]).
+    """
+    results = {}
+    failed = []
+    if not tasks:
+        return results, failed
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task): key for key, task in tasks.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                tqdm.write(f"Error transferring {key}: {e}")
+                failed.append(key)
+    return results, failed
+
+def write_landed_manifest(manifest_path, relative_paths):
+    """
+    Atomically writes manifest.txt for the landed images, keeping the extra
+    tab-separated fields (variants, ...) of lines already in the manifest.
+    """
+    extra_fields = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0].strip():
+                    extra_fields[fields[0].strip()] = fields[1:]
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for relative_path in sorted(relative_paths):
+            f.write('\t'.join([relative_path] + extra_fields.get(relative_path, [])) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+def sync_to_r2(source_dir, bucket, endpoint_url=None, prefix='', manifest_path=None, workers=16,
+               listing_cache=None, refresh_listing=False, store_dir=None, dry_run=False):
+    """
+    Uploads new or changed files of source_dir and regenerates the manifest.
+
+    Args:
+        source_dir (str): Root of the sorted tree to upload.
+        bucket (str): Bucket name.
+        endpoint_url (str, optional): S3 endpoint (R2, MinIO, moto). Defaults to AWS.
+        prefix (str): Key prefix inside the bucket.
+        manifest_path (str, optional): manifest.txt to write from the landed images.
+        workers (int): Number of concurrent transfers.
+        listing_cache (str, optional): Remote listing cache. Defaults to '<source_dir>.r2_listing.json'.
+        refresh_listing (bool): Re-list the bucket instead of trusting the cache.
+        store_dir (str, optional): Content store whose hash cache is used. Defaults to '<source_dir>.store'.
+        dry_run (bool): Only report what would be transferred.
+    """
+    if boto3 is None:
+        print("Error: boto3 is required for syncing. Install it with 'pip install boto3'.")
+        return
+
+    source_dir = os.path.normpath(source_dir)
+    listing_cache = listing_cache or f"{source_dir}.r2_listing.json"
+    local_files = {prefix + relative: os.path.join(source_dir, relative) for relative in list_files(source_dir)}
+    print(f"Found {len(local_files)} local files in {source_dir}.")
+
+    cache = ContentStore(store_dir or f"{source_dir}.store").open_cache()
+    try:
+        digests = hash_files(list(local_files.values()), cache, workers=workers)
+    finally:
+        cache.close()
+
+    client = make_client(endpoint_url, workers)
+    remote = load_listing(listing_cache, client, bucket, prefix, refresh_listing)
+    uploads, copies, in_sync = plan_sync(local_files, digests, remote)
+    print(f"{len(in_sync)} objects in sync, {len(uploads)} to upload, {len(copies)} to copy server-side.")
+    if dry_run:
+        return
+
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                     max_concurrency=4, use_threads=True)
+    uploaded, upload_failures = _run_transfers(
+        {key: (lambda key=key: _upload(client, bucket, key, local_files[key], digests[local_files[key]], transfer_config))
+         for key in uploads},
+        workers, "Uploading")
+    remote.update(uploaded)
+    save_listing(listing_cache, bucket, prefix, remote)
+
+    # Copies run after the uploads because their source may have been uploaded in this run
+    copies = [(source_key, key) for source_key, key in copies if source_key not in upload_failures]
+    copied, copy_failures = _run_transfers(
+        {key: (lambda key=key, source_key=source_key: _copy(client, bucket, source_key, key, digests[local_files[key]]))
+         for source_key, key in copies},
+        workers, "Copying")
+    remote.update(copied)
+    save_listing(listing_cache, bucket, prefix, remote)
+
+    failed = set(upload_failures) | set(copy_failures) | (set(local_files) - set(in_sync) - set(uploaded) - set(copied))
+    landed = [key[len(prefix):] for key in local_files if key not in failed]
+    if manifest_path:
+        images = [relative for relative in landed
+                  if relative.lower().endswith(IMAGE_EXTENSIONS) and not relative.startswith(VARIANTS_DIR + '/')]
+        write_landed_manifest(manifest_path, images)
+        print(f"Wrote {len(images)} landed images to {manifest_path}.")
+
+    print("\n-------------------------------------------------")
+    print("R2 sync complete!")
+    print(f"Uploaded {len(uploaded)}, copied {len(copied)}, already in sync {len(in_sync)}.")
+    if failed:
+        print(f"Failed to transfer {len(failed)} objects; they are left out of the manifest. Run the sync again to retry.")
+    print("-------------------------------------------------")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync the sorted image tree to Cloudflare R2 and regenerate manifest.txt.")
+    parser.add_argument(
+        '--source_dir',
+        type=str,
+        required=True,
+        help="Root of the sorted tree to upload (e.g., Data/FFHQ/ffhq_sorted)."
+    )
+    parser.add_argument(
+        '--bucket',
+        type=str,
+        required=True,
+        help="Name of the R2 bucket."
+    )
+    parser.add_argument(
+        '--endpoint_url',
+        type=str,
+        default=os.environ.get('R2_ENDPOINT_URL'),
+        help="S3 endpoint, e.g. https://<account_id>.r2.cloudflarestorage.com or a local MinIO/moto server. Defaults to $R2_ENDPOINT_URL."
+    )
+    parser.add_argument(
+        '--prefix',
+        type=str,
+        default='',
+        help="Key prefix inside the bucket (default: bucket root)."
+    )
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help="Path of the manifest.txt to regenerate from the landed images (e.g., image_labeler/manifest.txt)."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=16,
+        help="Number of concurrent transfers (default: 16)."
+    )
+    parser.add_argument(
+        '--listing_cache',
+        type=str,
+        default=None,
+        help="Remote listing cache file. Defaults to '<source_dir>.r2_listing.json'."
+    )
+    parser.add_argument(
+        '--refresh_listing',
+        action='store_true',
+        help="List the bucket again instead of trusting the cached listing."
+    )
+    parser.add_argument(
+        '--store',
+        type=str,
+        default=None,
+        help="Content store whose hash cache is used (e.g., Data/store). Defaults to '<source_dir>.store'."
+    )
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help="Only report what would be transferred."
+    )
+
+    args = parser.parse_args()
+    sync_to_r2(args.source_dir, args.bucket, args.endpoint_url, args.prefix, args.manifest, args.workers,
+               args.listing_cache, args.refresh_listing, args.store, args.dry_run)